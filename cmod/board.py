@@ -1,7 +1,102 @@
 import cmod.logger as logger
 import cmod.gcoder as gcoder
+import numpy as np
+import bisect
 import json
 
+
+class CalibTable(dict):
+  """
+  Calibration results of a single chip indexed by the gantry z value. This
+  behaves as a regular dictionary, but also keeps a sorted list of the z values
+  for bisection lookup of the closest measured z value, and allows for the
+  interpolation of the results between the measured z values.
+  """
+
+  INTERPOLATION = ['nearest', 'linear', 'spline']
+
+  def __init__(self, *args, **kwargs):
+    dict.__init__(self)
+    self._zlist = []
+    self._spline = None
+    self.update(*args, **kwargs)
+
+  def __setitem__(self, z, value):
+    if not z in self:
+      bisect.insort(self._zlist, z)
+    dict.__setitem__(self, z, value)
+    self._spline = None
+
+  def __delitem__(self, z):
+    dict.__delitem__(self, z)
+    self._zlist.remove(z)
+    self._spline = None
+
+  def __reduce__(self):
+    return (CalibTable, (dict(self), ))
+
+  def update(self, *args, **kwargs):
+    for z, value in dict(*args, **kwargs).items():
+      self[z] = value
+
+  def setdefault(self, z, value=None):
+    if not z in self:
+      self[z] = value
+    return self[z]
+
+  def pop(self, z, *default):
+    if z in self:
+      value = self[z]
+      del self[z]
+      return value
+    return dict.pop(self, z, *default)
+
+  def clear(self):
+    dict.clear(self)
+    self._zlist = []
+    self._spline = None
+
+  def zlist(self):
+    return self._zlist
+
+  def closest_z(self, z):
+    """
+    Measured z value closest to the requested value.
+    """
+    idx = bisect.bisect_left(self._zlist, z)
+    return min(self._zlist[max(idx - 1, 0):idx + 1], key=lambda x: abs(x - z))
+
+  def at(self, z, mode='nearest'):
+    """
+    Calibration result at z. For the nearest mode the result of the closest
+    measured z value is returned as is. For the linear and spline modes, the
+    result is interpolated between the measured z values (clamped to the
+    measured range), and returned as a list of the same shape as the stored
+    results.
+    """
+    if not self._zlist:
+      raise KeyError('No calibration value stored')
+    if mode == 'nearest' or len(self._zlist) == 1:
+      return self[self.closest_z(z)]
+
+    z = min(max(z, self._zlist[0]), self._zlist[-1])
+    if mode == 'spline' and len(self._zlist) >= 3:
+      if self._spline is None:
+        from scipy.interpolate import CubicSpline
+        values = np.array([self[x] for x in self._zlist], dtype=float)
+        self._spline = (CubicSpline(self._zlist,
+                                    values.reshape(len(self._zlist), -1)),
+                        values.shape[1:])
+      spline, shape = self._spline
+      return spline(z).reshape(shape).tolist()
+
+    idx = min(max(bisect.bisect_right(self._zlist, z), 1), len(self._zlist) - 1)
+    z0, z1 = self._zlist[idx - 1], self._zlist[idx]
+    t = (z - z0) / (z1 - z0)
+    return ((1 - t) * np.asarray(self[z0], dtype=float) +
+            t * np.asarray(self[z1], dtype=float)).tolist()
+
+
 class Board(object):
   """
   Class for storing a board type and a list of chip x-y positions
@@ -14,6 +109,14 @@ class Board(object):
     self.vis_coord = {}
     self.visM = {}
     self.lumi_coord = {}
+    ## Interpolation method for calibration lookups between measured z values
+    self.interpolation = 'nearest'
+    ## Session journal (cmod.journal.Journal) for recording calibration changes
+    self.journal = None
+
+  def record(self, entry, **data):
+    if self.journal:
+      self.journal.record(entry, **data)
 
   def set_boardtype(self, file):
     if any(self.chips()) or not self.empty():
@@ -22,6 +125,10 @@ class Board(object):
                         'for the current session'))
 
     jsontemp = json.loads(open(file, 'r').read())
+    self.set_boardtype_json(jsontemp)
+    self.record('boardtype', file=file, content=jsontemp)
+
+  def set_boardtype_json(self, jsontemp):
     self.boardtype = jsontemp['board type']
     self.boardid = jsontemp['board id']
 
@@ -47,9 +154,9 @@ class Board(object):
             [min([self.orig_coord[str(key)][1],
                   gcoder.GCoder.max_y()]), 0])
 
-      self.vis_coord[str(key)] = {}
-      self.visM[str(key)] = {}
-      self.lumi_coord[str(key)] = {}
+      self.vis_coord[str(key)] = CalibTable()
+      self.visM[str(key)] = CalibTable()
+      self.lumi_coord[str(key)] = CalibTable()
 
   def load_calib_file(self, file):
     if not self.empty():
@@ -57,11 +164,14 @@ class Board(object):
                         'boardtype will erase any existing configuration '
                         'for the current session'))
     jsontemp = json.loads(open(file, 'r').read())
+    self.load_calib_json(jsontemp)
+    self.record('calibfile', file=file, content=jsontemp)
 
+  def load_calib_json(self, jsontemp):
     def make_fz_dict(ext_dict):
       return {
-          chipid: {float(z): obj
-                   for z, obj in ext_dict[chipid].items()}
+          chipid: CalibTable({float(z): obj
+                              for z, obj in ext_dict[chipid].items()})
           for chipid in self.chips()
       }
 
@@ -89,19 +199,23 @@ class Board(object):
   def add_calib_chip(self, chipid):
     if chipid not in self.orig_coord and int(chipid) < 0:
       self.orig_coord[chipid] = [-100, -100]  # Non-existent calibration chip
-      self.vis_coord[chipid] = {}
-      self.visM[chipid] = {}
-      self.lumi_coord[chipid] = {}
+      self.vis_coord[chipid] = CalibTable()
+      self.visM[chipid] = CalibTable()
+      self.lumi_coord[chipid] = CalibTable()
+      self.record('calibchip', chip=chipid)
 
   # Get/Set calibration measures with additional parsing
   def add_vis_coord(self, chip, z, data):
     self.vis_coord[chip][self.roundz(z)] = data
+    self.record('vis_coord', chip=chip, z=self.roundz(z), data=data)
 
   def add_visM(self, chip, z, data):
     self.visM[chip][self.roundz(z)] = data
+    self.record('visM', chip=chip, z=self.roundz(z), data=data)
 
   def add_lumi_coord(self, chip, z, data):
     self.lumi_coord[chip][self.roundz(z)] = data
+    self.record('lumi_coord', chip=chip, z=self.roundz(z), data=data)
 
   def get_vis_coord(self, chip, z):
     return self.vis_coord[chip][self.roundz(z)]
@@ -110,7 +224,17 @@ class Board(object):
     return self.visM[chip][self.roundz(z)]
 
   def get_lumi_coord(self, chip, z):
-    return self.vis_coord[chip][self.roundz(z)]
+    return self.lumi_coord[chip][self.roundz(z)]
+
+  # Calibration values at arbitrary z with the session interpolation method
+  def interp_vis_coord(self, chip, z):
+    return self.vis_coord[chip].at(z, self.interpolation)
+
+  def interp_visM(self, chip, z):
+    return self.visM[chip].at(z, self.interpolation)
+
+  def interp_lumi_coord(self, chip, z):
+    return self.lumi_coord[chip].at(z, self.interpolation)
 
   def vis_coord_hasz(self, chip, z):
     return self.roundz(z) in self.vis_coord[chip]
@@ -0,0 +1,151 @@
+import cmod.jsonenc as jsonenc
+import threading
+import sqlite3
+import time
+import os
+
+
+class Catalogue(object):
+  """
+  SQLite catalogue of the data files produced by the session commands. Each
+  save file is registered when it is opened, with the board, chip, command
+  and command parameters used to produce it, and is updated with the end time,
+  row count and status when the command finishes. This allows the data files of
+  a given chip, command and z position to be selected without parsing the file
+  names. The connection is shared by the command threads of the server mode, with
+  the statements serialized by the catalogue lock.
+  """
+
+  default_file = os.path.join(os.path.expanduser('~'),
+                              '.sipmcalib_catalogue.db')
+
+  SCHEMA = [
+      """
+      CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command TEXT NOT NULL,
+        cmdline TEXT,
+        params TEXT,
+        boardtype TEXT,
+        boardid TEXT,
+        chip TEXT,
+        z REAL,
+        filename TEXT,
+        path TEXT,
+        format TEXT,
+        start REAL,
+        end REAL,
+        rows INTEGER,
+        status TEXT
+      )
+      """,
+      'CREATE INDEX IF NOT EXISTS runs_chip ON runs (chip, command, z)',
+      'CREATE INDEX IF NOT EXISTS runs_board ON runs (boardid, start)',
+      'CREATE INDEX IF NOT EXISTS runs_start ON runs (start)',
+  ]
+
+  def __init__(self):
+    self.filename = Catalogue.default_file
+    self.db = None
+    self.lock = threading.RLock()
+
+  def open(self, filename):
+    self.close()
+    self.filename = filename
+    self.connect()
+
+  def connect(self):
+    """
+    The database is opened on first use, so that sessions that never write a
+    data file do not create one.
+    """
+    with self.lock:
+      if self.db is None:
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        for statement in Catalogue.SCHEMA:
+          self.db.execute(statement)
+        self.db.commit()
+      return self.db
+
+  def close(self):
+    with self.lock:
+      if self.db is not None:
+        self.db.close()
+      self.db = None
+
+  def register(self, command, cmdline, params, boardtype, boardid, chip, z,
+               filename, path, fmt):
+    """
+    Adding a new data file entry, returns the run ID of the entry.
+    """
+    with self.lock:
+      db = self.connect()
+      cursor = db.execute(
+          'INSERT INTO runs (command, cmdline, params, boardtype, boardid, '
+          'chip, z, filename, path, format, start, rows, status) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)',
+          (command, cmdline, jsonenc.dumps(params),
+           boardtype, boardid, None if chip is None else str(chip),
+           None if z is None else float(z), filename, path, fmt, time.time(),
+           'running'))
+      db.commit()
+      return cursor.lastrowid
+
+  def finish(self, runid, rows, status):
+    with self.lock:
+      db = self.connect()
+      db.execute('UPDATE runs SET end = ?, rows = ?, status = ? WHERE id = ?',
+                 (time.time(), rows, status, runid))
+      db.commit()
+
+  def query(self,
+            command=None,
+            chip=None,
+            z=None,
+            boardid=None,
+            since=None,
+            until=None,
+            status=None,
+            limit=None):
+    """
+    Selecting catalogue entries, newest first. Every given argument is used as
+    a filter, with the z value matched to the 0.1 precision of the gantry
+    coordinates, and the since and until arguments given as unix time stamps.
+    """
+    conditions, values = [], []
+    for column, value in [('command', command), ('chip', chip),
+                          ('boardid', boardid), ('status', status)]:
+      if value is not None:
+        conditions.append(column + ' = ?')
+        values.append(str(value))
+    if z is not None:
+      conditions.append('abs(z - ?) < 0.05')
+      values.append(float(z))
+    if since is not None:
+      conditions.append('start >= ?')
+      values.append(since)
+    if until is not None:
+      conditions.append('start < ?')
+      values.append(until)
+
+    statement = 'SELECT * FROM runs'
+    if conditions:
+      statement += ' WHERE ' + ' AND '.join(conditions)
+    statement += ' ORDER BY start DESC'
+    if limit:
+      statement += ' LIMIT {0:d}'.format(limit)
+    with self.lock:
+      return [dict(row) for row in self.connect().execute(statement, values)]
+
+  def durations(self, command, limit=20):
+    """
+    List of (duration [s], rows) of the latest successful runs of a command.
+    """
+    with self.lock:
+      return [
+          (row['duration'], row['rows']) for row in self.connect().execute(
+              'SELECT end - start AS duration, rows FROM runs WHERE command = ? '
+              'AND status = ? AND end IS NOT NULL ORDER BY start DESC LIMIT ?',
+              (command, 'done', limit))
+      ]
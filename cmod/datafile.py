@@ -0,0 +1,507 @@
+"""
+Output file writers for the scanning commands. Commands declare their output
+as a list of named and typed columns, and write one row per scan point. The
+text backend reproduces the whitespace separated format of the original output
+files, while the columnar backends (HDF5 and npz) store each column as a typed
+array, with a metadata header describing how the file was produced. Text
+output can be compressed as it is written, with the compression performed in
+a worker thread, and read back transparently with open_text.
+"""
+import numpy as np
+import threading
+import queue
+import json
+import gzip
+import lzma
+import zlib
+import io
+import os
+import re
+
+## h5py is optional, only required for the hdf5 backend.
+try:
+  import h5py
+except ImportError:
+  h5py = None
+
+## zstandard and lz4 are optional, only required for the respective compression
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import lz4.frame
+except ImportError:
+  lz4 = None
+
+
+class TextWriter(object):
+  """
+  Writing rows as whitespace separated text lines using the column formats. The
+  underlying file object can be a local or remote (SFTP) file.
+  """
+
+  columnar = False
+
+  def __init__(self, file, columns):
+    self.file = file
+    self.columns = columns
+    self.rows = 0
+
+  @property
+  def name(self):
+    return self.file.name
+
+  def write_row(self, *values):
+    self.file.write(' '.join(col[2].format(val)
+                             for col, val in zip(self.columns, values)) + '\n')
+    self.rows += 1
+
+  ## Methods for writing free form content to the file, each line is counted
+  ## as a row.
+  def write(self, text):
+    self.file.write(text)
+    self.rows += text.count('\n')
+
+  def tell(self):
+    return self.file.tell()
+
+  @property
+  def closed(self):
+    return self.file.closed
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    if not self.closed:
+      self.file.close()
+
+
+class ColumnWriter(object):
+  """
+  Base class of the columnar writers. Rows are buffered in memory and written
+  to file in chunks of fixed size, as well as on every flush.
+  """
+
+  columnar = True
+  EXTENSION = ''
+  CHUNKSIZE = 256
+
+  def __init__(self, filename, columns, metadata, wipefile):
+    if not columns:
+      raise Exception('Columnar output requires the command to declare its '
+                      'output columns')
+    self.name = os.path.splitext(filename)[0] + self.EXTENSION
+    self.columns = columns
+    self.metadata = metadata
+    self.rows = 0
+    self.buffer = []
+    self.closed = False
+    if wipefile and os.path.isfile(self.name):
+      os.remove(self.name)
+
+  def write_row(self, *values):
+    self.buffer.append(values)
+    self.rows += 1
+    if len(self.buffer) >= self.CHUNKSIZE:
+      self.flush()
+
+  def write(self, text):
+    raise Exception('Columnar output files only accept rows of values')
+
+  def tell(self):
+    return self.rows
+
+  def chunk(self):
+    """
+    Buffered rows as a dictionary of typed column arrays
+    """
+    return {
+        col[0]: np.array([row[idx] for row in self.buffer], dtype=col[1])
+        for idx, col in enumerate(self.columns)
+    }
+
+  def flush(self):
+    if self.buffer:
+      self.write_chunk(self.chunk())
+      self.buffer = []
+
+  def close(self):
+    self.flush()
+    self.closed = True
+
+
+class HDF5Writer(ColumnWriter):
+  """
+  HDF5 output with one resizable, chunked dataset per column. The metadata is
+  stored in the attributes of the file root.
+  """
+
+  EXTENSION = '.h5'
+
+  def __init__(self, filename, columns, metadata, wipefile):
+    if h5py is None:
+      raise Exception('The hdf5 output format requires the h5py package')
+    ColumnWriter.__init__(self, filename, columns, metadata, wipefile)
+    self.file = h5py.File(self.name, 'a')
+    for name, dtype, _ in columns:
+      if not name in self.file:
+        self.file.create_dataset(name, (0, ),
+                                 maxshape=(None, ),
+                                 chunks=(self.CHUNKSIZE, ),
+                                 dtype=dtype)
+    for key, val in metadata.items():
+      self.file.attrs[key] = json.dumps(val)
+
+  def write_chunk(self, chunk):
+    for name, array in chunk.items():
+      dataset = self.file[name]
+      start = dataset.shape[0]
+      dataset.resize((start + len(array), ))
+      dataset[start:] = array
+    self.file.flush()
+
+  def close(self):
+    if self.closed:
+      return
+    ColumnWriter.close(self)
+    self.file.close()
+
+
+class NpzWriter(ColumnWriter):
+  """
+  Numpy npz output. As npz files cannot be appended to, the chunks are kept in
+  memory and the file is written once (atomically, by renaming a temporary
+  file) when the writer is closed. Use the hdf5 backend for long scans whose
+  results should be on disk as they are measured. The metadata is stored as a
+  json string under the "metadata" key.
+  """
+
+  EXTENSION = '.npz'
+
+  def __init__(self, filename, columns, metadata, wipefile):
+    ColumnWriter.__init__(self, filename, columns, metadata, wipefile)
+    self.data = {col[0]: [np.empty(0, dtype=col[1])] for col in columns}
+    if os.path.isfile(self.name):
+      with np.load(self.name) as existing:
+        for name in self.data:
+          if name in existing:
+            self.data[name] = [existing[name]]
+
+  def write_chunk(self, chunk):
+    for name, array in chunk.items():
+      self.data[name].append(array)
+
+  def close(self):
+    if self.closed:
+      return
+    ColumnWriter.close(self)
+    tmpname = self.name + '.tmp.npz'
+    np.savez(tmpname,
+             metadata=json.dumps(self.metadata),
+             **{name: np.concatenate(arrays)
+                for name, arrays in self.data.items()})
+    os.replace(tmpname, self.name)
+
+
+WRITERS = {'text': TextWriter, 'hdf5': HDF5Writer, 'npz': NpzWriter}
+
+
+class SortedWriter(object):
+  """
+  Wrapper of a writer holding the rows back until the file is closed, then
+  writing them sorted by the values of one column. Used for scans that measure
+  their points out of order (adaptive z scans), so that the output is in the
+  same order as a regular scan. Every other attribute is passed to the wrapped
+  writer.
+  """
+
+  def __init__(self, writer, column):
+    self.writer = writer
+    self.column = column
+    self.buffer = []
+
+  def __getattr__(self, name):
+    return getattr(self.writer, name)
+
+  def write_row(self, *values):
+    self.buffer.append(values)
+
+  def close(self):
+    if self.writer.closed:
+      return
+    for values in sorted(self.buffer, key=lambda x: x[self.column]):
+      self.writer.write_row(*values)
+    self.buffer = []
+    self.writer.flush()
+    self.writer.close()
+
+## Waveform lines are hexadecimal strings with 2 characters per sample
+HEXLINE = re.compile(r'^(?:[0-9a-f]{2})+$')
+
+## Marker line at the start of each compressed stream with delta encoded lines
+DELTA_MARKER = '#DELTA'
+
+
+def delta_encode(line):
+  """
+  Replacing each 8-bit sample in a waveform line by the difference to the
+  previous sample (modulo 256). Baseline samples become runs of "00" which are
+  compressed much better than the raw values.
+  """
+  raw = np.frombuffer(bytes.fromhex(line), dtype=np.uint8)
+  delta = raw.copy()
+  delta[1:] = raw[1:] - raw[:-1]
+  return delta.tobytes().hex()
+
+
+def delta_decode(line):
+  delta = np.frombuffer(bytes.fromhex(line), dtype=np.uint8)
+  return np.cumsum(delta, dtype=np.uint8).tobytes().hex()
+
+
+class LZ4Compressor(object):
+  """
+  Adapting the lz4 frame compressor to the compress/flush interface of the
+  standard library compressor objects.
+  """
+  def __init__(self):
+    self.compressor = lz4.frame.LZ4FrameCompressor()
+    self.header = self.compressor.begin()
+
+  def compress(self, data):
+    header, self.header = self.header, b''
+    return header + self.compressor.compress(data)
+
+  def flush(self):
+    return self.header + self.compressor.flush()
+
+
+def zstd_compressor():
+  if zstandard is None:
+    raise Exception('The zstd compression requires the zstandard package')
+  return zstandard.ZstdCompressor(level=3).compressobj()
+
+
+def lz4_compressor():
+  if lz4 is None:
+    raise Exception('The lz4 compression requires the lz4 package')
+  return LZ4Compressor()
+
+
+def zstd_reader(filename):
+  return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'),
+                                                     read_across_frames=True,
+                                                     closefd=True)
+
+
+## Compression methods as (file extension, compressor factory, binary reader).
+## Each flush of the output ends a compressed stream, and following writes start
+## a new one. All readers handle concatenated streams.
+COMPRESSION = {
+    'gzip': ('.gz', lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+             lambda f: gzip.open(f, 'rb')),
+    'lzma': ('.xz', lzma.LZMACompressor, lambda f: lzma.open(f, 'rb')),
+    'zstd': ('.zst', zstd_compressor, zstd_reader),
+    'lz4': ('.lz4', lz4_compressor, lambda f: lz4.frame.open(f, 'rb')),
+}
+
+
+class CompressedFile(object):
+  """
+  Text file-like object compressing its content into a binary file object. The
+  text is passed in blocks to a worker thread, which performs the optional delta
+  encoding of waveform lines and the compression, so that the writing thread
+  only pays for the string concatenation. Flushing waits for the worker to
+  finish the pending blocks, and ends the current compressed stream so that the
+  file is readable up to this point.
+  """
+
+  BLOCKSIZE = 1024 * 1024  # Characters passed to the worker at once
+
+  def __init__(self, file, method, delta=False):
+    COMPRESSION[method][1]()  # Failing early if the package is not available
+    self.file = file
+    self.method = method
+    self.delta = delta
+    self.compressor = None
+    self.buffer = []
+    self.buffersize = 0
+    self.partial = ''  # Incomplete line carried over by the worker
+    self.unflushed = False  # Content written since the last flush
+    self.outbytes = 0  # Compressed bytes written in this session
+    self.base = None
+    self.error = None
+    self.queue = queue.Queue(maxsize=4)
+    self.worker = threading.Thread(target=self.compress_loop, daemon=True)
+    self.worker.start()
+
+  @property
+  def name(self):
+    return self.file.name
+
+  @property
+  def closed(self):
+    return self.worker is None
+
+  def write(self, text):
+    self.check_error()
+    self.buffer.append(text)
+    self.buffersize += len(text)
+    self.unflushed = True
+    if self.buffersize >= CompressedFile.BLOCKSIZE:
+      self.push()
+
+  def tell(self):
+    ## Position in the compressed file in bytes. Content written since the
+    ## last flush is compressed first, so that every write is accounted for.
+    ## The existing content of the file is only fetched once, as fetching the
+    ## size of a remote file requires a network round trip.
+    if self.unflushed:
+      self.flush()
+    if self.base is None:
+      self.base = self.file.tell() - self.outbytes
+    return self.base + self.outbytes
+
+  def push(self, finish=False, final=False):
+    if self.buffer or finish:
+      self.queue.put((''.join(self.buffer), finish, final))
+      self.buffer = []
+      self.buffersize = 0
+
+  def flush(self, final=False):
+    self.push(finish=True, final=final)
+    self.queue.join()
+    self.check_error()
+    self.file.flush()
+    self.unflushed = False
+
+  def close(self):
+    if self.closed:
+      return
+    self.flush(final=True)
+    self.queue.put(None)
+    self.worker.join()
+    self.worker = None
+    self.file.close()
+
+  def check_error(self):
+    if self.error is not None:
+      raise Exception('Compression of output failed: ' + str(self.error))
+
+  def compress_loop(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        if self.error is None:
+          self.compress_block(*item)
+      except Exception as err:
+        self.error = err
+      finally:
+        self.queue.task_done()
+
+  def compress_block(self, text, finish, final):
+    if self.delta:
+      # Only complete lines can be delta encoded, the remainder is kept for the
+      # next block.
+      text = self.partial + text
+      split = len(text) if final else text.rfind('\n') + 1
+      text, self.partial = text[:split], text[split:]
+    if text:
+      if self.compressor is None:
+        self.compressor = COMPRESSION[self.method][1]()
+        if self.delta:
+          text = DELTA_MARKER + '\n' + text
+      if self.delta:
+        text = '\n'.join(
+            delta_encode(line) if HEXLINE.match(line) else line
+            for line in text.split('\n'))
+      self.output(self.compressor.compress(text.encode()))
+    if finish and self.compressor is not None:
+      self.output(self.compressor.flush())
+      self.compressor = None
+
+  def output(self, data):
+    self.file.write(data)
+    self.outbytes += len(data)
+
+
+def compression_method(filename):
+  for method, (extension, _, _) in COMPRESSION.items():
+    if filename.endswith(extension):
+      return method
+  return None
+
+
+class TextReader(object):
+  """
+  Iterating over the lines of a text output file, decompressing and reverting
+  the delta encoding of the waveform lines if needed.
+  """
+  def __init__(self, filename):
+    method = compression_method(filename)
+    if method is None:
+      self.file = open(filename, 'r')
+    else:
+      self.file = io.TextIOWrapper(COMPRESSION[method][2](filename))
+    self.delta = False
+
+  def __iter__(self):
+    for line in self.file:
+      if line.rstrip('\n') == DELTA_MARKER:
+        self.delta = True
+        continue
+      if self.delta and HEXLINE.match(line.rstrip('\n')):
+        line = delta_decode(line.rstrip('\n')) + '\n'
+      yield line
+
+  def read(self):
+    return ''.join(self)
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def open_text(filename):
+  """
+  Opening a text output file for reading, compressed or not.
+  """
+  return TextReader(filename)
+
+
+def load(filename, columns=None):
+  """
+  Loading an output file as a dictionary of column arrays, together with the
+  metadata dictionary. The column declaration is required for text files,
+  which do not store column names, and text files have no metadata.
+  """
+  if filename.endswith(HDF5Writer.EXTENSION):
+    if h5py is None:
+      raise Exception('Reading hdf5 files requires the h5py package')
+    with h5py.File(filename, 'r') as f:
+      data = {name: f[name][()] for name in f}
+      metadata = {key: json.loads(val) for key, val in f.attrs.items()}
+    return data, metadata
+  elif filename.endswith(NpzWriter.EXTENSION):
+    with np.load(filename) as f:
+      data = {name: f[name] for name in f.files if name != 'metadata'}
+      metadata = json.loads(str(f['metadata'])) if 'metadata' in f else {}
+    return data, metadata
+  else:
+    if not columns:
+      raise Exception('Column declaration is required for text files')
+    with open_text(filename) as f:
+      array = np.loadtxt(f,
+                         ndmin=1,
+                         dtype=[(col[0], col[1]) for col in columns])
+    return {col[0]: array[col[0]] for col in columns}, {}
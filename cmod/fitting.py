@@ -0,0 +1,372 @@
+"""
+Fitting routines for the calibration procedures. The luminosity alignment
+model is fitted with the analytic Jacobian, which is both faster and more
+stable than the numerical derivatives used by a plain curve_fit call.
+"""
+import numpy as np
+
+
+def halign_model(xydata, N, x0, y0, z, p):
+  """
+  Light yield of a point source at (x0, y0) at a distance z from the detector
+  plane, with N the overall normalization and p the pedestal.
+  """
+  x, y = xydata
+  D = (x - x0)**2 + (y - y0)**2 + z**2
+  return (N * z / D**1.5) + p
+
+
+def halign_jacobian(xydata, N, x0, y0, z, p):
+  """
+  Analytic Jacobian of the halign_model with respect to (N, x0, y0, z, p),
+  returned as an array of shape (npoints, 5).
+  """
+  x, y = xydata
+  D = (x - x0)**2 + (y - y0)**2 + z**2
+  D15 = D**1.5
+  D25 = D**2.5
+  return np.column_stack([
+      z / D15,
+      3 * N * z * (x - x0) / D25,
+      3 * N * z * (y - y0) / D25,
+      N / D15 - 3 * N * z**2 / D25,
+      np.ones_like(D)
+  ])
+
+
+def halign_guess(x, y, lumi, z):
+  """
+  Initial guess of the halign_model parameters from the data alone, using the
+  brightest point as the source position.
+  """
+  x = np.asarray(x)
+  y = np.asarray(y)
+  lumi = np.asarray(lumi)
+  idx = np.argmax(lumi)
+  return (
+      (lumi[idx] - np.min(lumi)) * z**2,
+      x[idx],
+      y[idx],
+      z,
+      np.min(lumi),
+  )
+
+
+def fit_halign(x, y, lumi, unc, p0):
+  """
+  Weighted least squares fit of the halign_model. Returns the best fit
+  parameters and the covariance matrix with the same conventions as
+  scipy.optimize.curve_fit (covariance scaled by the reduced chi-square).
+  Raises an exception if the fit does not converge.
+  """
+  xydata = np.vstack((np.asarray(x, dtype=float), np.asarray(y, dtype=float)))
+  lumi = np.asarray(lumi, dtype=float)
+  unc = np.asarray(unc, dtype=float)
+
+  # Zero uncertainties (ex. saturated readout) would give infinite weights.
+  positive = unc[unc > 0]
+  unc = np.where(unc > 0, unc, np.min(positive) if len(positive) else 1.0)
+
+  def residual(par):
+    return (halign_model(xydata, *par) - lumi) / unc
+
+  def jacobian(par):
+    return halign_jacobian(xydata, *par) / unc[:, np.newaxis]
+
+  from scipy.optimize import least_squares
+  result = least_squares(residual,
+                         np.asarray(p0, dtype=float),
+                         jac=jacobian,
+                         method='lm',
+                         x_scale='jac')
+  if not result.success:
+    raise Exception('Fit failed to converge: ' + result.message)
+
+  return result.x, fit_covariance(result.jac, result.fun)
+
+
+def halign3d_model(xyzdata, zindex, zref, par):
+  """
+  Light yield for a scan over several gantry heights. The source position
+  drifts linearly with the gantry height to account for a tilt of the z axis,
+  and each height has its own pedestal. The parameters are given as
+  (N, x0, y0, z0, tx, ty, p_0, p_1, ...), with (x0, y0) the source position at
+  the reference height zref, z0 the offset between the gantry height and the
+  source distance, and p_k the pedestal of the k-th height listed in zindex.
+  """
+  x, y, z = xyzdata
+  N, x0, y0, z0, tx, ty = par[:6]
+  pedestal = np.asarray(par[6:])
+  h = z + z0
+  D = (x - x0 - tx * (z - zref))**2 + (y - y0 - ty * (z - zref))**2 + h**2
+  return (N * h / D**1.5) + pedestal[zindex]
+
+
+def halign3d_jacobian(xyzdata, zindex, zref, par):
+  """
+  Analytic Jacobian of the halign3d_model with respect to all parameters,
+  returned as an array of shape (npoints, 6 + number of heights).
+  """
+  x, y, z = xyzdata
+  N, x0, y0, z0, tx, ty = par[:6]
+  h = z + z0
+  u = x - x0 - tx * (z - zref)
+  v = y - y0 - ty * (z - zref)
+  D = u**2 + v**2 + h**2
+  D15 = D**1.5
+  D25 = D**2.5
+  dx0 = 3 * N * h * u / D25
+  dy0 = 3 * N * h * v / D25
+  pedestal = np.zeros((len(x), len(par) - 6))
+  pedestal[np.arange(len(x)), zindex] = 1
+  return np.column_stack([
+      h / D15, dx0, dy0, N / D15 - 3 * N * h**2 / D25, dx0 * (z - zref),
+      dy0 * (z - zref), pedestal
+  ])
+
+
+def fit_halign3d(x, y, z, lumi, unc, p0, zref):
+  """
+  Joint weighted least squares fit of the halign3d_model over all heights.
+  Returns the best fit parameters and covariance matrix in the same convention
+  as fit_halign, together with the list of heights matching the pedestal
+  parameters. The initial guess p0 should contain one pedestal per unique
+  height. Raises an exception if the fit does not converge.
+  """
+  xyzdata = np.vstack((np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                       np.asarray(z, dtype=float)))
+  lumi = np.asarray(lumi, dtype=float)
+  unc = np.asarray(unc, dtype=float)
+  zvals, zindex = np.unique(xyzdata[2], return_inverse=True)
+  if len(p0) != 6 + len(zvals):
+    raise Exception('Initial guess requires one pedestal per scan height')
+
+  positive = unc[unc > 0]
+  unc = np.where(unc > 0, unc, np.min(positive) if len(positive) else 1.0)
+
+  def residual(par):
+    return (halign3d_model(xyzdata, zindex, zref, par) - lumi) / unc
+
+  def jacobian(par):
+    return halign3d_jacobian(xyzdata, zindex, zref, par) / unc[:, np.newaxis]
+
+  from scipy.optimize import least_squares
+  result = least_squares(residual,
+                         np.asarray(p0, dtype=float),
+                         jac=jacobian,
+                         method='lm',
+                         x_scale='jac')
+  if not result.success:
+    raise Exception('Fit failed to converge: ' + result.message)
+
+  return result.x, fit_covariance(result.jac, result.fun), zvals
+
+
+def halign3d_center(par, covar, z, zref):
+  """
+  Source x-y position and uncertainties at gantry height z from the
+  halign3d_model fit results, returned in the [x, unc_x, y, unc_y] format used
+  by the lumi alignment calibration.
+  """
+  dz = z - zref
+  x = par[1] + par[4] * dz
+  y = par[2] + par[5] * dz
+  uncx = np.sqrt(covar[1][1] + 2 * dz * covar[1][4] + dz**2 * covar[4][4])
+  uncy = np.sqrt(covar[2][2] + 2 * dz * covar[2][5] + dz**2 * covar[5][5])
+  return [x, uncx, y, uncy]
+
+
+def fit_visM(x, y, recox, recoy, method='ransac', threshold=None,
+             iterations=100):
+  """
+  Estimating the linear transformation between the gantry coordinates (x, y)
+  and the reconstructed chip position in the camera (recox, recoy), with
+  reco = visM . (x, y) + offset. Both camera axes are solved at once with the
+  design matrix [x, y, 1]. Points where the chip was not found (negative
+  reconstructed coordinates) are always discarded. Available methods:
+
+  - lsq: plain least squares over all points.
+  - huber: iteratively reweighted least squares with Huber weights.
+  - ransac: random sample consensus over minimal sets of 3 points to identify
+    the inliers, followed by the Huber fit over the inliers.
+
+  The threshold is the residual distance in pixels for a point to be counted as
+  an inlier in RANSAC; if not specified, it is estimated from the median
+  absolute deviation of the Huber fit residuals. Returns a dictionary with the
+  transformation matrix "visM" ([[ax, bx], [ay, by]]), the "offset", the
+  uncertainty of the matrix elements "unc", the "inliers" mask over the input
+  points, the root-mean-square residual of the inliers "residual" (pixels) and
+  the condition number of the (centered) gantry coordinate matrix "cond".
+  """
+  x, y, recox, recoy = [np.asarray(v, dtype=float) for v in (x, y, recox, recoy)]
+  valid = (recox > 0) & (recoy > 0) & np.isfinite(recox) & np.isfinite(recoy)
+  if np.sum(valid) < 4:
+    raise Exception('Not enough points with a found chip to fit visM')
+
+  # Gantry coordinates are centered for a well conditioned design matrix.
+  xm, ym = np.mean(x[valid]), np.mean(y[valid])
+  A = np.column_stack((x - xm, y - ym, np.ones_like(x)))
+  B = np.column_stack((recox, recoy))
+
+  if method == 'lsq':
+    inliers = valid
+    coeff, weight = _weighted_lstsq(A[inliers], B[inliers]), None
+  elif method == 'huber':
+    inliers = valid
+    coeff, weight = _huber_lstsq(A[inliers], B[inliers])
+  elif method == 'ransac':
+    inliers = _ransac_inliers(A, B, valid, threshold, iterations)
+    coeff, weight = _huber_lstsq(A[inliers], B[inliers])
+  else:
+    raise Exception('Unknown visM fitting method: ' + method)
+
+  Ai, Bi = A[inliers], B[inliers]
+  residual = np.linalg.norm(Bi - np.dot(Ai, coeff), axis=1)
+  w = np.ones(len(Ai)) if weight is None else weight
+  Aw = Ai * np.sqrt(w)[:, np.newaxis]
+  dof = max(len(Ai) - 3, 1)
+  sigma2 = np.sum(w[:, np.newaxis] * (Bi - np.dot(Ai, coeff))**2, axis=0) / dof
+  normal_inv = np.linalg.pinv(np.dot(Aw.T, Aw))
+
+  visM = [[coeff[0][0], coeff[1][0]], [coeff[0][1], coeff[1][1]]]
+  return {
+      'visM': visM,
+      'offset': [coeff[2][0] - visM[0][0] * xm - visM[0][1] * ym,
+                 coeff[2][1] - visM[1][0] * xm - visM[1][1] * ym],
+      'unc': [[np.sqrt(sigma2[0] * normal_inv[0][0]),
+               np.sqrt(sigma2[0] * normal_inv[1][1])],
+              [np.sqrt(sigma2[1] * normal_inv[0][0]),
+               np.sqrt(sigma2[1] * normal_inv[1][1])]],
+      'inliers': inliers,
+      'residual': np.sqrt(np.mean(residual**2)),
+      'cond': np.linalg.cond(Ai[:, :2]),
+  }
+
+
+def _weighted_lstsq(A, B, weight=None):
+  if weight is not None:
+    sw = np.sqrt(weight)[:, np.newaxis]
+    A, B = A * sw, B * sw
+  return np.linalg.lstsq(A, B, rcond=None)[0]
+
+
+def _huber_lstsq(A, B, k=1.345, maxiter=20):
+  """
+  Huber weighted least squares by iterative reweighting, using the distance of
+  the 2D residual and a robust scale from the median absolute residual.
+  Returns the coefficients and the final weights.
+  """
+  weight = np.ones(len(A))
+  coeff = _weighted_lstsq(A, B)
+  for _ in range(maxiter):
+    residual = np.linalg.norm(B - np.dot(A, coeff), axis=1)
+    scale = 1.4826 * np.median(residual)
+    if scale <= 0:
+      break
+    cut = k * scale
+    new_weight = np.where(residual <= cut, 1.0, cut / np.maximum(residual, cut))
+    new_coeff = _weighted_lstsq(A, B, new_weight)
+    converged = np.allclose(new_coeff, coeff, rtol=1e-8, atol=1e-10)
+    coeff, weight = new_coeff, new_weight
+    if converged:
+      break
+  return coeff, weight
+
+
+def _ransac_inliers(A, B, valid, threshold, iterations):
+  """
+  Inlier mask of the largest consensus set of the affine model fitted to
+  random minimal sets of 3 points among the valid points.
+  """
+  index = np.where(valid)[0]
+  if threshold is None:
+    coeff, _ = _huber_lstsq(A[index], B[index])
+    residual = np.linalg.norm(B[index] - np.dot(A[index], coeff), axis=1)
+    threshold = max(3 * 1.4826 * np.median(residual), 1.0)
+
+  # Fixed seed so that the calibration is reproducible for the same data.
+  rng = np.random.RandomState(0)
+  best = valid
+  best_count = 0
+  for _ in range(iterations):
+    sample = rng.choice(index, 3, replace=False)
+    if abs(np.linalg.det(A[sample])) < 1e-9:
+      continue
+    coeff = np.linalg.solve(A[sample], B[sample])
+    residual = np.linalg.norm(B - np.dot(A, coeff), axis=1)
+    inliers = valid & (residual < threshold)
+    if np.sum(inliers) > best_count:
+      best, best_count = inliers, np.sum(inliers)
+  return best if best_count >= 4 else valid
+
+
+def fit_covariance(jac, residual):
+  """
+  Covariance matrix of the fit parameters from the Jacobian of the weighted
+  residuals at the minimum, following the scipy.optimize.curve_fit method.
+  """
+  npar = jac.shape[1]
+  _, s, VT = np.linalg.svd(jac, full_matrices=False)
+  threshold = np.finfo(float).eps * max(jac.shape) * s[0]
+  s = s[s > threshold]
+  VT = VT[:s.size]
+  covar = np.dot(VT.T / s**2, VT)
+
+  dof = len(residual) - npar
+  if dof > 0 and s.size == npar:
+    covar = covar * np.sum(residual**2) / dof
+  else:
+    covar.fill(np.inf)
+  return covar
+
+
+## Benchmarking against the plain curve_fit call over stored halign files
+if __name__ == '__main__':
+  import argparse
+  import time
+  from scipy.optimize import curve_fit
+
+  parser = argparse.ArgumentParser(
+      description=('Comparing the time-to-converge and failure rate of the '
+                   'analytic fit and the numerical curve_fit for halign '
+                   'output files'))
+  parser.add_argument('files', nargs='+', help='halign output files')
+  args = parser.parse_args()
+
+  results = {'curve_fit': [], 'analytic': []}
+  failures = {'curve_fit': 0, 'analytic': 0}
+
+  for filename in args.files:
+    data = np.loadtxt(filename, ndmin=2)
+    x, y, z, lumi, unc = data[:, :5].T
+    lumi = np.abs(lumi)
+
+    ## Both fits start from the same point, so that only the effect of the
+    ## analytic Jacobian is compared
+    p0 = halign_guess(x, y, lumi, z[0])
+
+    start = time.time()
+    try:
+      curve_fit(halign_model,
+                np.vstack((x, y)),
+                lumi,
+                p0=p0,
+                sigma=unc,
+                maxfev=10000)
+      results['curve_fit'].append(time.time() - start)
+    except Exception:
+      failures['curve_fit'] += 1
+
+    start = time.time()
+    try:
+      fit_halign(x, y, lumi, unc, p0)
+      results['analytic'].append(time.time() - start)
+    except Exception:
+      failures['analytic'] += 1
+
+  for method in results:
+    times = results[method]
+    print('{0:10s} | converged {1:4d}/{2:4d} | mean time {3:8.4f}s | '
+          'max time {4:8.4f}s'.format(method, len(times), len(args.files),
+                                      np.mean(times) if times else np.nan,
+                                      np.max(times) if times else np.nan))
@@ -0,0 +1,95 @@
+import cmod.logger as logger
+import cmod.jsonenc as jsonenc
+import json
+import time
+
+
+class Journal(object):
+  """
+  Append-only JSON-lines journal of the calibration state of a session. Every
+  change to the calibration results stored in the Board and every session
+  setting is written as a single line as it happens, so that the session can be
+  restored by replaying the journal if the program terminates before the
+  calibration results are saved. Each line is flushed to the operating system
+  immediately, which is cheap enough to be done within scanning loops.
+  """
+
+  def __init__(self):
+    self.file = None
+
+  def open(self, filename):
+    """
+    Opening the journal file for appending. Existing content is kept, with a
+    truncated final line terminated so that new entries start on a new line.
+    """
+    self.close()
+    self.file = open(filename, 'a+')
+    if self.file.tell() > 0:
+      self.file.seek(self.file.tell() - 1)
+      if self.file.read(1) != '\n':
+        self.file.write('\n')
+
+  def close(self):
+    if self.file:
+      self.file.close()
+    self.file = None
+
+  @property
+  def name(self):
+    return self.file.name if self.file else None
+
+  def record(self, entry, **data):
+    """
+    Writing a single journal entry, does nothing if no journal file is opened.
+    """
+    if not self.file:
+      return
+    data['entry'] = entry
+    data['time'] = time.time()
+    self.file.write(jsonenc.dumps(data) + '\n')
+    self.file.flush()
+
+  @staticmethod
+  def read(filename):
+    """
+    Reading the entries of an existing journal file. A truncated final line
+    (from a crash during writing) is ignored.
+    """
+    entries = []
+    with open(filename, 'r') as f:
+      for line in f:
+        try:
+          entries.append(json.loads(line))
+        except ValueError:
+          logger.printwarn('Skipping corrupted journal line: ' + line.strip())
+    return entries
+
+  @staticmethod
+  def replay(filename, board, settings=None):
+    """
+    Restoring the board calibration state from the journal file. Session
+    setting entries are passed to the settings function if given. Returns the
+    number of entries replayed.
+    """
+    entries = Journal.read(filename)
+    journal, board.journal = board.journal, None  # Not re-recording entries
+    try:
+      for data in entries:
+        entry = data['entry']
+        if entry == 'boardtype':
+          board.set_boardtype_json(data['content'])
+        elif entry == 'calibfile':
+          board.load_calib_json(data['content'])
+        elif entry == 'calibchip':
+          board.add_calib_chip(data['chip'])
+        elif entry == 'vis_coord':
+          board.add_vis_coord(data['chip'], data['z'], data['data'])
+        elif entry == 'visM':
+          board.add_visM(data['chip'], data['z'], data['data'])
+        elif entry == 'lumi_coord':
+          board.add_lumi_coord(data['chip'], data['z'], data['data'])
+        elif entry == 'setting' and settings:
+          settings(data['name'], data['value'])
+    finally:
+      board.journal = journal
+    return len(entries)
@@ -0,0 +1,15 @@
+import json
+
+
+def encode(obj):
+  """
+  Encoding the values not handled by the json module: numpy arrays and scalars
+  as lists and numbers, other objects (ex. open files) by name or as strings.
+  """
+  if hasattr(obj, 'tolist'):
+    return obj.tolist()
+  return getattr(obj, 'name', str(obj))
+
+
+def dumps(data):
+  return json.dumps(data, default=encode)
@@ -0,0 +1,37 @@
+import cmod.proxy as proxy
+import importlib
+import threading
+
+
+class LazyDevice(proxy.DeviceProxy):
+  """
+  Handle of a hardware interface object that is only constructed on first use.
+  The extension modules of the camera and picoscope interfaces link against the
+  OpenCV and picoscope libraries, the loading of which takes up a large part of
+  the program start up, while many sessions never use the device. Attribute
+  access is passed to the interface object, which is created (and its module
+  imported) on the first access.
+  """
+
+  def __init__(self, module, classname):
+    self._module = module
+    self._classname = classname
+    self._instance = None
+    self._lock = threading.Lock()
+
+  def instance(self):
+    """
+    The interface object. The lock ensures that the object is constructed only
+    once when first accessed from several initialization threads.
+    """
+    with self._lock:
+      if self._instance is None:
+        module = importlib.import_module(self._module)
+        self._instance = getattr(module, self._classname)()
+      return self._instance
+
+  target = instance
+
+  @property
+  def loaded(self):
+    return self._instance is not None
@@ -0,0 +1,199 @@
+import cmod.proxy as proxy
+import collections
+import threading
+import math
+import time
+
+
+class PhaseStats(object):
+  """
+  Accumulated wall time of a single phase (motion, acquisition... etc) within a
+  command run. The latency of each call is also histogrammed in power-of-two
+  bins, indexed by the binary exponent of the call time in seconds, so that the
+  bin of exponent e holds calls taking between 2^(e-1) and 2^e seconds.
+  """
+
+  def __init__(self):
+    self.calls = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.hist = collections.Counter()
+
+  def add(self, elapsed):
+    self.calls += 1
+    self.total += elapsed
+    self.max = max(self.max, elapsed)
+    self.hist[math.frexp(elapsed)[1]] += 1
+
+  def merge(self, other):
+    self.calls += other.calls
+    self.total += other.total
+    self.max = max(self.max, other.max)
+    self.hist.update(other.hist)
+
+  @property
+  def mean(self):
+    return self.total / self.calls if self.calls else 0.0
+
+  def quantile(self, q):
+    """
+    Upper edge of the histogram bin containing the q-quantile of the latency.
+    """
+    target, count = q * self.calls, 0
+    for exponent in sorted(self.hist):
+      count += self.hist[exponent]
+      if count >= target:
+        return min(2.0**exponent, self.max)
+    return self.max
+
+  def to_json(self):
+    return {
+        'calls': self.calls,
+        'total': self.total,
+        'mean': self.mean,
+        'max': self.max,
+        'histogram': {
+            '{0:.3g}'.format(2.0**exponent): count
+            for exponent, count in sorted(self.hist.items())
+        }
+    }
+
+
+class RunProfile(object):
+  """
+  Per-phase timing of a single command invocation.
+  """
+
+  def __init__(self, command, cmdline):
+    self.command = command
+    self.cmdline = cmdline
+    self.start = time.time()
+    self.wall = 0.0
+    self.status = 'running'
+    self.phases = collections.defaultdict(PhaseStats)
+    self._t0 = time.perf_counter()
+
+  def finish(self, status):
+    self.wall = time.perf_counter() - self._t0
+    self.status = status
+
+  def other(self):
+    """
+    Wall time not spent in any of the instrumented phases, the python overhead
+    of the command. Phases running in parallel threads (image processing during
+    the gantry motion) overlap, so this is clamped at zero.
+    """
+    return max(self.wall - sum(x.total for x in self.phases.values()), 0.0)
+
+  def to_json(self):
+    return {
+        'command': self.command,
+        'cmdline': self.cmdline,
+        'start': self.start,
+        'wall': self.wall,
+        'status': self.status,
+        'other': self.other(),
+        'phases': {name: x.to_json()
+                   for name, x in self.phases.items()}
+    }
+
+
+class Profiler(object):
+  """
+  Lightweight timing layer for the session commands. Device objects are wrapped
+  with the wrap method, which maps the method names of the device to a phase.
+  While a command is being profiled, each call to a mapped method is timed and
+  accumulated to the phase of the current run. Calls made within a timed call
+  (the picoscope polling within a readout) are attributed to the outer phase
+  only. When profiling is disabled, the wrapped device methods are returned
+  unmodified. The current run is kept per thread, as the commands of the server
+  mode run concurrently in separate threads.
+  """
+
+  def __init__(self):
+    self.enabled = False
+    self.history = collections.deque(maxlen=100)
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  @property
+  def current(self):
+    return getattr(self.local, 'current', None)
+
+  def begin(self, command, cmdline):
+    if self.enabled:
+      self.local.current = RunProfile(command, cmdline)
+
+  def end(self, status):
+    """
+    Finishing the profile of the current run, returns the run profile, or None
+    if the run was not profiled.
+    """
+    run, self.local.current = self.current, None
+    if run is not None:
+      run.finish(status)
+      self.history.append(run)
+    return run
+
+  def bind(self, func):
+    """
+    Function running with the current run of the calling thread, for the work
+    that commands hand to worker threads.
+    """
+    run = self.current
+
+    def call(*args, **kwargs):
+      self.local.current = run
+      try:
+        return func(*args, **kwargs)
+      finally:
+        self.local.current = None
+
+    return call
+
+  def runs(self, command=None):
+    return [x for x in self.history if command is None or x.command == command]
+
+  def wrap(self, obj, phases):
+    return ProfiledObject(obj, self, phases)
+
+  def timed(self, phase, func):
+    run = self.current  # The call may be made from a worker thread
+
+    def call(*args, **kwargs):
+      if run is None or getattr(self.local, 'active', False):
+        return func(*args, **kwargs)
+      self.local.active = True
+      start = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        elapsed = time.perf_counter() - start
+        self.local.active = False
+        with self.lock:
+          run.phases[phase].add(elapsed)
+
+    return call
+
+
+class ProfiledObject(proxy.DeviceProxy):
+  """
+  Proxy of a device object, with the methods listed in the phase map timed by
+  the profiler. Every other attribute is passed to the device as is.
+  """
+
+  def __init__(self, obj, profiler, phases):
+    self._obj = obj
+    self._profiler = profiler
+    self._phases = phases
+
+  def target(self):
+    return self._obj
+
+  def wrap(self, name, method):
+    phase = self._phases.get(name)
+    if phase is None:
+      return None
+    if self._profiler.current is None:
+      return method
+    return self._profiler.timed(phase, method)
@@ -0,0 +1,28 @@
+class DeviceProxy(object):
+  """
+  Base class of the proxies standing in for a device object (lazy construction,
+  telemetry counters, profiler timing). Attribute access is passed to the
+  object returned by target, with the methods passed through wrap. Methods that
+  are not wrapped are stored in the proxy, so that later calls skip the
+  lookup, while wrapped methods are wrapped on every access, as the wrapping
+  can depend on the session state.
+  """
+
+  def target(self):
+    raise NotImplementedError
+
+  def wrap(self, name, method):
+    """
+    Callable replacing the method, or None to pass the method as is.
+    """
+    return None
+
+  def __getattr__(self, name):
+    attr = getattr(self.target(), name)
+    if not callable(attr):
+      return attr
+    wrapped = self.wrap(name, attr)
+    if wrapped is None:
+      self.__dict__[name] = attr
+      return attr
+    return wrapped
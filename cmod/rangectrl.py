@@ -0,0 +1,141 @@
+import cmod.logger as log
+import json
+import os
+
+
+class RangeController(object):
+  """
+  Voltage range selection for the picoscope. Instead of stepping through the
+  voltage ranges one at a time with a full acquisition at each step, a short
+  probe block is used to measure the waveform maximum, and the range is set
+  directly to the smallest one that keeps the signal below a headroom fraction
+  of the full scale. The starting range is taken from the cache of previous
+  selections of the same (chip, z) position if it exists, otherwise it is
+  predicted from the previous measurement with the light model.
+  """
+
+  PROBE_CAPTURES = 50  # Number of captures in the probe block
+  HEADROOM = 0.8  # Target maximum fraction of the full scale
+  MAXITER = 5  # Maximum number of probe blocks per selection
+
+  def __init__(self, parent):
+    self.parent = parent
+    self.pico = parent.pico
+    self.cache = {}
+    self.cachefile = None
+    ## (z, peak [mV]) of the last selection, used for predicting the range of
+    ## the next z position.
+    self.last = None
+
+  def set_cachefile(self, file):
+    """
+    Setting the json file used to store the selected ranges across sessions.
+    Existing entries in the file are loaded into the cache.
+    """
+    self.cachefile = file
+    if os.path.isfile(file):
+      with open(file, 'r') as f:
+        self.cache.update(json.load(f))
+
+  def reset(self):
+    """
+    Forgetting the previous measurement, should be called at the start of each
+    scan.
+    """
+    self.last = None
+
+  def select(self, channel, chipid=None, z=None, captures=None, x=None,
+             y=None):
+    """
+    Setting the voltage range for the given channel, returning the waveform
+    maximum of the last probe block in mV. If both the chip id and z are given,
+    the selection is stored in the cache.
+    """
+    key = RangeController.cache_key(channel, chipid, z, x, y)
+    start = self.cache.get(key) if key else None
+    if start is None and z is not None:
+      start = self.predict(z)
+    if start is not None and start != self.pico.range:
+      self.pico.setrange(start)
+
+    for _ in range(RangeController.MAXITER):
+      peak = self.probe(channel, captures)
+      current = self.pico.range
+      best = self.best_range(peak)
+
+      # A saturated waveform only gives a lower bound on the signal size, so
+      # the range is increased by at least a factor of ~5.
+      if peak >= 0.99 * self.pico.rangevalue(current):
+        best = min(max(best, current + 2), self.pico.rangemax())
+      if best == current:
+        break
+      self.pico.setrange(best)
+    else:
+      log.printwarn(('Voltage range selection did not settle after {0:d} '
+                     'probes').format(RangeController.MAXITER))
+
+    if z is not None:
+      self.last = (z, peak)
+    if key:
+      self.cache[key] = self.pico.range
+      self.save()
+    return peak
+
+  @staticmethod
+  def cache_key(channel, chipid, z, x=None, y=None):
+    """
+    Cache key of a (chip, z) position. Positions given in raw coordinates all
+    use a negative placeholder chip id, so the x-y position is used instead,
+    and the selection is not cached if it is not known.
+    """
+    if chipid is None or z is None:
+      return None
+    if int(chipid) < 0:
+      if x is None or y is None:
+        return None
+      chipid = '{0:.1f},{1:.1f}'.format(x, y)
+    return '{0}:{1}:{2:.1f}'.format(channel, chipid, z)
+
+  def probe(self, channel, captures=None):
+    """
+    Running a short rapid block and returning the waveform maximum in mV
+    """
+    captures = captures or RangeController.PROBE_CAPTURES
+    self.pico.setblocknums(captures, self.pico.postsamples,
+                           self.pico.presamples)
+    self.pico.startrapidblocks()
+    while not self.pico.isready():
+      self.parent.trigger.pulse(self.pico.ncaptures, 500)
+    self.pico.flushbuffer()
+    # waveformmax returns the ADC value divided by 256
+    return self.pico.adc2mv(self.pico.waveformmax(channel) * 256)
+
+  def best_range(self, peak):
+    """
+    Smallest voltage range index where the given peak value [mV] is within the
+    headroom of the full scale.
+    """
+    for index in range(self.pico.rangemin(), self.pico.rangemax() + 1):
+      if peak <= RangeController.HEADROOM * self.pico.rangevalue(index):
+        return index
+    return self.pico.rangemax()
+
+  def predict(self, z):
+    """
+    Predicting the voltage range at height z from the previous measurement,
+    assuming the peak signal of a point source scales as 1/z^2 directly above
+    the source.
+    """
+    if self.last is None or self.last[0] <= 0 or z <= 0:
+      return None
+    zprev, peak = self.last
+    return self.best_range(peak * (zprev / z)**2)
+
+  def save(self):
+    if not self.cachefile:
+      return
+    try:
+      with open(self.cachefile, 'w') as f:
+        json.dump(self.cache, f, indent=2, sort_keys=True)
+    except Exception as err:
+      log.printwarn('Failed to save voltage range cache: ' + str(err))
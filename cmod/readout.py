@@ -2,17 +2,6 @@ import cmod.logger as log
 import numpy as np
 import time
 
-## Try to import the ADC models, do nothing if module isn't found
-# Exceptions will be raised by other function calls.
-try:
-  import board
-  import busio
-  import adafruit_ads1x15.ads1115 as ads
-  import adafruit_ads1x15.ads1x15 as adsset
-  from adafruit_ads1x15.analog_in import AnalogIn
-except:
-  pass
-
 
 class readout(object):
   """
@@ -61,7 +50,12 @@ class readout(object):
       return self.read_adc(channel, samples)
 
   def setup_i2c(self):
-    ## Setting up dummy variables first
+    ## The ADC modules are only imported when the ADC readout is requested, an
+    ## exception is raised here if the modules are not found.
+    import board
+    import busio
+    import adafruit_ads1x15.ads1115 as ads
+    import adafruit_ads1x15.ads1x15 as adsset
     self.i2c = busio.I2C(board.SCL, board.SDA)
     self.adc = ads.ADS1115(self.i2c, data_rate=860, mode=adsset.Mode.CONTINUOUS)
 
@@ -85,6 +79,8 @@ class readout(object):
     Reading a single ADC value from ADC chip
     """
     if self.mode == readout.MODE_ADC:
+      import adafruit_ads1x15.ads1115 as ads
+      from adafruit_ads1x15.analog_in import AnalogIn
       return AnalogIn(self.adc, ads.P0).voltage * 1000
     else:
       return self.modelval()
@@ -2,10 +2,15 @@
 ## Solution take from
 ## https://stackoverflow.com/questions/18499497/how-to-process-sigterm-signal-gracefully
 import signal
+import threading
 
 class SigHandle:
   def __init__(self):
     self.terminate = False
+    ## Signals can only be handled in the main thread. Commands running in the
+    ## server threads are terminated by setting terminate directly.
+    if threading.current_thread() is not threading.main_thread():
+      return
     ## SIG_INT is Ctl+C
     signal.signal(signal.SIGINT, self.receive_term)
     signal.signal(signal.SIGTERM, self.receive_term)
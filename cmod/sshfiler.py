@@ -1,36 +1,161 @@
-import paramiko
 import getpass
 import shutil
+import threading
+import hashlib
+import queue
+import json
+import time
+import os
+import collections
 import cmod.logger as log
 #import logger as log
 
 
-class SSHFiler(paramiko.SSHClient):
+class SpoolFile(object):
   """
-  Object for handling ssh file requests with host server
+  File handle for a remote output file. All writes go to a local file in the
+  spool directory, and the background uploader of the SSHFiler streams the
+  content to the remote host, so that writing never waits on the network.
+  """
+  def __init__(self, filer, filename, localname, binary=False):
+    self.filer = filer
+    self.name = filename
+    self.localname = localname
+    self.file = open(localname, 'wb' if binary else 'w')
+
+  def write(self, data):
+    self.file.write(data)
+
+  def flush(self):
+    self.file.flush()
+    self.filer.notify_upload()
+
+  def tell(self):
+    ## Includes the existing content of the remote file when appending
+    return self.filer.upload_base(self.localname) + self.file.tell()
+
+  @property
+  def closed(self):
+    return self.file.closed
+
+  def close(self):
+    if self.closed:
+      return
+    self.file.close()
+    self.filer.finish_upload(self.localname)
+
+
+class Transfer(object):
+  """
+  Progress record of a single background upload, used for status reporting.
+  """
+  def __init__(self, localname, remotename):
+    self.local = localname
+    self.remote = remotename
+    self.size = 0
+    self.done = 0
+    self.channels = 1
+    self.state = 'queued'
+    self.error = ''
+    self.start = None
+    self.end = None
+    self.lock = threading.Lock()
+
+  def begin(self, size, channels, state):
+    with self.lock:
+      if self.start is None:
+        self.start = time.time()
+      self.end = None
+      self.size = size
+      self.channels = channels
+      self.state = state
+
+  def add(self, nbytes):
+    with self.lock:
+      self.done += nbytes
+
+  def finish(self, state, error=''):
+    self.state = state
+    self.error = error
+    self.end = time.time()
+
+  def rate(self):
+    """
+    Average throughput in bytes per second
+    """
+    if self.start is None:
+      return 0
+    elapsed = (self.end or time.time()) - self.start
+    return self.done / elapsed if elapsed > 0 else 0
+
+
+class SSHFiler(object):
+  """
+  Object for handling ssh file requests with host server. The paramiko client
+  is only created (and paramiko imported) when connecting to a remote host, as
+  most sessions never do.
   """
 
   default_path = "/home/yichen/public/SiPMCalib/"
+  default_spool = os.path.join(os.path.expanduser('~'), '.sipmcalib_spool')
+
+  UPLOAD_BLOCK = 32768  # Bytes per SFTP write
+  RETRY_MAX = 30  # Maximum wait between upload retries in seconds
+
+  ## Closed files with more than PARALLEL_THRESHOLD bytes left to upload are
+  ## split into ranges of PARALLEL_CHUNK bytes, uploaded over PARALLEL_CHANNELS
+  ## SFTP channels of the same transport.
+  PARALLEL_THRESHOLD = 16 * 1024 * 1024
+  PARALLEL_CHUNK = 4 * 1024 * 1024
+  PARALLEL_CHANNELS = 4
+  CHUNK_RETRY = 3
 
   def __init__(self):
-    paramiko.SSHClient.__init__(self)
-    self.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    self.client = None
     self.host = ""
     self.remotepath = SSHFiler.default_path
+    self.sftp = None
+
+    ## Spooled uploads, indexed by the local spool file name. Each entry holds
+    ## the remote file name, the number of bytes already uploaded and the
+    ## remote file size before the upload (base).
+    self.spooldir = SSHFiler.default_spool
+    self.uploads = {}
+    self.upload_cv = threading.Condition()
+    self.uploader = None
+    ## Transfer records of the queued uploads and recently finished uploads
+    self.transfers = {}
+    self.history = collections.deque(maxlen=20)
 
   def reconnect(self, remotehost):
+    """
+    Connecting to the remote host with the credentials prompted on the
+    terminal. Nothing is saved in memory!
+    """
+    self.connect(
+        remotehost,
+        username=input(log.GREEN('Username at {0}: ').format(remotehost)),
+        password=getpass.getpass(
+            log.GREEN('Password at {0}: ').format(remotehost)))
+
+  def connect(self, remotehost, username, password, port=22):
+    """
+    Connecting to the remote host with the given credentials, and resuming the
+    uploads left over in the spool directory.
+    """
     # Closing existing section
     if self.get_transport():
       self.sftp.close()
       self.close()
 
-    ## Nothing is saved in memory!
-    self.connect(remotehost,
-                 username=input(
-                     log.GREEN('Username at {0}: ').format(remotehost)),
-                 password=getpass.getpass(
-                     log.GREEN('Password at {0}: ').format(remotehost)),
-                 compress=True)
+    import paramiko
+    self.client = paramiko.SSHClient()
+    self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    self.client.connect(remotehost,
+                        port=port,
+                        username=username,
+                        password=password,
+                        compress=True)
 
     ## Magic settings for boosting speed
     self.get_transport().window_size = 2147483647
@@ -41,23 +166,39 @@ class SSHFiler(paramiko.SSHClient):
     self.sftp = self.open_sftp()
     self.host = remotehost
 
+    # Resuming uploads left over by a previous session
+    self.resume_uploads()
+
   def __del__(self):
     if self.get_transport():
       self.sftp.close()
       self.close()
 
-  def remotefile(self, filename, wipefile):
+  ## Client methods, with no transport before the first connection
+  def get_transport(self):
+    return self.client.get_transport() if self.client else None
+
+  def open_sftp(self):
+    return self.client.open_sftp()
+
+  def exec_command(self, command):
+    return self.client.exec_command(command)
+
+  def close(self):
+    if self.client:
+      self.client.close()
+
+  def remotefile(self, filename, wipefile, binary=False):
     ## Always try to open in append mode
     if self.get_transport():
-      if wipefile:
-        return self.sftp.open(self.remotefilename(filename), 'w')
-      else:
-        return self.sftp.open(self.remotefilename(filename), 'a')
+      return SpoolFile(self, filename,
+                       self.register_upload(self.remotefilename(filename),
+                                            wipefile), binary)
     else:
       if wipefile:
-        return open(filename, 'w')
+        return open(filename, 'wb' if binary else 'w')
       else:
-        return open(filename, 'a+')
+        return open(filename, 'ab' if binary else 'a+')
 
   def remotefilename(self, filename):
     return str(self.remotepath + filename)
@@ -69,10 +210,366 @@ class SSHFiler(paramiko.SSHClient):
 
   def copyfile(self, localfile, remotefile):
     if self.get_transport():
-      self.sftp.put(localfile, self.remotefilename(remotefile))
+      self.register_upload(self.remotefilename(remotefile),
+                           True,
+                           localname=localfile,
+                           closed=True)
     else:
       shutil.copyfile(localfile, remotefile)
 
+  ## Background uploading of spooled files
+  def register_upload(self, remotename, wipefile, localname=None, closed=False):
+    """
+    Adding a local file to the upload queue, creating a new spool file if the
+    local file is not given. Files given explicitly are kept after the upload,
+    spool files are removed. The manifests of all uploads are kept in the spool
+    directory, such that uploads of kept files are also resumed. Returns the
+    local file name.
+    """
+    os.makedirs(self.spooldir, exist_ok=True)
+    spoolname = os.path.join(
+        self.spooldir, '{0:.6f}_{1}'.format(time.time(),
+                                            os.path.basename(remotename)))
+    keep = localname is not None
+    if not keep:
+      localname = spoolname
+      open(localname, 'w').close()
+
+    entry = {
+        'remote': remotename,
+        'local': os.path.abspath(localname),
+        'manifest': spoolname + '.upload',
+        'offset': 0,
+        'base': 0 if wipefile else None,  # Filled by the uploader if None
+        'wipe': wipefile,
+        'closed': closed,
+        'keep': keep,
+        'verify': False,
+    }
+    with self.upload_cv:
+      self.uploads[localname] = entry
+      self.transfers[localname] = Transfer(localname, remotename)
+      self.save_manifest(entry)
+      self.start_uploader()
+      self.upload_cv.notify()
+    return localname
+
+  def notify_upload(self):
+    with self.upload_cv:
+      self.upload_cv.notify()
+
+  def finish_upload(self, localname):
+    with self.upload_cv:
+      if localname in self.uploads:
+        self.uploads[localname]['closed'] = True
+        self.save_manifest(self.uploads[localname])
+      self.upload_cv.notify()
+
+  def upload_base(self, localname):
+    """
+    Size of the remote file before the upload started. This requires a
+    network round trip if the uploader has not yet processed the file.
+    """
+    entry = self.uploads.get(localname)
+    if not entry:
+      return 0
+    if entry['base'] is None:
+      try:
+        entry['base'] = self.sftp.stat(entry['remote']).st_size
+      except IOError:
+        entry['base'] = 0
+    return entry['base']
+
+  def pending_uploads(self):
+    with self.upload_cv:
+      return {
+          local: (entry['remote'], os.path.getsize(local) - entry['offset'])
+          for local, entry in self.uploads.items() if os.path.isfile(local)
+      }
+
+  def wait_uploads(self, timeout=None):
+    """
+    Waiting for all queued uploads to finish, returns whether the queue is
+    empty.
+    """
+    start = time.time()
+    with self.upload_cv:
+      while self.uploads and self.get_transport():
+        remain = None if timeout is None else timeout - (time.time() - start)
+        if remain is not None and remain <= 0:
+          break
+        self.upload_cv.wait(remain)
+      return not self.uploads
+
+  def start_uploader(self):
+    if self.uploader is None or not self.uploader.is_alive():
+      self.uploader = threading.Thread(target=self.upload_loop, daemon=True)
+      self.uploader.start()
+
+  def upload_loop(self):
+    """
+    Main loop of the uploader thread. Files are uploaded as they grow, and
+    failed uploads are retried with an increasing wait time. The upload
+    position of each file is verified against the remote file size after a
+    failure, so that partially written blocks are not duplicated.
+    """
+    wait = 1
+    while True:
+      with self.upload_cv:
+        # Periodic wake up to pick up content that is written but not flushed
+        self.upload_cv.wait(1.0)
+        if not self.uploads:
+          continue
+        entries = list(self.uploads.items())
+
+      # Stopping at the first failure, so that later entries to the same remote
+      # file are never uploaded ahead of earlier ones.
+      failed = False
+      for localname, entry in entries:
+        try:
+          self.upload_entry(localname, entry)
+        except Exception as err:
+          if wait == 1:
+            log.printwarn('Upload of [{0}] failed, retrying: {1}'.format(
+                entry['remote'], str(err)))
+          if localname in self.transfers:
+            self.transfers[localname].state = 'retrying'
+            self.transfers[localname].error = str(err)
+          entry['verify'] = True
+          failed = True
+          break
+
+      if failed:
+        time.sleep(wait)
+        wait = min(wait * 2, SSHFiler.RETRY_MAX)
+        try:  # Reopening the sftp channel if the transport is still alive
+          if self.get_transport() and self.get_transport().is_active():
+            self.sftp = self.open_sftp()
+        except Exception:
+          pass
+      else:
+        wait = 1
+
+  def upload_entry(self, localname, entry):
+    if not self.get_transport():
+      raise Exception('No connection to remote host')
+    if entry['wipe']:
+      self.sftp.open(entry['remote'], 'w').close()
+      entry['wipe'] = False
+      entry['base'] = 0
+    if entry['base'] is None:
+      entry['base'] = self.remote_size(entry['remote'])
+    if entry['verify']:
+      if entry.get('parallel'):
+        # Ranges of an interrupted parallel upload can leave holes in the remote
+        # file, so the content after the last verified offset is discarded.
+        self.sftp.truncate(entry['remote'], entry['base'] + entry['offset'])
+        entry['parallel'] = False
+      else:
+        entry['offset'] = max(
+            self.remote_size(entry['remote']) - entry['base'], 0)
+      entry['verify'] = False
+
+    closed = entry['closed']  # Read before the size to not miss content
+    size = os.path.getsize(localname)
+    transfer = self.transfers.setdefault(localname,
+                                         Transfer(localname, entry['remote']))
+    if closed and size - entry['offset'] > SSHFiler.PARALLEL_THRESHOLD:
+      self.parallel_upload(localname, entry, size, transfer)
+    elif size > entry['offset']:
+      transfer.begin(size, 1, 'streaming')
+      with open(localname, 'rb') as local:
+        local.seek(entry['offset'])
+        with self.sftp.open(entry['remote'], 'a') as remote:
+          while entry['offset'] < size:
+            block = local.read(min(SSHFiler.UPLOAD_BLOCK,
+                                   size - entry['offset']))
+            if not block:
+              break
+            remote.write(block)
+            entry['offset'] += len(block)
+            transfer.add(len(block))
+      self.save_manifest(entry)
+
+    if closed and entry['offset'] >= size:
+      transfer.finish('done')
+      # Removing the spool files before the waiting threads are notified, so
+      # that the upload is not resumed if the program exits right after.
+      os.remove(entry['manifest'])
+      if not entry['keep']:
+        os.remove(localname)
+      with self.upload_cv:
+        self.uploads.pop(localname, None)
+        self.history.append(self.transfers.pop(localname, transfer))
+        self.upload_cv.notify_all()
+
+  def parallel_upload(self, localname, entry, size, transfer):
+    """
+    Uploading the remaining content of a closed file as ranges over multiple
+    SFTP channels, writing each range in place in the remote file. The result is
+    verified by the remote file size and the SHA256 hash of the uploaded range
+    before the upload offset is advanced.
+    """
+    start = entry['offset']
+    ranges = queue.Queue()
+    for pos in range(start, size, SSHFiler.PARALLEL_CHUNK):
+      ranges.put((pos, min(SSHFiler.PARALLEL_CHUNK, size - pos), 0))
+    nchannels = min(SSHFiler.PARALLEL_CHANNELS, ranges.qsize())
+    transfer.begin(size, nchannels, 'parallel')
+    transfer.done = start
+    errors = []
+
+    ## The workers open the remote file for in place writing, which does not
+    ## create it. Created before the manifest flag, so that the truncation on
+    ## resume always finds the file.
+    self.sftp.open(entry['remote'], 'a').close()
+
+    ## Flagging the manifest such that a crash during the parallel upload is
+    ## handled by truncating the remote file on resume.
+    entry['parallel'] = True
+    self.save_manifest(entry)
+
+    def worker():
+      try:
+        sftp = self.open_sftp()
+      except Exception as err:
+        errors.append(err)
+        return
+      try:
+        with open(localname, 'rb') as local, \
+             sftp.open(entry['remote'], 'r+') as remote:
+          remote.set_pipelined(True)
+          while not errors:
+            try:
+              pos, length, attempt = ranges.get_nowait()
+            except queue.Empty:
+              break
+            try:
+              self.upload_range(local, remote, entry['base'], pos, length,
+                                transfer)
+            except Exception as err:
+              if attempt + 1 >= SSHFiler.CHUNK_RETRY:
+                errors.append(err)
+              else:
+                ranges.put((pos, length, attempt + 1))
+      except Exception as err:
+        errors.append(err)
+      finally:
+        sftp.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(nchannels)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      transfer.finish('failed', str(errors[0]))
+      raise errors[0]
+
+    transfer.state = 'verifying'
+    remote_size = self.remote_size(entry['remote'])
+    if remote_size != entry['base'] + size:
+      raise Exception('Remote size mismatch for [{0}]: {1:d}/{2:d}'.format(
+          entry['remote'], remote_size, entry['base'] + size))
+    remote_hash = self.remote_hash(entry['remote'], entry['base'] + start,
+                                   size - start)
+    if remote_hash is not None and \
+       remote_hash != self.local_hash(localname, start, size - start):
+      raise Exception('Hash mismatch for [{0}]'.format(entry['remote']))
+
+    entry['offset'] = size
+    entry['parallel'] = False
+    self.save_manifest(entry)
+
+  @staticmethod
+  def upload_range(local, remote, base, pos, length, transfer):
+    local.seek(pos)
+    remote.seek(base + pos)
+    remain = length
+    while remain > 0:
+      block = local.read(min(SSHFiler.UPLOAD_BLOCK, remain))
+      if not block:
+        raise Exception('Local file truncated during upload')
+      remote.write(block)
+      remain -= len(block)
+      transfer.add(len(block))
+    remote.flush()
+
+  @staticmethod
+  def local_hash(localname, start, length):
+    sha = hashlib.sha256()
+    with open(localname, 'rb') as f:
+      f.seek(start)
+      while length > 0:
+        block = f.read(min(1024 * 1024, length))
+        if not block:
+          break
+        sha.update(block)
+        length -= len(block)
+    return sha.hexdigest()
+
+  def remote_hash(self, remotename, start, length):
+    """
+    SHA256 hash of a byte range of the remote file, computed on the remote host.
+    Returns None if the remote host cannot compute it, in which case only the
+    file size is verified.
+    """
+    try:
+      _, stdout, _ = self.exec_command(
+          "tail -c +{0:d} '{1}' | head -c {2:d} | sha256sum".format(
+              start + 1, remotename, length))
+      return stdout.read().decode().split()[0]
+    except Exception:
+      return None
+
+  def transfer_status(self):
+    """
+    List of transfer records, recently finished transfers first.
+    """
+    with self.upload_cv:
+      return list(self.history) + list(self.transfers.values())
+
+  def remote_size(self, remotename):
+    try:
+      return self.sftp.stat(remotename).st_size
+    except IOError:
+      return 0
+
+  @staticmethod
+  def save_manifest(entry):
+    """
+    Storing the upload state in the spool directory, so that the upload can be
+    resumed after the program terminates.
+    """
+    with open(entry['manifest'], 'w') as f:
+      json.dump(entry, f)
+
+  def resume_uploads(self):
+    if not os.path.isdir(self.spooldir):
+      return
+    for manifest in sorted(os.listdir(self.spooldir)):
+      if not manifest.endswith('.upload'):
+        continue
+      manifest = os.path.join(self.spooldir, manifest)
+      with open(manifest, 'r') as f:
+        entry = json.load(f)
+      localname = entry['local']
+      if localname in self.uploads or not os.path.isfile(localname):
+        continue
+      # The last recorded offset may be behind the remote content.
+      entry['manifest'] = manifest
+      entry['closed'] = True
+      entry['verify'] = not entry['wipe']
+      with self.upload_cv:
+        self.uploads[localname] = entry
+        self.transfers[localname] = Transfer(localname, entry['remote'])
+    if self.uploads:
+      log.printmsg(log.GREEN('[SSHFILER]'),
+                   'Resuming upload of {0:d} files'.format(len(self.uploads)))
+      with self.upload_cv:
+        self.start_uploader()
+        self.upload_cv.notify()
+
   def setremotepath(self, newpath):
     self.remotepath = newpath
     if not self.remotepath.endswith('/'):
@@ -90,6 +587,9 @@ if __name__ == "__main__":
   def randomstring():
     return ''.join(random.choice('0123456789abcedf') for x in range(250))
 
+  f = ssh.remotefile('test.txt', True)
   for i in range(1000000):
-    ssh.writeto('test.txt', randomstring() + '\n')
+    f.write(randomstring() + '\n')
+  f.close()
+  ssh.wait_uploads()
   #ssh.sftp.put("/tmp/test2.txt", "test2.txt")
@@ -0,0 +1,235 @@
+import cmod.proxy as proxy
+import cmod.jsonenc as jsonenc
+import collections
+import threading
+import time
+import os
+
+
+class Telemetry(object):
+  """
+  Telemetry of the session for external monitoring. Structured events (scan
+  progress, command start and end, errors) are stored with a time stamp in an
+  in-process ring buffer, and are optionally appended to a JSON-lines file as
+  they happen. Counters (gantry moves, trigger pulses, scan points, errors) and
+  gauges are exported, together with the rates derived from them, to a
+  Prometheus textfile that is rewritten periodically by a background thread, to
+  be picked up by the textfile collector of a node exporter.
+  """
+
+  PREFIX = 'sipmcalib_'
+
+  ## Exported metrics as name: (type, help)
+  METRICS = {
+      'events_total': ('counter', 'Telemetry events published'),
+      'commands_total': ('counter', 'Commands run, by final status'),
+      'errors_total': ('counter', 'Command and device errors'),
+      'moves_total': ('counter', 'Gantry moves'),
+      'trigger_pulses_total': ('counter', 'Trigger pulses sent'),
+      'scan_points_total': ('counter', 'Scan points measured'),
+      'scan_progress': ('gauge', 'Fraction of the current scan completed'),
+      'scan_points_per_minute': ('gauge', 'Scan points in the last minute'),
+      'moves_per_second': ('gauge', 'Gantry move rate'),
+      'trigger_pulses_per_second': ('gauge', 'Trigger pulse rate'),
+      'device_ready': ('gauge', 'Device initialized successfully'),
+      'last_event_timestamp_seconds': ('gauge', 'Time of the latest event'),
+  }
+
+  ## Counters exported as rates, computed over RATE_WINDOW seconds
+  RATES = {
+      'moves_total': 'moves_per_second',
+      'trigger_pulses_total': 'trigger_pulses_per_second',
+  }
+  RATE_WINDOW = 60
+
+  def __init__(self, size=10000):
+    self.events = collections.deque(maxlen=size)
+    ## Metric values indexed by (name, sorted label pairs)
+    self.counters = collections.Counter()
+    self.gauges = {}
+    self.samples = collections.deque()  # Counter snapshots for the rates
+    self.lock = threading.Lock()
+    ## Held by the exporter thread and the command thread while exporting
+    self.exportlock = threading.RLock()
+    self.jsonfile = None
+    self.promfile = None
+    self.interval = 15
+    self.exporter = None
+    self.subscribers = []
+
+  def open_json(self, filename):
+    with self.lock:
+      if self.jsonfile:
+        self.jsonfile.close()
+      self.jsonfile = open(filename, 'a')
+
+  def set_promfile(self, filename, interval=None):
+    """
+    Setting the Prometheus textfile, which is rewritten every interval seconds
+    by the exporter thread.
+    """
+    self.promfile = filename
+    if interval:
+      self.interval = interval
+    if self.exporter is None:
+      self.exporter = threading.Thread(target=self.export_loop, daemon=True)
+      self.exporter.start()
+    self.write_prometheus()
+
+  @staticmethod
+  def key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+  def publish(self, event, **data):
+    """
+    Adding an event to the ring buffer and the JSON-lines file.
+    """
+    data['event'] = event
+    data['time'] = time.time()
+    with self.lock:
+      self.events.append(data)
+      self.counters[Telemetry.key('events_total', {'event': event})] += 1
+      self.gauges[Telemetry.key('last_event_timestamp_seconds',
+                                {})] = data['time']
+      if self.jsonfile:
+        self.jsonfile.write(jsonenc.dumps(data) + '\n')
+        self.jsonfile.flush()
+    for callback in self.subscribers:
+      callback(data)
+
+  def subscribe(self, callback):
+    """
+    Adding a function to be called with every published event, in the thread
+    publishing the event.
+    """
+    self.subscribers.append(callback)
+
+  def count(self, name, value=1, **labels):
+    with self.lock:
+      self.counters[Telemetry.key(name, labels)] += value
+
+  def gauge(self, name, value, **labels):
+    with self.lock:
+      self.gauges[Telemetry.key(name, labels)] = value
+
+  def recent(self, event=None, since=None):
+    with self.lock:
+      return [
+          x for x in self.events if (event is None or x['event'] == event) and (
+              since is None or x['time'] >= since)
+      ]
+
+  def total(self, name):
+    with self.lock:
+      return sum(v for k, v in self.counters.items() if k[0] == name)
+
+  def rates(self, now):
+    """
+    Per-second rates of the RATES counters, relative to the oldest counter
+    snapshot within the rate window.
+    """
+    totals = {name: self.total(name) for name in Telemetry.RATES}
+    self.samples.append((now, totals))
+    while len(self.samples) > 1 and \
+          now - self.samples[1][0] >= Telemetry.RATE_WINDOW:
+      self.samples.popleft()
+    start, previous = self.samples[0]
+    return {
+        Telemetry.RATES[name]:
+        (totals[name] - previous[name]) / (now - start) if now > start else 0.0
+        for name in totals
+    }
+
+  def snapshot(self):
+    """
+    All metric values as a dictionary of (name, labels) keys, including the
+    derived rates.
+    """
+    now = time.time()
+    metrics = {}
+    with self.exportlock:
+      rates = self.rates(now)
+    for name, rate in rates.items():
+      metrics[Telemetry.key(name, {})] = rate
+    for point in self.recent('scan_point', now - 60):
+      key = Telemetry.key('scan_points_per_minute',
+                          {'command': point['command']})
+      metrics[key] = metrics.get(key, 0) + 1
+    with self.lock:
+      metrics.update(self.counters)
+      metrics.update(self.gauges)
+    return metrics
+
+  def prometheus_text(self):
+    metrics = self.snapshot()
+    lines = []
+    for name, (kind, description) in Telemetry.METRICS.items():
+      entries = sorted((k, v) for k, v in metrics.items() if k[0] == name)
+      if not entries:
+        continue
+      lines.append('# HELP {0}{1} {2}'.format(Telemetry.PREFIX, name,
+                                               description))
+      lines.append('# TYPE {0}{1} {2}'.format(Telemetry.PREFIX, name, kind))
+      for (_, labels), value in entries:
+        labelstr = ','.join('{0}="{1}"'.format(k, v.replace('"', '\\"'))
+                            for k, v in labels)
+        lines.append('{0}{1}{2} {3}'.format(
+            Telemetry.PREFIX, name, '{' + labelstr + '}' if labelstr else '',
+            repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self):
+    """
+    Writing the textfile through a temporary file, so that the collector never
+    reads a partially written file.
+    """
+    if not self.promfile:
+      return
+    with self.exportlock:
+      tmpname = self.promfile + '.tmp'
+      with open(tmpname, 'w') as f:
+        f.write(self.prometheus_text())
+      os.replace(tmpname, self.promfile)
+
+  def export_loop(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.write_prometheus()
+      except Exception:
+        pass  # Retried on the next interval
+
+  def wrap(self, obj, counters):
+    return CountedObject(obj, self, counters)
+
+  def counted(self, counter, func):
+    name, argindex = counter
+
+    def call(*args, **kwargs):
+      result = func(*args, **kwargs)
+      self.count(name, 1 if argindex is None else args[argindex])
+      return result
+
+    return call
+
+class CountedObject(proxy.DeviceProxy):
+  """
+  Proxy of a device object, with the calls to the methods listed in the counter
+  map added to a telemetry counter. The counter map gives the counter name and
+  the index of the positional argument holding the count for each method (None
+  to count the calls).
+  """
+
+  def __init__(self, obj, telemetry, counters):
+    self._obj = obj
+    self._telemetry = telemetry
+    self._counters = counters
+
+  def target(self):
+    return self._obj
+
+  def wrap(self, name, method):
+    counter = self._counters.get(name)
+    if counter is None:
+      return None
+    return self._telemetry.counted(counter, method)
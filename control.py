@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
+import time
+launch_time = time.time()  # Before the other imports for the start up report
 import ctlcmd.cmdbase as cmdbase
 import ctlcmd.motioncmd as motioncmd
 import ctlcmd.getset as getset
 import ctlcmd.digicmd as digicmd
 import ctlcmd.viscmd as viscmd
 import ctlcmd.picocmd as picocmd
+import ctlcmd.server as server
 import cmod.logger as logger
 import copy
 import sys
@@ -14,6 +17,7 @@ if __name__ == '__main__':
       motioncmd.moveto,
       motioncmd.movespeed,
       motioncmd.halign,
+      motioncmd.halign3d,
       motioncmd.zscan,
       motioncmd.timescan,
       motioncmd.showreadout,
@@ -22,6 +26,8 @@ if __name__ == '__main__':
       viscmd.visualmaxsharp,
       viscmd.visualshowchip,
       viscmd.visualcenterchip,
+      viscmd.visualsurvey,
+      viscmd.visualmosaic,
       getset.set,
       getset.get,
       getset.getcoord,
@@ -30,6 +36,10 @@ if __name__ == '__main__':
       getset.lighton,
       getset.lightoff,
       getset.promptaction,
+      getset.transfers,
+      getset.catalogue,
+      getset.profile,
+      getset.showtelemetry,
       digicmd.pulse,
       picocmd.picoset,
       picocmd.picorunblock,
@@ -47,6 +57,14 @@ if __name__ == '__main__':
                            '--help',
                            action='store_true',
                            help='print help message and exit')
+  prog_parser.add_argument('--serve',
+                           type=str,
+                           metavar='ADDRESS',
+                           help="""
+                           Run headless, serving the session commands as JSON-RPC
+                           requests on the given unix socket path or HOST:PORT
+                           TCP address instead of the command prompt.
+                           """)
 
   ## Using map to store Default values:
   default_overide = {
@@ -69,14 +87,28 @@ if __name__ == '__main__':
     prog_parser.print_help()
     sys.exit(0)
 
+  ## The devices are initialized in the background, commands using a device
+  ## wait for its initialization to finish.
   try:
+    tasks = cmd.set.device_tasks(args)
+    cmd.init_devices(tasks + [('trigger', cmd.trigger.init)])
     cmd.set.run(args)
-    cmd.trigger.init()
   except Exception as err:
     logger.printerr(str(err))
     logger.printwarn(
         'There was error in the setup process, program will '
         'continue but will most likely misbehave! Use at your own risk!')
 
+  pending = cmd.pending_devices()
+  logger.printmsg(
+      logger.GREEN('[STARTUP]'),
+      '{0} ready after {1:.2f}s{2}'.format(
+          'Server' if args.serve else 'Command prompt',
+          time.time() - launch_time,
+          ', still initializing: ' + ', '.join(pending) if pending else ''))
 
-  cmd.cmdloop()
+  if args.serve:
+    server.controlserver(cmd).serve(args.serve)
+    cmd.do_exit('')
+  else:
+    cmd.cmdloop()
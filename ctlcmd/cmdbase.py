@@ -2,22 +2,38 @@ import cmod.gcoder as gcoder
 import cmod.board as board
 import cmod.logger as log
 import cmod.trigger as trigger
-import cmod.visual as visual
+import cmod.lazydevice as lazydevice
+import cmod.profiler as profiler
+import cmod.telemetry as telemetry
 import cmod.readout as readout
+import cmod.rangectrl as rangectrl
+import cmod.journal as journal
+import cmod.catalogue as catalogue
+import cmod.datafile as datafile
 import cmod.sshfiler as sshfiler
-import cmod.pico as pico
 import cmod.actionlist as actionlist
 import cmod.sighandle as sig
 import numpy as np
 import cmd
 import sys
 import os
+import copy
+import json
 import argparse
 import readline
 import glob
 import traceback
 import re
 import datetime
+import time
+import concurrent.futures
+import threading
+
+
+class ChipLostError(Exception):
+  """
+  The chip could not be found in the camera frame during visual centering.
+  """
 
 
 class controlterm(cmd.Cmd):
@@ -34,17 +50,69 @@ class controlterm(cmd.Cmd):
     """
   prompt = 'SiPMCalib> '
 
+  ## Device methods timed by the profiler, with the phase they are counted in
+  PROFILE_PHASES = {
+      'gcoder': {
+          'moveto': 'motion'
+      },
+      'visual':
+      dict.fromkeys([
+          'get_frame', 'find_chip', 'find_chip_frame', 'sharpness',
+          'sharpness_frame', 'mosaic_add'
+      ], 'vision'),
+      'pico':
+      dict.fromkeys(['startrapidblocks', 'isready', 'waitready', 'flushbuffer'],
+                    'acquisition'),
+      'readout': {
+          'read': 'acquisition'
+      },
+      'trigger': {
+          'pulse': 'acquisition'
+      },
+      'savefile':
+      dict.fromkeys(['write', 'write_row', 'flush', 'close'], 'fileio'),
+  }
+
+  ## Device methods counted in the telemetry, with the counter name and the
+  ## index of the argument holding the count (None to count the calls)
+  TELEMETRY_COUNTERS = {
+      'gcoder': {
+          'moveto': ('moves_total', None)
+      },
+      'trigger': {
+          'pulse': ('trigger_pulses_total', 0)
+      },
+  }
+
   def __init__(self, cmdlist):
     cmd.Cmd.__init__(self)
 
+    self.profiler = profiler.Profiler()
+    self.telemetry = telemetry.Telemetry()
     self.sshfiler = sshfiler.SSHFiler()
-    self.gcoder = gcoder.GCoder()
+    self.gcoder = self.wrap_device('gcoder', gcoder.GCoder())
     self.board = board.Board()
-    self.visual = visual.Visual()
-    self.pico = pico.PicoUnit()
-    self.readout = readout.readout(self)  # Must be after picoscope setup
-    self.trigger = trigger.Trigger()
+    self.journal = journal.Journal()
+    self.board.journal = self.journal
+    self.runcatalogue = catalogue.Catalogue()
+    ## The OpenCV and picoscope libraries are only loaded when first used
+    self.visual = self.wrap_device(
+        'visual', lazydevice.LazyDevice('cmod.visual', 'Visual'))
+    self.pico = self.wrap_device(
+        'pico', lazydevice.LazyDevice('cmod.pico', 'PicoUnit'))
+    # Must be after picoscope setup
+    self.readout = self.wrap_device('readout', readout.readout(self))
+    self.rangectrl = rangectrl.RangeController(self)
+    self.trigger = self.wrap_device('trigger', trigger.Trigger())
     self.action = actionlist.ActionList()
+    ## Set while runfiles are compiled, commands must not access the devices
+    self.dryrun = False
+    ## Device initializations running in the background, indexed by the name
+    ## of the session device being initialized
+    self.devinit = {}
+    ## Output sink and cancel flag of the requests run by the server, one per
+    ## thread
+    self.sinks = threading.local()
 
     ## Creating command instances and attaching to associated functions
     for com in cmdlist:
@@ -72,7 +140,81 @@ class controlterm(cmd.Cmd):
     """
     return dir(self)
 
+  def wrap_device(self, name, obj):
+    """
+    Wrapping a device object for the telemetry counters and the profiler timing
+    of its methods.
+    """
+    if name in controlterm.TELEMETRY_COUNTERS:
+      obj = self.telemetry.wrap(obj, controlterm.TELEMETRY_COUNTERS[name])
+    return self.profiler.wrap(obj, controlterm.PROFILE_PHASES[name])
+
+  def init_devices(self, tasks):
+    """
+    Running the device initialization functions, given as a list of (device,
+    function) pairs, concurrently in worker threads. The slow initializations
+    (homing the printer, opening the camera and the picoscope) then neither hold
+    up each other nor the command prompt. Commands wait for the devices they
+    use in wait_devices before running.
+    """
+    if not tasks:
+      return
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks))
+    for device, task in tasks:
+      self.devinit[device] = pool.submit(self.run_init, device, task)
+    pool.shutdown(wait=False)
+
+  def run_init(self, device, task):
+    try:
+      ready = task() is not False
+    except Exception as err:
+      log.printerr(str(err))
+      log.printwarn(('Failed to initialize [{0}], program will continue but '
+                     'will most likely misbehave!').format(device))
+      ready = False
+    self.telemetry.gauge('device_ready', int(ready), device=device)
+    if not ready:
+      self.telemetry.count('errors_total', source=device)
+
+  def wait_devices(self, devices=None):
+    """
+    Readiness barrier for the listed session devices (all devices if None),
+    blocking until their background initialization has finished.
+    """
+    for device in list(self.devinit) if devices is None else devices:
+      future = self.devinit.get(device)
+      if future is None:
+        continue
+      if not future.done():
+        log.printmsg(log.GREEN('[DEVICE]'),
+                     'Waiting for [{0}] to finish initializing'.format(device))
+      future.result()
+
+  def pending_devices(self):
+    return [x for x, future in self.devinit.items() if not future.done()]
+
+  def forward(self, kind, data):
+    """
+    Passing command output and telemetry events to the output sink of the
+    current thread, set by the server for the commands of a client.
+    """
+    sink = getattr(self.sinks, 'sink', None)
+    if sink:
+      sink(kind, data)
+
+  def cancelled(self):
+    """
+    Whether the server request run by the current thread was cancelled.
+    """
+    cancel = getattr(self.sinks, 'cancel', None)
+    return cancel is not None and cancel.is_set()
+
   def do_exit(self, line):
+    if self.sshfiler.pending_uploads():
+      log.printmsg(log.GREEN('[EXIT]'), 'Waiting for remote uploads to finish')
+      if not self.sshfiler.wait_uploads(60):
+        log.printwarn(('Uploads not finished, they will be resumed on the '
+                       'next connection to the remote host'))
     sys.exit(0)
 
   def help_exit(self):
@@ -82,28 +224,157 @@ class controlterm(cmd.Cmd):
   # cannot be declared using an external class.
   def do_runfile(self, line):
     """
-    usage: runfile <file>
+    usage: runfile [--dryrun] [--noreorder] <file>
 
     Executing commands listed in a file. This should be used for standard
-    calibration procedures only.
+    calibration procedures only. The file is first compiled: every line is
+    parsed and validated against the board and calibration state expected at
+    that point of the file, without moving the gantry or taking data, and the
+    total run time is estimated from previous runs. Nothing is executed if any
+    line fails to compile. Consecutive lines running the same command on
+    different chips are reordered to reduce the gantry travel, unless
+    --noreorder is given. With --dryrun, the compiled plan is printed without
+    being executed. Empty lines and lines starting with # are ignored.
     """
-    if len(line.split()) != 1:
+    tokens = line.split()
+    dryrun = '--dryrun' in tokens
+    reorder = '--noreorder' not in tokens
+    files = [x for x in tokens if x not in ['--dryrun', '--noreorder']]
+    if len(files) != 1:
       log.printerr('Please only specify one file!')
       return
 
-    if not os.path.isfile(line):
+    if not os.path.isfile(files[0]):
       log.printerr('Specified file could not be opened!')
       return
 
-    with open(line) as f:
-      for cmdline in f.readlines():
-        status = self.onecmd(cmdline.strip())
-        if status != controlcmd.EXIT_SUCCESS:
-          log.printerr(('Command [{0}] in file [{1}] has failed. Exiting '
-                        '[runfile] command').format(cmdline.strip(), f.name))
-          break
+    steps, errors = self.compile_runfile(files[0])
+    if errors:
+      for error in errors:
+        log.printerr(error)
+      log.printerr(('Runfile [{0}] has {1:d} invalid lines, nothing was '
+                    'executed').format(files[0], len(errors)))
+      return
+
+    header = log.GREEN('[RUNFILE]')
+    travel = runstep.travel(steps, (self.gcoder.opx, self.gcoder.opy))
+    if reorder:
+      steps = self.reorder_runfile(steps)
+      newtravel = runstep.travel(steps, (self.gcoder.opx, self.gcoder.opy))
+      if newtravel < travel:
+        log.printmsg(header,
+                     ('Reordered chips, gantry travel reduced from {0:.0f}mm '
+                      'to {1:.0f}mm').format(travel, newtravel))
+    known = [x.estimate for x in steps if x.estimate is not None]
+    log.printmsg(header, ('{0:d} commands, estimated time {1} ({2:d} commands '
+                          'without previous runs)').format(
+                              len(steps),
+                              datetime.timedelta(seconds=int(sum(known))),
+                              len(steps) - len(known)))
+
+    if dryrun:
+      for step in steps:
+        log.printmsg(header, '{0:>10s} | {1}'.format(
+            '?' if step.estimate is None else str(
+                datetime.timedelta(seconds=int(step.estimate))), step.line))
+      return
+
+    for step in steps:
+      if self.cancelled():
+        log.printerr('Runfile cancelled before [{0}] in file [{1}] (line {2:d})'.
+                     format(step.line, step.source, step.lineno))
+        break
+      status = self.onecmd(step.line)
+      if status != controlcmd.EXIT_SUCCESS:
+        log.printerr(('Command [{0}] in file [{1}] (line {2:d}) has failed. '
+                      'Exiting [runfile] command').format(
+                          step.line, step.source, step.lineno))
+        break
     return
 
+  def compile_runfile(self, filename, depth=0):
+    """
+    Parsing every line of a runfile with the parser of the command, returning
+    the list of compiled steps and the list of error messages. The commands are
+    parsed with a copy of the board, which is updated with the expected results
+    of each command (see controlcmd.plan), so that calibration prerequisites
+    produced by earlier lines of the file are taken into account. Runfiles
+    called within the file are expanded in place.
+    """
+    steps, errors = [], []
+    commands = [x for x in vars(self).values() if isinstance(x, controlcmd)]
+    journal, self.board.journal = self.board.journal, None
+    sandbox = copy.deepcopy(self.board)
+    self.board.journal = journal
+
+    self.dryrun = True
+    for command in commands:
+      command.board = sandbox
+    try:
+      self.compile_lines(filename, depth, steps, errors)
+    finally:
+      self.dryrun = False
+      for command in commands:
+        command.board = self.board
+    return steps, errors
+
+  def compile_lines(self, filename, depth, steps, errors):
+    with open(filename) as f:
+      lines = f.readlines()
+    for lineno, line in enumerate(lines, 1):
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      where = '[{0}] line {1:d}: '.format(filename, lineno)
+      name, _, argline = line.partition(' ')
+
+      if name == 'runfile':
+        if depth >= 8 or not os.path.isfile(argline.strip()):
+          errors.append(where + 'Cannot open runfile [{0}]'.format(argline))
+        else:
+          self.compile_lines(argline.strip(), depth + 1, steps, errors)
+        continue
+      if not hasattr(self, 'do_' + name):
+        errors.append(where + 'Unknown command [{0}]'.format(name))
+        continue
+
+      step = runstep(filename, lineno, line)
+      command = getattr(self, name, None)
+      if isinstance(command, controlcmd):
+        try:
+          step.compile(command, argline)
+        except Exception as err:
+          errors.append(where + str(err))
+          continue
+      steps.append(step)
+
+  def reorder_runfile(self, steps):
+    """
+    Reordering blocks of consecutive steps that run the same command with the
+    same options on different chips, such that the gantry travel between the
+    chips is minimized. Blocks are only reordered if each step writes to a
+    different file.
+    """
+    result = []
+    position = (self.gcoder.opx, self.gcoder.opy)
+    idx = 0
+    while idx < len(steps):
+      end = idx + 1
+      while (end < len(steps) and steps[idx].group is not None
+             and steps[end].group == steps[idx].group):
+        end += 1
+      block = steps[idx:end]
+      savefiles = [x.savefile for x in block]
+      if len(block) > 2 and len(set(savefiles)) == len(savefiles):
+        order = controlcmd.order_by_travel([x.position for x in block],
+                                           position)
+        block = [block[x] for x in order]
+      result.extend(block)
+      position = next((x.position for x in reversed(result) if x.position),
+                      position)
+      idx = end
+    return result
+
   def complete_runfile(self, text, line, start_index, end_index):
     return controlcmd.globcomp(text)
 
@@ -141,6 +412,48 @@ class controlterm(cmd.Cmd):
             'Please respond with \'yes\' or \'no\' (or \'y\' or \'n\').\n')
 
 
+class runstep(object):
+  """
+  Single compiled line of a runfile
+  """
+  def __init__(self, source, lineno, line):
+    self.source = source
+    self.lineno = lineno
+    self.line = line
+    self.estimate = None  # Estimated run time in seconds
+    self.position = None  # x-y position of the command
+    self.savefile = None  # Expanded save file name
+    self.group = None  # Key of steps that can be reordered
+
+  def compile(self, command, argline):
+    args = command.parse(argline)
+    command.plan(args)
+    self.estimate = command.estimate(args)
+    self.savefile = getattr(args, 'savefile', None)
+    if getattr(args, 'x', None) is not None and \
+       getattr(args, 'y', None) is not None:
+      self.position = (args.x, args.y)
+    if getattr(args, 'chipid', None) in command.board.chips() and \
+       self.position is not None:
+      self.group = ' '.join(
+          re.sub(r'(^|\s)(-c|--chipid)(\s+|=)\S+', ' ', self.line).split())
+
+  @staticmethod
+  def travel(steps, start):
+    """
+    Total x-y gantry travel [mm] of the steps, counting the larger of the axis
+    displacements as the motors move simultaneously.
+    """
+    total = 0
+    for step in steps:
+      if step.position is None:
+        continue
+      total += max(abs(step.position[0] - start[0]),
+                   abs(step.position[1] - start[1]))
+      start = step.position
+    return total
+
+
 class controlcmd():
   """
   The control command is the base interface for defining a command in the
@@ -155,6 +468,18 @@ class controlcmd():
 
   LOG = "DUMMY"
 
+  ## Output columns of the save file as (name, dtype, text format) tuples. Only
+  ## commands declaring their columns can use the columnar output formats.
+  SAVEFILE_COLUMNS = None
+
+  ## Session devices used by the command, which must have finished initializing
+  ## before the command runs. None waits for every device.
+  DEVICES = None
+
+  ## Commands only reading the session state, which may run in the server
+  ## while other commands are using the devices.
+  READONLY = False
+
   def __init__(self, cmdsession):
     """
     Initializer declares an argument parser class with the class name as the
@@ -176,8 +501,10 @@ class controlcmd():
     self.visual = cmdsession.visual
     self.pico = cmdsession.pico
     self.readout = cmdsession.readout  # Must be after pico setup
+    self.rangectrl = cmdsession.rangectrl
     self.trigger = cmdsession.trigger
     self.action = cmdsession.action
+    self.runcatalogue = cmdsession.runcatalogue
 
   def do(self, line):
     """
@@ -211,11 +538,15 @@ class controlcmd():
         stackline += content
         log.printmsg(stackline)
 
+    self.cmdline = line  # Stored for the save file metadata
+    self.cmd.wait_devices(self.DEVICES)
+    self.begin_run(line)
     try:
       args = self.parse(line)
     except Exception as err:
       print_tracestack()
       self.printerr(str(err))
+      self.end_run(None, 'parse error', err)
       return controlcmd.PARSE_ERROR
 
     try:
@@ -223,8 +554,14 @@ class controlcmd():
     except Exception as err:
       print_tracestack()
       self.printerr(str(err))
+      try:  # Keeping the results written before the failure
+        self.close_savefile(args, verbose=False)
+      except Exception as close_err:
+        self.printwarn('Failed to close save file: ' + str(close_err))
+      self.end_run(args, 'failed', err)
       return controlcmd.EXECUTE_ERROR
 
+    self.end_run(args, 'done')
     log.clear_update()
     return controlcmd.EXIT_SUCCESS
 
@@ -270,6 +607,7 @@ class controlcmd():
     Printing an update message using the static variable "LOG".
     """
     log.update(self.LOG, text)
+    self.cmd.forward('update', text)
 
   def printmsg(self, text):
     """
@@ -277,6 +615,7 @@ class controlcmd():
     """
     log.clear_update()
     log.printmsg(self.LOG, text)
+    self.cmd.forward('message', text)
 
   def printerr(self, text):
     """
@@ -284,13 +623,15 @@ class controlcmd():
     """
     log.clear_update()
     log.printerr(text)
+    self.cmd.forward('error', text)
 
   def printwarn(self, text):
     """
     Printing a warning message with a standard yellow "WARNING" header.
     """
     log.clear_update()
-    log.printerr()
+    log.printwarn(text)
+    self.cmd.forward('warning', text)
 
   def run(self, args):
     """
@@ -305,13 +646,73 @@ class controlcmd():
     session doesn't end with the user inputs a bad command. Additional parsing
     could be achieved by overloading this methods.
     """
+    ## Files are not opened when compiling runfiles, only checked
+    filetypes = {}
+    if self.cmd.dryrun:
+      for action in self.parser._actions:
+        if isinstance(action.type, argparse.FileType):
+          filetypes[action] = action.type
+          action.type = controlcmd.dryrun_file(action.type._mode)
     try:
       arg = self.parser.parse_args(line.split())
     except SystemExit as err:
       self.printerr(str(err))
       raise Exception('Cannot parse input')
+    finally:
+      for action, filetype in filetypes.items():
+        action.type = filetype
     return arg
 
+  @staticmethod
+  def dryrun_file(mode):
+    """
+    Argument type replacing argparse.FileType when compiling runfiles. The file
+    is checked for access in the given mode, and only the name is stored.
+    """
+    def check(name):
+      if 'r' in mode and not os.access(name, os.R_OK):
+        raise argparse.ArgumentTypeError('cannot read file ' + name)
+      if 'w' in mode and not os.access(
+          os.path.dirname(os.path.abspath(name)), os.W_OK):
+        raise argparse.ArgumentTypeError('cannot write file ' + name)
+      return argparse.Namespace(name=name)
+
+    return check
+
+  def plan(self, args):
+    """
+    Updating the session board with the expected results of the command when
+    compiling runfiles, such that the calibration prerequisites of the later
+    commands can be checked. Should be overwritten by commands that produce
+    calibration results. The devices must not be accessed.
+    """
+    pass
+
+  def expected_rows(self, args):
+    """
+    Expected number of rows written to the save file, used for estimating the
+    run time. Should be overwritten by the commands if it is known in advance.
+    """
+    return None
+
+  def estimate(self, args):
+    """
+    Estimated run time [s] of the command from the previous runs recorded in
+    the run catalogue, scaled by the expected number of rows if it is known.
+    None is returned for commands without previous runs.
+    """
+    try:
+      history = self.runcatalogue.durations(self.__class__.__name__.lower())
+    except Exception:
+      return None
+    if not history:
+      return None
+    rows = self.expected_rows(args)
+    rates = [duration / nrows for duration, nrows in history if nrows > 0]
+    if rows and rates:
+      return float(np.median(rates)) * rows
+    return float(np.median([duration for duration, _ in history]))
+
   def init_handle(self):
     """
     Creating the a new instance of the signal handling class to be used for
@@ -330,11 +731,9 @@ class controlcmd():
     msg = check_msg + exit_msg if hasattr(args, 'savefile') \
       else check_msg + flush_msg + exit_msg
 
-    if self.sighandle.terminate:
+    if self.sighandle.terminate or self.cmd.cancelled():
       self.printmsg(msg)
-      if hasattr(args, 'savefile'):
-        args.savefile.flush()
-        args.savefile.close()
+      self.close_savefile(args, verbose=False)
       raise Exception('TERMINATION SIGNAL')
 
   def move_gantry(self, x, y, z, verbose):
@@ -350,6 +749,33 @@ class controlcmd():
     except:
       pass
 
+  def visual_pipeline_scan(self, args, points, process, collect):
+    """
+    Running a visual scan over a list of (x,y,z) points, where the image
+    processing of the frame captured at one point is overlapped with the gantry
+    motion to the next point. The process function is called on a worker thread
+    with the captured frame, and the collect function is called on the main
+    thread in scan order with the scan index, the gantry position at the time
+    of capture and the return value of the process function. The wall time per
+    point is roughly max(motion, processing) rather than their sum.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      pending = None
+      for idx, (xval, yval, zval) in enumerate(points):
+        self.check_handle(args)
+        self.move_gantry(xval, yval, zval, False)
+        frame = self.visual.get_frame()
+        position = (self.gcoder.opx, self.gcoder.opy, self.gcoder.opz)
+
+        # Processing of the previous frame should be done by now.
+        if pending:
+          collect(pending[0], pending[1], pending[2].result())
+        pending = (idx, position,
+                   executor.submit(self.cmd.profiler.bind(process), frame))
+
+      if pending:
+        collect(pending[0], pending[1], pending[2].result())
+
   def add_xychip_options(self):
     """
     Adding XY motion commands
@@ -430,6 +856,25 @@ class controlcmd():
     self.parser.add_argument('--wipefile',
                              action='store_true',
                              help='Wipe existing content in output file')
+    if self.SAVEFILE_COLUMNS:  # Free form output is only written as text
+      self.parser.add_argument('--format',
+                               type=str,
+                               choices=list(datafile.WRITERS.keys()),
+                               default='text',
+                               help=('Output file format. The columnar formats '
+                                     '(hdf5, npz) store named, typed columns '
+                                     'with a metadata header, and are written '
+                                     'locally then copied to the remote host '
+                                     'when the command finishes'))
+    self.parser.add_argument('--compress',
+                             type=str,
+                             choices=['none'] +
+                             list(datafile.COMPRESSION.keys()),
+                             default='none',
+                             help=('Compressing the text output as it is '
+                                   'written. The file extension of the '
+                                   'compression method is added to the '
+                                   'filename'))
 
   def add_zscan_options(self, zlist=range(10, 51, 1)):
     """
@@ -446,6 +891,28 @@ class controlcmd():
                                    'One can add a list of number by the notation'
                                    ' "[start_z end_z sepration]"'))
 
+  def add_adaptivez_options(self):
+    """
+    Common arguments for adaptive sampling along the z axis
+    """
+    self.parser.add_argument('--adaptive',
+                             action='store_true',
+                             help=('Start with a coarse subset of the z list '
+                                   'and insert points where the measured curve '
+                                   'changes rapidly'))
+    self.parser.add_argument('--maxpoints',
+                             type=int,
+                             default=25,
+                             help=('Maximum number of z points to measure in '
+                                   'adaptive mode'))
+    self.parser.add_argument('--threshold',
+                             type=float,
+                             default=0.05,
+                             help=('Relative change or curvature of the '
+                                   'measured curve (normalized to its range) '
+                                   'above which an interval is subdivided in '
+                                   'adaptive mode'))
+
   def parse_readout_options(self, args):
     """
     Parsing the readout option
@@ -455,33 +922,42 @@ class controlcmd():
     if args.mode == self.readout.MODE_PICO:
       if args.channel < 0 or args.channel > 1:
         raise Exception('Channel for PICOSCOPE can only be 0 or 1')
-      self.readout.set_mode(args.mode)
+      if not self.cmd.dryrun:
+        self.readout.set_mode(args.mode)
     elif args.mode == self.readout.MODE_ADC:
       if args.channel < 0 or args.channel > 3:
         raise Exception('Channel for ADC can only be 0--3')
-      self.readout.set_mode(args.mode)
+      if not self.cmd.dryrun:
+        self.readout.set_mode(args.mode)
 
-  def make_hscan_mesh(self, args):
+  def make_hscan_mesh(self, args, x=None, y=None, hrange=None, distance=None):
     """
-    Common argument for generating x-y scanning coordinate mesh
+    Common argument for generating x-y scanning coordinate mesh. The center,
+    range and sampling distance are taken from the arguments unless explicitly
+    specified.
     """
     max_x = gcoder.GCoder.max_x()
     max_y = gcoder.GCoder.max_y()
-
-    if(args.x - args.range < 0 or
-       args.x + args.range > max_x or
-       args.y - args.range < 0 or
-       args.y + args.range > max_y):
+    x = args.x if x is None else x
+    y = args.y if y is None else y
+    hrange = args.range if hrange is None else hrange
+    distance = args.distance if distance is None else distance
+
+    if(x - hrange < 0 or
+       x + hrange > max_x or
+       y - hrange < 0 or
+       y + hrange > max_y):
       log.printwarn(('The arguments placed will put the gantry past its limits, '
                      'the command will used modified input parameters'))
 
-    xmin = max([args.x - args.range, 0])
-    xmax = min([args.x + args.range, max_x])
-    ymin = max([args.y - args.range, 0])
-    ymax = min([args.y + args.range, max_y])
-    sep = max([args.distance, 0.1])
-    xmesh, ymesh = np.meshgrid(np.linspace(xmin, xmax, (xmax - xmin) / sep + 1),
-                               np.linspace(ymin, ymax, (ymax - ymin) / sep + 1))
+    xmin = max([x - hrange, 0])
+    xmax = min([x + hrange, max_x])
+    ymin = max([y - hrange, 0])
+    ymax = min([y + hrange, max_y])
+    sep = max([distance, 0.1])
+    xmesh, ymesh = np.meshgrid(
+        np.linspace(xmin, xmax, int(round((xmax - xmin) / sep)) + 1),
+        np.linspace(ymin, ymax, int(round((ymax - ymin) / sep)) + 1))
     return [
         xmesh.reshape(1, np.prod(xmesh.shape))[0],
         ymesh.reshape(1, np.prod(ymesh.shape))[0]
@@ -504,10 +980,84 @@ class controlcmd():
       maxz = max(r[:2])
       sep = 1 if len(r) == 2 else r[2]
       args.zlist.extend(
-          np.linspace(minz, maxz, (maxz - minz) / sep, endpoint=False))
+          np.linspace(minz,
+                      maxz,
+                      int(round((maxz - minz) / sep)),
+                      endpoint=False))
     args.zlist = [x for x in args.zlist if x < gcoder.GCoder.max_z()]
     args.zlist.sort()  ## Returning sorted result
 
+  def adaptive_zscan(self, args, measure):
+    """
+    Running the measure function over the z values of args.zlist. The measure
+    function takes a list of z values, performs (and records) the measurement
+    in order, and returns the list of measured values. In adaptive mode, a
+    coarse evenly spaced subset of the z list is measured first, then the
+    intervals where the measured curve exceeds the threshold are subdivided
+    round by round until no interval needs refinement or the point budget is
+    exhausted. The rows of the save file are then held back and written sorted
+    by z when the file is closed, so the output has the same order as a regular
+    scan. Returns the sorted list of z values measured and the corresponding
+    values.
+    """
+    if not getattr(args, 'adaptive', False):
+      return args.zlist, list(measure(args.zlist))
+
+    if not isinstance(getattr(args, 'savefile', ''), str):
+      zcolumn = [col[0] for col in self.SAVEFILE_COLUMNS].index('z')
+      args.savefile = datafile.SortedWriter(args.savefile, zcolumn)
+
+    zlist = sorted(set(args.zlist))
+    ncoarse = min(len(zlist), max(3, args.maxpoints // 3))
+    pending = [zlist[i] for i in np.unique(
+        np.linspace(0, len(zlist) - 1, ncoarse).round().astype(int))]
+    results = {}
+    while pending:
+      for z, val in zip(pending, measure(pending)):
+        results[z] = val
+      zvals = sorted(results)
+      pending = self.refine_zlist(zvals, [results[z] for z in zvals],
+                                  args.maxpoints - len(results), args.threshold)
+
+    zvals = sorted(results)
+    return zvals, [results[z] for z in zvals]
+
+  @staticmethod
+  def refine_zlist(zvals, values, budget, threshold, resolution=0.1):
+    """
+    Given a sorted list of measured z values and the measured values, return
+    the interval midpoints to measure next. Each interval is scored by the
+    relative change of the measurement across it and the curvature at its
+    edges, both normalized to the range of the measurement. Intervals scoring
+    above threshold are split in order of decreasing score, as long as the
+    budget allows and the interval is wider than twice the gantry resolution.
+    """
+    if budget <= 0 or len(zvals) < 2:
+      return []
+    z = np.asarray(zvals, dtype=float)
+    v = np.asarray(values, dtype=float)
+    scale = np.max(v) - np.min(v)
+    if scale <= 0:
+      return []
+
+    slope = np.diff(v) / np.diff(z)
+    score = np.abs(np.diff(v)) / scale
+    # Second difference at interior points in units of the measurement range
+    curve = np.abs(np.diff(slope)) * (z[2:] - z[:-2]) / 2 / scale
+    score[:-1] = np.maximum(score[:-1], curve)
+    score[1:] = np.maximum(score[1:], curve)
+
+    new_z = []
+    for idx in np.argsort(-score):
+      if score[idx] < threshold or len(new_z) >= budget:
+        break
+      if z[idx + 1] - z[idx] < 2 * resolution:
+        continue
+      mid = round(round((z[idx] + z[idx + 1]) / 2 / resolution) * resolution, 1)
+      if z[idx] < mid < z[idx + 1]:
+        new_z.append(mid)
+    return sorted(new_z)
+
   def parse_xychip_options(self, args, add_visoffset=False, raw_coord=False):
     """
     Parsing the x-y-chip position arguments
@@ -545,32 +1095,151 @@ class controlcmd():
 
     if add_visoffset:
       if any(self.board.vis_coord[args.chipid]):
-        closest_z = self.find_closest_z(self.board.vis_coord[args.chipid],
-                                        current_z)
-        args.x = board.vis_coord[args.chipid][closest_z][0]
-        args.y = board.vis_coord[args.chipid][closest_z][1]
+        args.x, args.y = board.interp_vis_coord(args.chipid, current_z)[:2]
       else:
         x_offset, y_offset = self.find_xyoffset(current_z)
         args.x = board.orig_coord[args.chipid][0] + x_offset
         args.y = board.orig_coord[args.chipid][1] + y_offset
     else:
       if any(board.lumi_coord[args.chipid]):
-        closest_z = self.find_closest_z(self.board.lumi_coord[args.chipid],
-                                        current_z)
-        args.x = board.lumi_coord[args.chipid][closest_z][0]
-        args.y = board.lumi_coord[args.chipid][closest_z][2]
+        lumi = board.interp_lumi_coord(args.chipid, current_z)
+        args.x = lumi[0]
+        args.y = lumi[2]
       elif any(board.vis_coord[args.chipid]):
         x_offset, y_offset = self.find_xyoffset(current_z)
-        closest_z = self.find_closest_z(self.board.vis_coord[args.chipid],
-                                        current_z)
-        args.x = board.vis_coord[args.chipid][closest_z][0] - x_offset
-        args.y = board.vis_coord[args.chipid][closest_z][1] - y_offset
+        vis = board.interp_vis_coord(args.chipid, current_z)
+        args.x = vis[0] - x_offset
+        args.y = vis[1] - y_offset
       else:
         args.x, args.y = board.orig_coord[args.chipid]
 
   @staticmethod
-  def find_closest_z(my_map, current_z):
-    return min(my_map.keys(), key=lambda x: abs(float(x) - float(current_z)))
+  def order_by_travel(points, start):
+    """
+    Returning the visiting order (as a list of indices) of a list of (x,y)
+    points that approximately minimizes the gantry travel when starting from
+    the start position. As the x and y motors move simultaneously, the travel
+    time between two points is given by the larger of the axis displacements.
+    The path is built by nearest neighbour and then refined by 2-opt swaps.
+    """
+    if not len(points):
+      return []
+    pts = np.vstack([np.array(start, dtype=float)[:2],
+                     np.array(points, dtype=float)[:, :2]])
+    dist = np.max(np.abs(pts[:, np.newaxis, :] - pts[np.newaxis, :, :]),
+                  axis=-1)
+
+    ## Nearest neighbour path, index 0 is the fixed starting position
+    order = [0]
+    remain = list(range(1, len(pts)))
+    while remain:
+      nextidx = min(remain, key=lambda j: dist[order[-1], j])
+      order.append(nextidx)
+      remain.remove(nextidx)
+
+    ## 2-opt refinement for an open path
+    improved = True
+    while improved:
+      improved = False
+      for i in range(1, len(order) - 1):
+        for j in range(i + 1, len(order)):
+          prev, first, last = order[i - 1], order[i], order[j]
+          delta = dist[prev, last] - dist[prev, first]
+          if j + 1 < len(order):
+            delta += dist[first, order[j + 1]] - dist[last, order[j + 1]]
+          if delta < -1e-9:
+            order[i:j + 1] = order[i:j + 1][::-1]
+            improved = True
+
+    return [idx - 1 for idx in order[1:]]
+
+  def visM_calibchip(self, chipid, z):
+    """
+    Returning the chip whose visual transformation matrix should be used for
+    the chip at height z: the chip itself if it has a matrix at this height,
+    otherwise the first calibration chip that does. Without a matrix at this
+    height, the chip (or the first calibration chip) with matrices at other
+    heights is returned, with the matrix then taken from the closest or
+    interpolated heights (see Board.interp_visM). None is returned if no chip
+    has a matrix.
+    """
+    chips = ([chipid] if chipid in self.board.visM else []) + \
+            [x for x in self.board.calibchips() if x != chipid]
+    return next((x for x in chips if self.board.visM_hasz(x, z)),
+                next((x for x in chips if self.board.visM[x]), None))
+
+  def visual_center_oneshot(self, visM, tolerance=0.1, maxcorrection=2):
+    """
+    Centering the chip in the field of view using the linear visual
+    transformation matrix visM to solve for the required motion directly. A
+    single frame is used to verify the position after each motion, and a
+    correction motion is only performed if the residual exceeds the tolerance
+    [mm]. The observed displacement of the chip after each motion is used to
+    refine the matrix with a rank-1 (Broyden) update.
+
+    Returns the list of residuals [mm] seen after each frame (so the number of
+    motions performed is one less than its length) and the refined matrix.
+    """
+    visM = np.array(visM, dtype=float)
+    fov_center = np.array([
+        self.visual.frame_width() / 2,
+        self.visual.frame_height() / 2
+    ])
+    residuals = []
+    prev_pixel = None
+    prev_gantry = None
+
+    for nmotion in range(maxcorrection + 1):
+      center = self.visual.find_chip(False)
+      if center.x < 0 or center.y < 0:
+        raise ChipLostError(('Chip lost! Check current camera position with '
+                             'command visualshowchip'))
+      pixel = np.array([center.x, center.y])
+      gantry = np.array([self.gcoder.opx, self.gcoder.opy])
+
+      ## Refining the matrix using the actual motion of the gantry
+      if prev_pixel is not None:
+        dgantry = gantry - prev_gantry
+        if np.dot(dgantry, dgantry) > 0:
+          visM += np.outer((pixel - prev_pixel) - visM.dot(dgantry),
+                           dgantry) / np.dot(dgantry, dgantry)
+
+      motionxy = np.linalg.solve(visM, fov_center - pixel)
+      residuals.append(np.linalg.norm(motionxy))
+      if residuals[-1] < tolerance or nmotion == maxcorrection:
+        break
+
+      prev_pixel, prev_gantry = pixel, gantry
+      self.move_gantry(self.gcoder.opx + motionxy[0],
+                       self.gcoder.opy + motionxy[1], self.gcoder.opz, False)
+
+    return residuals, visM
+
+  def predict_vis_coord(self, chip, z, default_offset):
+    """
+    Predicting the visual coordinates of a chip at height z. Existing visual
+    coordinates of the chip are used if available, otherwise the prediction
+    uses the offset between the visual and original coordinates of the
+    nearest chip that has visual coordinates at this height. The default
+    offset is used if no such chip exists.
+    """
+    if self.board.vis_coord_hasz(chip, z):
+      return tuple(self.board.get_vis_coord(chip, z)[:2])
+
+    orig = self.board.orig_coord[chip]
+    surveyed = [
+        c for c in self.board.chips()
+        if self.board.vis_coord_hasz(c, z) and self.board.orig_coord[c][0] >= 0
+    ]
+    if not surveyed:
+      return orig[0] + default_offset[0], orig[1] + default_offset[1]
+
+    nearest = min(surveyed,
+                  key=lambda c: np.hypot(self.board.orig_coord[c][0] - orig[
+                      0], self.board.orig_coord[c][1] - orig[1]))
+    vis = self.board.get_vis_coord(nearest, z)
+    return (orig[0] + vis[0] - self.board.orig_coord[nearest][0],
+            orig[1] + vis[1] - self.board.orig_coord[nearest][1])
 
   def find_xyoffset(self, currentz):
     """
@@ -593,19 +1262,17 @@ class controlcmd():
       vis_x = None
       vis_y = None
 
-      # Trying to get the luminosity alignment with closest z value
+      # Trying to get the luminosity alignment at the current z value
       if any(self.board.lumi_coord[calibchip]):
-        closestz = self.find_closest_z(self.board.lumi_coord[calibchip],
-                                       currentz)
-        lumi_x = self.board.lumi_coord[calibchip][closestz][0]
-        lumi_y = self.board.lumi_coord[calibchip][closestz][2]
+        lumi = self.board.interp_lumi_coord(calibchip, currentz)
+        lumi_x = lumi[0]
+        lumi_y = lumi[2]
 
-      # Trying to get the visual alignment with closest z value
+      # Trying to get the visual alignment at the current z value
       if any(self.board.vis_coord[calibchip]):
-        closestz = self.find_closest_z(self.board.vis_coord[calibchip],
-                                       currentz)
-        vis_x = self.board.vis_coord[calibchip][closestz][0]
-        vis_y = self.board.vis_coord[calibchip][closestz][1]
+        vis = self.board.interp_vis_coord(calibchip, currentz)
+        vis_x = vis[0]
+        vis_y = vis[1]
 
       if lumi_x and lumi_y and vis_x and vis_y:
         return vis_x - lumi_x, vis_y - lumi_y
@@ -638,18 +1305,194 @@ class controlcmd():
                           filename,
                           flags=re.IGNORECASE)
 
-    # Opening the file using the remote file handle
-    args.savefile = self.sshfiler.remotefile(filename, args.wipefile)
+    if self.cmd.dryrun:  # Not opening files when compiling runfiles
+      args.savefile = filename
+      return
 
-  def close_savefile(self,args):
+    fmt = getattr(args, 'format', 'text')
+    compress = getattr(args, 'compress', 'none')
+    if fmt == 'text' and compress != 'none':
+      filename += datafile.COMPRESSION[compress][0]
+      args.savefile = datafile.TextWriter(
+          datafile.CompressedFile(
+              self.sshfiler.remotefile(filename, args.wipefile, binary=True),
+              compress, getattr(args, 'delta', False)), self.SAVEFILE_COLUMNS)
+    elif fmt == 'text':
+      # Opening the file using the remote file handle
+      args.savefile = datafile.TextWriter(
+          self.sshfiler.remotefile(filename, args.wipefile),
+          self.SAVEFILE_COLUMNS)
+    else:
+      args.savefile = datafile.WRITERS[fmt](filename, self.SAVEFILE_COLUMNS,
+                                            self.savefile_metadata(args),
+                                            args.wipefile)
+    if self.cmd.profiler.current:
+      args.savefile = self.cmd.wrap_device('savefile', args.savefile)
+    self.register_catalogue(args, fmt)
+
+  def register_catalogue(self, args, fmt):
+    """
+    Registering the save file in the run catalogue. Failures of the catalogue
+    are reported but do not stop the command.
+    """
+    name = args.savefile.name
+    if self.sshfiler.get_transport():
+      path = self.sshfiler.host + ':' + self.sshfiler.remotefilename(name)
+    else:
+      path = os.path.abspath(name)
+    params = {
+        key: val
+        for key, val in vars(args).items() if key != 'savefile'
+    }
+    try:
+      args.runid = self.runcatalogue.register(
+          command=self.__class__.__name__.lower(),
+          cmdline=self.__class__.__name__.lower() + ' ' + self.cmdline,
+          params=params,
+          boardtype=self.board.boardtype,
+          boardid=self.board.boardid,
+          chip=getattr(args, 'chipid', None),
+          z=getattr(args, 'scanz', None),
+          filename=name,
+          path=path,
+          fmt=fmt)
+    except Exception as err:
+      self.printwarn('Failed to register save file in catalogue: ' + str(err))
+
+  def finish_catalogue(self, args, status):
+    """
+    Updating the catalogue entry of the save file when the command finishes.
+    """
+    if getattr(args, 'runid', None) is None:
+      return
+    try:
+      self.runcatalogue.finish(args.runid, args.savefile.rows, status)
+    except Exception as err:
+      self.printwarn('Failed to update catalogue entry: ' + str(err))
+
+  def begin_run(self, line):
+    """
+    Starting the profile and the telemetry of a command run. Commands not using
+    any device, or only reading the session state, are neither profiled nor
+    reported to the telemetry.
+    """
+    self.points = 0
+    self.points_total = None
+    if self.DEVICES == [] or self.READONLY:
+      return
+    self.cmd.profiler.begin(self.__class__.__name__.lower(), line)
+    self.cmd.telemetry.publish('command_start',
+                               command=self.__class__.__name__.lower(),
+                               cmdline=line)
+    self.run_start = time.time()
+
+  def end_run(self, args, status, error=None):
+    """
+    Finishing the catalogue entry, profile and telemetry of a command run.
+    """
+    if args is not None:
+      self.finish_catalogue(args, status)
+    if self.DEVICES == [] or self.READONLY:
+      return  # Not profiled, see begin_run
+    if args is not None:
+      self.finish_profile(args, status)
+    else:
+      self.cmd.profiler.end(status)
+
+    name = self.__class__.__name__.lower()
+    self.cmd.telemetry.count('commands_total', command=name, status=status)
+    if error is not None:
+      self.cmd.telemetry.count('errors_total', source=name)
+      self.cmd.telemetry.publish('error', command=name, message=str(error))
+    self.cmd.telemetry.publish('command_end',
+                               command=name,
+                               status=status,
+                               points=self.points,
+                               duration=time.time() - self.run_start)
+    try:
+      self.cmd.telemetry.write_prometheus()
+    except Exception as err:
+      self.printwarn('Failed to export telemetry: ' + str(err))
+
+  def publish_progress(self, args, total=None, **data):
+    """
+    Publishing a measured scan point to the session telemetry, with the progress
+    relative to the number of points expected from the command arguments
+    (expected_rows), unless the total is given explicitly.
+    """
+    name = self.__class__.__name__.lower()
+    if total is None:
+      if self.points_total is None:
+        self.points_total = self.expected_rows(args) or 0
+      total = self.points_total
+    self.points += 1
+    self.cmd.telemetry.count('scan_points_total', command=name)
+    if total:
+      self.cmd.telemetry.gauge('scan_progress',
+                               min(self.points / total, 1.0),
+                               command=name)
+    self.cmd.telemetry.publish('scan_point',
+                               command=name,
+                               point=self.points,
+                               total=total,
+                               **data)
+
+  def finish_profile(self, args, status):
+    """
+    Ending the profile of the command. The profile of a command with a save
+    file is appended as a json line to <savefile>.profile.jsonl.
+    """
+    run = self.cmd.profiler.end(status)
+    if run is None or not hasattr(args, 'savefile'):
+      return
+    try:
+      self.sshfiler.writeto(args.savefile.name + '.profile.jsonl',
+                            json.dumps(run.to_json()) + '\n')
+    except Exception as err:
+      self.printwarn('Failed to write command profile: ' + str(err))
+
+  def savefile_metadata(self, args):
+    """
+    Metadata header for the columnar output files.
+    """
+    metadata = {
+        'command': self.__class__.__name__.lower(),
+        'command line': self.__class__.__name__.lower() + ' ' + self.cmdline,
+        'time': datetime.datetime.now().isoformat(),
+        'board type': self.board.boardtype,
+        'board id': self.board.boardid,
+        'chip id': getattr(args, 'chipid', None),
+    }
+    if self.readout.mode == self.readout.MODE_PICO:
+      metadata['pico'] = {
+          'range': self.pico.range,
+          'range [mV]': self.pico.rangevalue(self.pico.range),
+          'presamples': self.pico.presamples,
+          'postsamples': self.pico.postsamples,
+          'ncaptures': self.pico.ncaptures,
+          'timeinterval': self.pico.timeinterval,
+          'triggerchannel': self.pico.triggerchannel,
+          'triggerlevel': self.pico.triggerlevel,
+      }
+    return metadata
+
+  def close_savefile(self, args, verbose=True):
     """
     Close a save file with a standard message for the verbosity of run files.
+    Save files that are already closed (or never opened, when compiling
+    runfiles) are skipped, so the file is closed exactly once whether the
+    command finishes, fails or is terminated.
     """
-    if not hasattr(args, 'savefile'):
+    savefile = getattr(args, 'savefile', None)
+    if savefile is None or isinstance(savefile, str) or savefile.closed:
       return
-    self.printmsg( "Saving results to file [{0}]".format(args.savefile.name) )
+    if verbose:
+      self.printmsg("Saving results to file [{0}]".format(savefile.name))
     args.savefile.flush()
     args.savefile.close()
+    if getattr(args.savefile, 'columnar', False) and \
+       self.sshfiler.get_transport():
+      self.sshfiler.copyfile(args.savefile.name, args.savefile.name)
 
   # Helper function for globbing
   @staticmethod
@@ -3,6 +3,7 @@ import cmod.logger as log
 import time
 
 class pulse(cmdbase.controlcmd):
+  DEVICES = ['trigger']
   LOG = log.GREEN('[PULSE]')
 
   def __init__(self, cmd):
@@ -1,7 +1,17 @@
 import ctlcmd.cmdbase as cmdbase
 import cmod.logger as log
 from cmod.readout import readout
+from cmod.board import CalibTable
+from cmod.journal import Journal
+from cmod.profiler import PhaseStats
 import argparse
+import collections
+import copy
+import datetime
+import json
+import math
+import time
+import os
 import re
 
 
@@ -9,8 +19,21 @@ class set(cmdbase.controlcmd):
   """
   Setting session parameters
   """
+  ## Settings restored from the session journal. Device settings are not
+  ## replayed, as the devices are set up when the program starts.
+  JOURNAL_SETTINGS = [
+      'remotepath', 'zinterp', 'rangecache', 'catalogue', 'telemetry',
+      'promfile'
+  ]
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
+    self.parser.add_argument(
+        '-journal',
+        type=str,
+        help=('Json-lines file for journaling the calibration results and '
+              'session settings as they happen. If the file already exists, '
+              'the session is restored from the file first.'))
     self.parser.add_argument(
         '-boardtype',
         type=argparse.FileType(mode='r'),
@@ -45,8 +68,43 @@ class set(cmdbase.controlcmd):
     self.parser.add_argument('-action',
                              type=argparse.FileType(mode='r'),
                              help='List of short hands for setting user prompts')
+    self.parser.add_argument(
+        '-zinterp',
+        type=str,
+        choices=CalibTable.INTERPOLATION,
+        help=('Method for obtaining calibration values between the measured z '
+              'values'))
+    self.parser.add_argument(
+        '-rangecache',
+        type=str,
+        help=('Json file for storing the picoscope voltage range selected at '
+              'each chip and z position across sessions'))
+    self.parser.add_argument(
+        '-catalogue',
+        type=str,
+        help=('SQLite file of the catalogue of produced data files (default: '
+              '~/.sipmcalib_catalogue.db)'))
+    self.parser.add_argument(
+        '-telemetry',
+        type=str,
+        help=('JSON-lines file that the telemetry events (scan progress, '
+              'command results and errors) are appended to'))
+    self.parser.add_argument(
+        '-promfile',
+        type=str,
+        help=('Prometheus textfile for exporting the telemetry metrics, '
+              'rewritten every 15 seconds. Should be placed in the directory '
+              'of the node exporter textfile collector.'))
+
+  def plan(self, args):
+    ## Only the board type affects the validity of later commands
+    if args.boardtype:
+      with open(args.boardtype.name, 'r') as f:
+        self.board.set_boardtype_json(json.load(f))
 
   def run(self, args):
+    if args.journal:
+      self.set_journal(args)
     if args.boardtype:
       self.set_board(args)
     if args.camdev:
@@ -63,6 +121,74 @@ class set(cmdbase.controlcmd):
       self.readout.set_mode(args.readout)
     if args.action:
       self.action.add_json(args.action.name)
+    if args.rangecache:
+      self.set_rangecache(args)
+    if args.zinterp:
+      self.board.interpolation = args.zinterp
+    if args.catalogue:
+      self.set_catalogue(args)
+    if args.telemetry:
+      self.set_telemetry(args)
+    if args.promfile:
+      self.set_promfile(args)
+
+    for name in set.JOURNAL_SETTINGS:
+      if getattr(args, name):
+        self.cmd.journal.record('setting', name=name, value=getattr(args, name))
+
+  def device_tasks(self, args):
+    """
+    Taking the device settings out of the parsed arguments, returned as
+    (device, function) pairs for the parallel initialization of the devices
+    with controlterm.init_devices. The functions return False if the device
+    could not be set up. The remaining settings are applied with run.
+    The readout mode is set after the picoscope is initialized, as the
+    picoscope readout requires an opened device.
+    """
+    devargs = copy.copy(args)
+    tasks = []
+    if args.printerdev:
+      tasks.append(('gcoder', lambda: self.set_printer(devargs)))
+    if args.camdev:
+      tasks.append(('visual', lambda: self.set_camera(devargs)))
+    if args.picodevice or args.readout:
+      tasks.append(('pico', lambda: self.set_pico_readout(devargs)))
+    args.printerdev = args.camdev = args.picodevice = args.readout = None
+    return tasks
+
+  def set_pico_readout(self, args):
+    if args.picodevice and self.set_picodevice(args) is False:
+      return False
+    if args.readout:
+      self.readout.set_mode(args.readout)
+
+  def set_journal(self, args):
+    try:
+      if os.path.isfile(args.journal):
+        n = Journal.replay(args.journal, self.board, self.apply_setting)
+        log.printmsg(log.GREEN('[JOURNAL]'),
+                     'Restored {0:d} entries from [{1}]'.format(n, args.journal))
+      self.cmd.journal.open(args.journal)
+    except Exception as err:
+      log.printerr(str(err))
+      log.printwarn('Failed to open session journal, skipping over setting')
+
+  def apply_setting(self, name, value):
+    """
+    Applying a session setting restored from the journal.
+    """
+    if name == 'remotepath':
+      self.sshfiler.setremotepath(value)
+    elif name == 'zinterp':
+      self.board.interpolation = value
+    elif name == 'rangecache':
+      self.rangectrl.set_cachefile(value)
+    elif name == 'catalogue':
+      self.runcatalogue.open(value)
+    elif name == 'telemetry':
+      self.cmd.telemetry.open_json(value)
+    elif name == 'promfile':
+      self.cmd.telemetry.set_promfile(value)
 
   def set_board(self, args):
     try:
@@ -79,6 +205,7 @@ class set(cmdbase.controlcmd):
     except Exception as err:
       log.printerr(str(err))
       log.printwarn('Initializing webcam has failed, skipping over setting')
+      return False
 
   def set_printer(self, args):
     if args.printerdev == self.gcoder.dev_path:
@@ -92,6 +219,7 @@ class set(cmdbase.controlcmd):
     except Exception as err:
       log.printerr(str(err))
       log.printwarn('Failed to setup printer, skipping over settings')
+      return False
 
   def set_host(self, args):
     try:
@@ -100,18 +228,49 @@ class set(cmdbase.controlcmd):
       log.printerr(str(err))
       log.printwarn('Failed to establish connection remote host')
 
+  def set_rangecache(self, args):
+    try:
+      self.rangectrl.set_cachefile(args.rangecache)
+    except Exception as err:
+      log.printerr(str(err))
+      log.printwarn('Failed to load voltage range cache, skipping over setting')
+
+  def set_catalogue(self, args):
+    try:
+      self.runcatalogue.open(args.catalogue)
+    except Exception as err:
+      log.printerr(str(err))
+      log.printwarn('Failed to open data file catalogue, skipping over setting')
+
+  def set_telemetry(self, args):
+    try:
+      self.cmd.telemetry.open_json(args.telemetry)
+    except Exception as err:
+      log.printerr(str(err))
+      log.printwarn('Failed to open telemetry file, skipping over setting')
+
+  def set_promfile(self, args):
+    try:
+      self.cmd.telemetry.set_promfile(args.promfile)
+    except Exception as err:
+      log.printerr(str(err))
+      log.printwarn('Failed to write Prometheus textfile, skipping over setting')
+
   def set_picodevice(self, args):
     try:
       self.pico.init()
     except Exception as err:
       log.printerr(str(err))
       log.printwarn('Picoscope device is not properly set!')
+      return False
 
 
 class get(cmdbase.controlcmd):
   """
   Printing out the session parameters, and equipment settings.
   """
+  READONLY = True
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.parser.add_argument('--boardtype', action='store_true')
@@ -206,6 +365,8 @@ class getcoord(cmdbase.controlcmd):
   """
   Printing current gantry coordinates
   """
+  DEVICES = ['gcoder']
+  READONLY = True
   LOG = log.GREEN('[GANTRY-COORD]')
 
   def __init__(self, cmd):
@@ -220,6 +381,7 @@ class savecalib(cmdbase.controlcmd):
   """
   Saving current calibration information into a json file
   """
+  DEVICES = []
   LOG = log.GREEN('[SAVE_CALIB]')
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
@@ -245,6 +407,9 @@ class loadcalib(cmdbase.controlcmd):
   """
   Loading calibration information from a json file
   """
+
+  DEVICES = []
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.parser.add_argument(
@@ -259,6 +424,10 @@ class loadcalib(cmdbase.controlcmd):
       raise Exception('Filename must be specified')
     return args
 
+  def plan(self, args):
+    with open(args.file.name, 'r') as f:
+      self.board.load_calib_json(json.load(f))
+
   def run(self, args):
     self.board.load_calib_file(args.file.name)
 
@@ -267,6 +436,9 @@ class lighton(cmdbase.controlcmd):
   """
   Turning the LED lights on.
   """
+
+  DEVICES = ['trigger']
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
 
@@ -278,6 +450,9 @@ class lightoff(cmdbase.controlcmd):
   """
   Turning the LED lights on.
   """
+
+  DEVICES = ['trigger']
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
 
@@ -289,6 +464,9 @@ class promptaction(cmdbase.controlcmd):
   """
   Displaying message that requires manual intervention.
   """
+
+  DEVICES = []
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.parser.add_argument(
@@ -334,3 +512,255 @@ class promptaction(cmdbase.controlcmd):
       self.check_handle(args)
       input_text = input(
           log.GREEN('    TYPE [%s] to continue...') % args.string[0])
+
+
+class transfers(cmdbase.controlcmd):
+  """
+  Displaying the status of the background uploads to the remote host.
+  """
+
+  DEVICES = []
+  LOG = log.GREEN('[TRANSFERS]')
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.parser.add_argument('--wait',
+                             action='store_true',
+                             help=('Continuously updating the status until '
+                                   'all uploads are finished'))
+    self.parser.add_argument('--clear',
+                             action='store_true',
+                             help='Clearing the list of finished uploads')
+
+  def run(self, args):
+    if args.clear:
+      self.sshfiler.history.clear()
+
+    if args.wait:
+      self.init_handle()
+      while not self.sshfiler.wait_uploads(0.5):
+        self.check_handle(args)
+        self.update(' | '.join(
+            self.status_str(t) for t in self.sshfiler.transfers.values()))
+
+    records = self.sshfiler.transfer_status()
+    if not records:
+      self.printmsg('No uploads in this session')
+    for record in records:
+      self.printmsg(self.status_str(record) + ' | ' + record.remote)
+      if record.error and record.state != 'done':
+        self.printmsg('  last error: ' + record.error)
+
+  @staticmethod
+  def status_str(record):
+    progress = 100.0 * record.done / record.size if record.size else 0
+    return '{0:>9s} {1:5.1f}% {2:7.2f}MB/s x{3:d}'.format(
+        record.state, progress, record.rate() / 1e6, record.channels)
+
+
+class catalogue(cmdbase.controlcmd):
+  """
+  Listing the data files registered in the run catalogue, newest first.
+  """
+
+  DEVICES = []
+  LOG = log.GREEN('[CATALOGUE]')
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.parser.add_argument('--command',
+                             type=str,
+                             help='Command that produced the file')
+    self.parser.add_argument('-c', '--chipid', type=str, help='Chip ID')
+    self.parser.add_argument('-z',
+                             type=float,
+                             help='Scan z position (for horizontal scans)')
+    self.parser.add_argument('--boardid', type=str, help='Board ID')
+    self.parser.add_argument('--status',
+                             type=str,
+                             choices=['running', 'done', 'failed'],
+                             help='Status of the command producing the file')
+    self.parser.add_argument('--since',
+                             type=str,
+                             help=('Earliest start time, either as a date '
+                                   '"YYYY-MM-DD[_HH:MM]" or relative to now '
+                                   'like "12h" or "7d"'))
+    self.parser.add_argument('--until',
+                             type=str,
+                             help='Latest start time, same format as --since')
+    self.parser.add_argument('--limit',
+                             type=int,
+                             default=20,
+                             help='Maximum number of entries (0 for all)')
+    self.parser.add_argument('--paths',
+                             action='store_true',
+                             help='Only printing the file paths')
+
+  def parse(self, line):
+    args = cmdbase.controlcmd.parse(self, line)
+    args.since = catalogue.parse_time(args.since)
+    args.until = catalogue.parse_time(args.until)
+    return args
+
+  @staticmethod
+  def parse_time(string):
+    if string is None:
+      return None
+    match = re.match(r'^(\d+(?:\.\d*)?)([mhd])$', string)
+    if match:
+      unit = {'m': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+      return time.time() - float(match.group(1)) * unit
+    for fmt in ['%Y-%m-%d_%H:%M', '%Y-%m-%d']:
+      try:
+        return datetime.datetime.strptime(string, fmt).timestamp()
+      except ValueError:
+        pass
+    raise Exception('Unrecognized time format: ' + string)
+
+  def run(self, args):
+    entries = self.runcatalogue.query(command=args.command,
+                                      chip=args.chipid,
+                                      z=args.z,
+                                      boardid=args.boardid,
+                                      since=args.since,
+                                      until=args.until,
+                                      status=args.status,
+                                      limit=args.limit)
+    if args.paths:
+      for entry in entries:
+        log.printmsg(entry['path'])
+      return
+    if not entries:
+      self.printmsg('No matching entries in [{0}]'.format(
+          self.runcatalogue.filename))
+    for entry in entries:
+      start = datetime.datetime.fromtimestamp(entry['start'])
+      duration = (entry['end'] or time.time()) - entry['start']
+      self.printmsg(('{0:5d} | {1} | {2:>12s} | chip:{3:>4s} | z:{4:>5s} | '
+                     '{5:>7s} | {6:6d} rows | {7:7.1f}s | {8}').format(
+                         entry['id'], start.strftime('%Y-%m-%d %H:%M'),
+                         entry['command'], str(entry['chip']),
+                         '' if entry['z'] is None else
+                         '{0:.1f}'.format(entry['z']), entry['status'],
+                         entry['rows'], duration, entry['path']))
+
+
+class profile(cmdbase.controlcmd):
+  """
+  Displaying the per-phase timing of the commands. While profiling is enabled,
+  the time spent in the gantry motion, data acquisition, image processing and
+  save file writing is accumulated for each command run, with the remaining
+  time listed as other. The profile of commands writing a save file is also
+  appended to <savefile>.profile.jsonl.
+  """
+
+  DEVICES = []
+  LOG = log.GREEN('[PROFILE]')
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.parser.add_argument('--enable',
+                             action='store_true',
+                             help='Enabling the profiling of commands')
+    self.parser.add_argument('--disable',
+                             action='store_true',
+                             help='Disabling the profiling of commands')
+    self.parser.add_argument('--command',
+                             type=str,
+                             help=('Summing the profiles of all stored runs of '
+                                   'a command'))
+    self.parser.add_argument('--runs',
+                             type=int,
+                             default=1,
+                             help='Number of latest runs to display')
+    self.parser.add_argument('--histogram',
+                             action='store_true',
+                             help='Displaying the latency histogram of phases')
+    self.parser.add_argument('--clear',
+                             action='store_true',
+                             help='Clearing the stored profiles')
+
+  def run(self, args):
+    profiler = self.cmd.profiler
+    if args.enable:
+      profiler.enabled = True
+    if args.disable:
+      profiler.enabled = False
+    if args.clear:
+      profiler.history.clear()
+    self.printmsg('Profiling is {0}'.format(
+        'enabled' if profiler.enabled else 'disabled'))
+
+    runs = profiler.runs(args.command)
+    if not runs:
+      self.printmsg('No profiled command runs')
+      return
+    if args.command:
+      phases = collections.defaultdict(PhaseStats)
+      for run in runs:
+        for name, stats in run.phases.items():
+          phases[name].merge(stats)
+      self.show_profile('{0} ({1:d} runs)'.format(args.command, len(runs)),
+                        sum(x.wall for x in runs), phases,
+                        sum(x.other() for x in runs), args.histogram)
+    else:
+      for run in runs[-args.runs:]:
+        self.show_profile('{0} {1} [{2}]'.format(run.command, run.cmdline,
+                                                 run.status), run.wall,
+                          run.phases, run.other(), args.histogram)
+
+  def show_profile(self, title, wall, phases, other, histogram):
+    self.printmsg('{0} | {1:.2f}s'.format(title, wall))
+    for name in sorted(phases, key=lambda x: -phases[x].total):
+      stats = phases[name]
+      self.printmsg(('{0:>12s} | {1:7d} calls | {2:8.2f}s | {3:5.1f}% | '
+                     'mean {4:8.2f}ms | p90 {5:8.2f}ms | max {6:8.2f}ms').format(
+                         name, stats.calls, stats.total,
+                         100 * stats.total / wall if wall else 0,
+                         1e3 * stats.mean, 1e3 * stats.quantile(0.9),
+                         1e3 * stats.max))
+      if histogram:
+        for exponent in sorted(stats.hist):
+          count = stats.hist[exponent]
+          self.printmsg('{0:>12s}   < {1:9.3f}ms | {2:7d} | {3}'.format(
+              '', 1e3 * 2.0**exponent, count,
+              '#' * int(math.ceil(40 * count / stats.calls))))
+    self.printmsg('{0:>12s} | {1:>13s} | {2:8.2f}s | {3:5.1f}%'.format(
+        'other', '', other, 100 * other / wall if wall else 0))
+
+
+class showtelemetry(cmdbase.controlcmd):
+  """
+  Displaying the session telemetry: the exported metrics and the latest events
+  in the telemetry ring buffer.
+  """
+
+  DEVICES = []
+  LOG = log.GREEN('[TELEMETRY]')
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.parser.add_argument('--events',
+                             type=int,
+                             default=10,
+                             help='Number of latest events to display')
+    self.parser.add_argument('--type',
+                             type=str,
+                             help=('Only displaying events of a type '
+                                   '(scan_point, command_start, command_end, '
+                                   'error)'))
+
+  def run(self, args):
+    telemetry = self.cmd.telemetry
+    for (name, labels), value in sorted(telemetry.snapshot().items()):
+      self.printmsg('{0:>28s} {1:<36s} {2:g}'.format(
+          name, ','.join('{0}={1}'.format(k, v) for k, v in labels), value))
+    events = telemetry.recent(args.type)
+    for event in events[-args.events:] if args.events else []:
+      data = {k: v for k, v in event.items() if k not in ['time', 'event']}
+      self.printmsg('{0} | {1:>13s} | {2}'.format(
+          datetime.datetime.fromtimestamp(event['time']).strftime('%H:%M:%S'),
+          event['event'], json.dumps(data, default=str)))
+    self.printmsg('JSON lines: [{0}], Prometheus textfile: [{1}]'.format(
+        telemetry.jsonfile.name if telemetry.jsonfile else 'none',
+        telemetry.promfile or 'none'))
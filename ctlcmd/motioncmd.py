@@ -1,7 +1,7 @@
 import ctlcmd.cmdbase as cmdbase
 import cmod.logger as log
+import cmod.fitting as fitting
 import numpy as np
-from scipy.optimize import curve_fit
 import time
 
 
@@ -10,6 +10,9 @@ class moveto(cmdbase.controlcmd):
   Moving the gantry head to a specific location, either by chip ID or by raw
   x-y-z coordinates. Units for the x-y-z inputs is millimeters.
   """
+
+  DEVICES = ['gcoder']
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.add_xychip_options()
@@ -33,6 +36,9 @@ class movespeed(cmdbase.controlcmd):
   """
   Setting the motion speed of the gantry x-y-z motors. Units in mm/s.
   """
+
+  DEVICES = ['gcoder']
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.parser.add_argument('-x',
@@ -67,8 +73,16 @@ class halign(cmdbase.controlcmd):
   range... etc. You will still need the picoset command.
   """
 
+  DEVICES = ['gcoder', 'pico']
   DEFAULT_SAVEFILE = 'halign_<CHIPID>_<SCANZ>_<TIMESTAMP>.txt'
   LOG = log.GREEN('[LUMI ALIGN]')
+  SAVEFILE_COLUMNS = [
+      ('x', 'f4', '{0:5.1f}'),
+      ('y', 'f4', '{0:5.1f}'),
+      ('z', 'f4', '{0:5.1f}'),
+      ('lumi', 'f8', '{0:8.5f}'),
+      ('unc', 'f8', '{0:8.6f}'),
+  ]
 
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
@@ -78,6 +92,42 @@ class halign(cmdbase.controlcmd):
                              action='store_true',
                              help=('Forcing the storage of scan results as '
                                    'session information'))
+    self.parser.add_argument('--strategy',
+                             type=str,
+                             choices=['mesh', 'adaptive'],
+                             default='mesh',
+                             help=('Scanning strategy: mesh scans the full '
+                                   'dense mesh, adaptive fits a coarse mesh '
+                                   'first and only scans the dense mesh near '
+                                   'the fitted center'))
+    self.parser.add_argument('--coarsedistance',
+                             type=float,
+                             default=4,
+                             help=('Sampling distance of the coarse mesh for '
+                                   'the adaptive strategy [mm]'))
+    self.parser.add_argument('--nsigma',
+                             type=float,
+                             default=5,
+                             help=('Range of the dense mesh around the coarse '
+                                   'fit center for the adaptive strategy, in '
+                                   'units of the fitted center uncertainty'))
+    self.parser.add_argument('--onlinefit',
+                             type=int,
+                             default=0,
+                             help=('Refit the collected data every N points, '
+                                   'stopping the scan once the fitted center '
+                                   'uncertainty is below the tolerance. The '
+                                   'mesh is scanned from the center outwards. '
+                                   'Set to 0 to disable'))
+    self.parser.add_argument('--tolerance',
+                             type=float,
+                             default=0.05,
+                             help=('Target uncertainty of the fitted x-y '
+                                   'center for the online fit [mm]'))
+
+    ## Fit results of the session by chip id, as (scanz, fit parameters), used
+    ## to warm-start subsequent fits.
+    self.fit_cache = {}
 
   def parse(self, line):
     args = cmdbase.controlcmd.parse(self, line)
@@ -86,14 +136,70 @@ class halign(cmdbase.controlcmd):
     self.parse_savefile(args)
     return args
 
+  def plan(self, args):
+    if not args.chipid in self.board.visM and int(args.chipid) < 0:
+      self.board.add_calib_chip(args.chipid)
+    self.board.add_lumi_coord(args.chipid, args.scanz, [args.x, 0, args.y, 0])
+
+  def expected_rows(self, args):
+    if args.strategy == 'mesh':
+      return len(self.make_hscan_mesh(args)[0])
+    return None
+
   def run(self, args):
     self.init_handle()
-    x, y = self.make_hscan_mesh(args)
+    if args.strategy == 'adaptive':
+      x, y, lumi, unc = self.scan_adaptive(args)
+    else:
+      x, y = self.make_hscan_mesh(args)
+      x, y, lumi, unc = self.scan_points(args, x, y)
+
+    self.close_savefile(args)
+    fitval, fitcovar = self.fit(args, x, y, lumi, unc)
+
+    self.printmsg('Best x:{0:.2f}+-{1:.3f}'.format(fitval[1],
+                                                   np.sqrt(fitcovar[1][1])))
+    self.printmsg('Best y:{0:.2f}+-{1:.3f}'.format(fitval[2],
+                                                   np.sqrt(fitcovar[2][2])))
+    self.printmsg('Fit  z:{0:.2f}+-{1:.3f}'.format(fitval[3],
+                                                   np.sqrt(fitcovar[3][3])))
+
+    ## Generating calibration chip id if using chip coordinates
+    if not args.chipid in self.board.visM and int(args.chipid) < 0:
+      self.board.add_calib_chip(args.chipid)
+
+    ## Saving session information
+    result = [
+        fitval[1],
+        np.sqrt(fitcovar[1][1]), fitval[2],
+        np.sqrt(fitcovar[2][2])
+    ]
+    if (not self.board.lumi_coord_hasz(args.chipid, args.scanz)
+        or args.overwrite):
+      self.board.add_lumi_coord(args.chipid, args.scanz, result)
+    elif self.cmd.prompt(('A lumi alignment for z={0:.1f} already exists for '
+                          'the current session, overwrite?').format(args.scanz)):
+      self.board.add_lumi_coord(args.chipid, args.scanz, result)
+
+    ## Sending gantry to position
+    self.move_gantry(fitval[1], fitval[2], args.scanz, True)
+
+  def scan_points(self, args, x, y):
+    """
+    Collecting the readout over a list of x-y points, writing each point to the
+    save file. If the online fit is enabled, the points are visited from the
+    center outwards and the scan stops once the fitted center is precise
+    enough. Returns the x, y coordinates actually visited alongside the
+    absolute readout values and uncertainties.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if args.onlinefit > 0 and len(x):
+      order = np.argsort(np.hypot(x - np.mean(x), y - np.mean(y)), kind='stable')
+      x, y = x[order], y[order]
+
     lumi = []
     unc = []
-    total = len(x)
-
-    ## Running over mesh.
     for idx, (xval, yval) in enumerate(zip(x, y)):
       self.check_handle(args)
       self.move_gantry(xval, yval, args.scanz, False)
@@ -105,67 +211,306 @@ class halign(cmdbase.controlcmd):
           'x:{0:5.1f}, y:{1:5.1f}, z:{2:5.1f}'.format(xval, yval, args.scanz),
           'Lumi:{0:8.5f}+-{1:8.6f}'.format(lumival, uncval),
           'Progress [{0:3d}/{1:3d}]'.format(idx+1, len(x))))
+      self.publish_progress(args,
+                            x=xval,
+                            y=yval,
+                            z=args.scanz,
+                            lumi=lumival,
+                            unc=uncval)
       ## Writing to file
-      args.savefile.write(
-          '{0:5.1f} {1:5.1f} {2:5.1f} {3:8.5f} {4:8.6f}\n'.format(
-              xval, yval, args.scanz, lumival, uncval))
+      args.savefile.write_row(xval, yval, args.scanz, lumival, uncval)
+
+      if (args.onlinefit > 0 and (idx + 1) % args.onlinefit == 0
+          and self.online_converged(args, x[:idx + 1], y[:idx + 1], lumi, unc)):
+        self.printmsg(('Online fit converged after {0:d}/{1:d} points, '
+                       'stopping scan').format(idx + 1, len(x)))
+        return x[:idx + 1], y[:idx + 1], lumi, unc
+
+    return x, y, lumi, unc
+
+  def online_converged(self, args, x, y, lumi, unc):
+    """
+    Checking whether the fit to the partially collected data has a center
+    uncertainty below the tolerance. The fitted center is also required to lie
+    within the scanned region, so that the peak is bracketed by data points.
+    Failed fits are treated as not converged.
+    """
+    if len(x) <= 5:
+      return False
+    try:
+      fitval, fitcovar = fitting.fit_halign(
+          x, y, lumi, unc, self.initial_guess(args, x, y, lumi))
+    except Exception:
+      return False
+
+    if not (np.min(x) <= fitval[1] <= np.max(x) and
+            np.min(y) <= fitval[2] <= np.max(y)):
+      return False
+    return (np.sqrt(fitcovar[1][1]) < args.tolerance and
+            np.sqrt(fitcovar[2][2]) < args.tolerance)
+
+  def scan_adaptive(self, args):
+    """
+    Coarse-to-fine scan: a sparse grid over the full range is used to fit the
+    source position, then a dense grid is only collected within a few sigma of
+    the fitted center. Both sets of points are used for the final fit. If the
+    coarse fit fails, the dense grid over the full range is collected instead.
+    """
+    x, y = self.make_hscan_mesh(args, distance=args.coarsedistance)
+    x, y, lumi, unc = self.scan_points(args, x, y)
+    try:
+      fitval, fitcovar = fitting.fit_halign(
+          x, y, lumi, unc, self.initial_guess(args, x, y, lumi))
+      center = np.array([fitval[1], fitval[2]])
+      sigma = max(np.sqrt(fitcovar[1][1]), np.sqrt(fitcovar[2][2]))
+      if not (np.all(np.isfinite(center)) and np.isfinite(sigma)):
+        raise Exception('Non-finite fit result')
+    except Exception as err:
+      self.printwarn(('Coarse fit failed ({0}), falling back to the dense mesh '
+                      'over the full range').format(str(err)))
+      center, refine = np.array([args.x, args.y]), args.range
+    else:
+      refine = min(max(args.nsigma * sigma, 2 * args.distance), args.range)
+    finex, finey = self.make_hscan_mesh(args,
+                                        x=center[0],
+                                        y=center[1],
+                                        hrange=refine)
+
+    ## Skipping points that were already collected in the coarse scan
+    collected = set(zip(np.round(x, 1), np.round(y, 1)))
+    fine = [(xval, yval) for xval, yval in zip(finex, finey)
+            if not (round(xval, 1), round(yval, 1)) in collected]
+    finex = np.array([p[0] for p in fine])
+    finey = np.array([p[1] for p in fine])
+    finex, finey, finelumi, fineunc = self.scan_points(args, finex, finey)
+
+    self.printmsg('Coarse points: {0:d}, refined points: {1:d} (+-{2:.2f}mm)'.
+                  format(len(x), len(finex), refine))
+    return (np.concatenate((x, finex)), np.concatenate(
+        (y, finey)), lumi + finelumi, unc + fineunc)
+
+  def fit(self, args, x, y, lumi, unc):
+    """
+    Fitting the collected data to the light model, moving the gantry back to
+    the scan center if the fit fails.
+    """
+    p0 = self.initial_guess(args, x, y, lumi)
+    try:
+      fitval, fitcovar = fitting.fit_halign(x, y, lumi, unc, p0)
+    except Exception as err:
+      self.printerr(('Lumi fit failed to converge, check output stored in file '
+                     '{0} for collected values').format(args.savefile.name))
+      self.gcoder.moveto(args.x, args.y, args.scanz, False)
+      raise err
+    self.fit_cache[args.chipid] = (args.scanz, fitval)
+    return fitval, fitcovar
+
+  def initial_guess(self, args, x, y, lumi):
+    """
+    Starting parameters for the fit. The fit of the same chip at a previous z
+    is used if available, otherwise the fit of the nearest chip shifted by the
+    difference in the original chip coordinates. If no fit exists in the
+    session, the guess is made from the data alone.
+    """
+    guess = list(fitting.halign_guess(x, y, lumi, args.scanz))
+    orig = self.board.orig_coord
+
+    # Raw x-y scans are not associated with a chip position
+    if not args.chipid in orig:
+      return guess
+
+    if args.chipid in self.fit_cache:
+      prevz, prev = self.fit_cache[args.chipid]
+      dx, dy = 0, 0
+    else:
+      others = [c for c in self.fit_cache if c in orig]
+      if not others:
+        return guess
+      nearest = min(others,
+                    key=lambda c: np.hypot(orig[c][0] - orig[args.chipid][0],
+                                           orig[c][1] - orig[args.chipid][1]))
+      prevz, prev = self.fit_cache[nearest]
+      dx = orig[args.chipid][0] - orig[nearest][0]
+      dy = orig[args.chipid][1] - orig[nearest][1]
+
+    # Keeping the fitted offset between the gantry and the source height.
+    return [
+        prev[0], prev[1] + dx, prev[2] + dy, prev[3] + args.scanz - prevz,
+        guess[4]
+    ]
+
+  @staticmethod
+  def model(xydata, N, x0, y0, z, p):
+    return fitting.halign_model(xydata, N, x0, y0, z, p)
+
+
+class halign3d(cmdbase.controlcmd):
+  """
+  Joint horizontal alignment over several heights. Rather than a full mesh per
+  height, each height is sampled with an interleaved subset of the x-y mesh,
+  and a single model with a shared source position, a linear drift of the
+  source position with height and a per-height pedestal is fitted to the full
+  point cloud. The lumi alignment result is stored for every requested height.
+  """
+
+  DEVICES = ['gcoder', 'pico']
+  DEFAULT_SAVEFILE = 'halign3d_<CHIPID>_<TIMESTAMP>.txt'
+  LOG = log.GREEN('[LUMI ALIGN3D]')
+  SAVEFILE_COLUMNS = halign.SAVEFILE_COLUMNS
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.add_zscan_options(zlist=[10, 20, 30, 40, 50])
+    self.add_savefile_options(halign3d.DEFAULT_SAVEFILE)
+    self.parser.add_argument('-r',
+                             '--range',
+                             type=float,
+                             default=10,
+                             help=('Range to perform x-y scanning from central '
+                                   'position [mm]'))
+    self.parser.add_argument('-d',
+                             '--distance',
+                             type=float,
+                             default=2,
+                             help='Horizontal sampling distance [mm]')
+    self.parser.add_argument('--stride',
+                             type=int,
+                             default=3,
+                             help=('Only one in every N mesh points is scanned '
+                                   'at each height, with the selected points '
+                                   'shifted from one height to the next'))
+    self.parser.add_argument('--overwrite',
+                             action='store_true',
+                             help=('Forcing the storage of scan results as '
+                                   'session information'))
+
+  def parse(self, line):
+    args = cmdbase.controlcmd.parse(self, line)
+    self.parse_readout_options(args)
+    self.parse_zscan_options(args)
+    self.parse_xychip_options(args)
+    self.parse_savefile(args)
+    if len(args.zlist) < 2:
+      raise Exception('At least 2 heights are required for the joint fit')
+    if args.stride < 1:
+      raise Exception('Stride must be a positive integer')
+    return args
+
+  def plan(self, args):
+    if not args.chipid in self.board.visM and int(args.chipid) < 0:
+      self.board.add_calib_chip(args.chipid)
+    for zval in args.zlist:
+      self.board.add_lumi_coord(args.chipid, zval, [args.x, 0, args.y, 0])
+
+  def expected_rows(self, args):
+    return len(self.make_cloud(args)[0])
+
+  def run(self, args):
+    self.init_handle()
+    x, y, z = self.make_cloud(args)
+    lumi = []
+    unc = []
+
+    for idx, (xval, yval, zval) in enumerate(zip(x, y, z)):
+      self.check_handle(args)
+      self.move_gantry(xval, yval, zval, False)
+      lumival, uncval = self.readout.read(channel=args.channel,
+                                          samples=args.samples)
+      lumi.append(abs(lumival))
+      unc.append(uncval)
+      self.update('{0} | {1} | {2}'.format(
+          'x:{0:5.1f}, y:{1:5.1f}, z:{2:5.1f}'.format(xval, yval, zval),
+          'Lumi:{0:8.5f}+-{1:8.6f}'.format(lumival, uncval),
+          'Progress [{0:3d}/{1:3d}]'.format(idx+1, len(x))))
+      self.publish_progress(args,
+                            x=xval,
+                            y=yval,
+                            z=zval,
+                            lumi=lumival,
+                            unc=uncval)
+      args.savefile.write_row(xval, yval, zval, lumival, uncval)
 
     self.close_savefile(args)
 
-    # Performing fit
-    p0 = (max(lumi) * (args.scanz**2), args.x, args.y, args.scanz, min(lumi))
+    zref = np.mean(args.zlist)
     try:
-      fitval, fitcovar = curve_fit(halign.model,
-                                   np.vstack((x, y)),
-                                   lumi,
-                                   p0=p0,
-                                   sigma=unc,
-                                   maxfev=10000)
+      fitval, fitcovar, zvals = fitting.fit_halign3d(
+          x, y, z, lumi, unc, self.initial_guess(x, y, z, lumi, zref), zref)
     except Exception as err:
       self.printerr(('Lumi fit failed to converge, check output stored in file '
                      '{0} for collected values').format(args.savefile.name))
-      self.gcoder.moveto(args.x, args.y, args.scanz, False)
+      self.gcoder.moveto(args.x, args.y, min(args.zlist), False)
       raise err
 
-    self.printmsg('Best x:{0:.2f}+-{1:.3f}'.format(fitval[1],
-                                                   np.sqrt(fitcovar[1][1])))
-    self.printmsg('Best y:{0:.2f}+-{1:.3f}'.format(fitval[2],
-                                                   np.sqrt(fitcovar[2][2])))
-    self.printmsg('Fit  z:{0:.2f}+-{1:.3f}'.format(fitval[3],
-                                                   np.sqrt(fitcovar[3][3])))
+    self.printmsg('Scanned points: {0:d}'.format(len(x)))
+    self.printmsg('Tilt x:{0:.4f}+-{1:.4f}, y:{2:.4f}+-{3:.4f}'.format(
+        fitval[4], np.sqrt(fitcovar[4][4]), fitval[5],
+        np.sqrt(fitcovar[5][5])))
 
     ## Generating calibration chip id if using chip coordinates
     if not args.chipid in self.board.visM and int(args.chipid) < 0:
       self.board.add_calib_chip(args.chipid)
 
-    ## Saving session information
-    if (not args.chipid in self.board.lumi_coord
-        or not args.scanz in self.board.lumi_coord[args.chipid]
-        or args.overwrite):
-      if not args.chipid in self.board.lumi_coord:
-        self.board.lumi_coord[args.chipid] = {}
-      self.board.lumi_coord[args.chipid][args.scanz] = [
-          fitval[1],
-          np.sqrt(fitcovar[1][1]), fitval[2],
-          np.sqrt(fitcovar[1][1])
-      ]
-    elif args.scanz in self.board.lumi_coord[args.chipid]:
-      if self.cmd.prompt(('A lumi alignment for z={0:.1f} already exists for '
-                          'the current session, overwrite?').format(args.scanz)):
-        self.board.lumi_coord[args.chipid][args.scanz] = [
-            fitval[1],
-            np.sqrt(fitcovar[1][1]), fitval[2],
-            np.sqrt(fitcovar[1][1])
-        ]
+    results = {
+        float(zval): fitting.halign3d_center(fitval, fitcovar, zval, zref)
+        for zval in zvals
+    }
+    for zval, center in results.items():
+      self.printmsg('z:{0:5.1f} | x:{1:.2f}+-{2:.3f} y:{3:.2f}+-{4:.3f}'.format(
+          zval, *center))
 
-    ## Sending gantry to position
-    self.move_gantry(fitval[1], fitval[2], args.scanz, True)
+    ## Saving session information
+    existing = [
+        zval for zval in results
+        if self.board.lumi_coord_hasz(args.chipid, zval)
+    ]
+    if (not existing or args.overwrite or self.yn_prompt(
+        ('A lumi alignment already exists for z={0} in the current session, '
+         'overwrite?').format(', '.join('{0:.1f}'.format(z)
+                                        for z in existing)))):
+      for zval, center in results.items():
+        self.board.add_lumi_coord(args.chipid, zval, center)
+    else:
+      for zval, center in results.items():
+        if not zval in existing:
+          self.board.add_lumi_coord(args.chipid, zval, center)
+
+    ## Sending gantry to position of the lowest height
+    zmin = min(results)
+    self.move_gantry(results[zmin][0], results[zmin][2], zmin, True)
+
+  def make_cloud(self, args):
+    """
+    Sparse x-y-z sampling points. The mesh point (i, j) is scanned at the k-th
+    height if (i + j + k) is divisible by the stride, so the union of all
+    heights covers the full x-y mesh. The mesh is traversed in a serpentine
+    order at each height to reduce the gantry travel.
+    """
+    x, y = self.make_hscan_mesh(args)
+    xvals = np.unique(x)
+    yvals = np.unique(y)
+    cloud = []
+    for k, zval in enumerate(args.zlist):
+      for j, yval in enumerate(yvals):
+        row = [(xval, yval, zval) for i, xval in enumerate(xvals)
+               if (i + j + k) % args.stride == 0]
+        cloud.extend(row if j % 2 == 0 else row[::-1])
+    cloud = np.array(cloud)
+    return cloud[:, 0], cloud[:, 1], cloud[:, 2]
 
   @staticmethod
-  def model(xydata, N, x0, y0, z, p):
-    x, y = xydata
-    D = (x - x0)**2 + (y - y0)**2 + z**2
-    return (N * z / D**1.5) + p
+  def initial_guess(x, y, z, lumi, zref):
+    """
+    Starting parameters from the data alone: the brightest point at each height
+    gives the source position, and the lowest height is used for the
+    normalization.
+    """
+    zvals = np.unique(z)
+    pedestal = [np.min(np.asarray(lumi)[z == zval]) for zval in zvals]
+    mask = z == zvals[0]
+    N, x0, y0, _, _ = fitting.halign_guess(x[mask], y[mask],
+                                            np.asarray(lumi)[mask], zvals[0])
+    return [N, x0, y0, 0, 0, 0] + pedestal
 
 
 class zscan(cmdbase.controlcmd):
@@ -173,12 +518,15 @@ class zscan(cmdbase.controlcmd):
   Performing z scanning at a certain x-y coordinate
   """
 
+  DEVICES = ['gcoder', 'pico']
   DEFAULT_SAVEFILE = 'zscan_<CHIPID>_<TIMESTAMP>.txt'
   LOG = log.GREEN('[LUMI ZSCAN]')
+  SAVEFILE_COLUMNS = halign.SAVEFILE_COLUMNS
 
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.add_zscan_options()
+    self.add_adaptivez_options()
     self.add_savefile_options(zscan.DEFAULT_SAVEFILE)
 
   def parse(self, line):
@@ -189,51 +537,60 @@ class zscan(cmdbase.controlcmd):
     self.parse_savefile(args)
     return args
 
+  def expected_rows(self, args):
+    return args.maxpoints if args.adaptive else len(args.zlist)
+
   def run(self, args):
     self.init_handle()
+    self.rangectrl.reset()
+    zvals, _ = self.adaptive_zscan(args,
+                                   lambda zlist: self.measure(args, zlist))
+    self.close_savefile(args)
+    if args.adaptive:
+      self.printmsg('Measured {0:d} z points'.format(len(zvals)))
+
+  def measure(self, args, zlist):
+    """
+    Collecting the readout at each z value in the list, writing each point to
+    the save file. Returns the list of readout values.
+    """
     lumi = []
-    unc = []
-
-    for z in args.zlist:
+    for z in zlist:
       self.check_handle(args)
       self.move_gantry(args.x, args.y, z, False)
 
-      lumival = 0
-      uncval = 0
-      while 1:
-        lumival, uncval = self.readout.read(channel=args.channel,
-                                            samples=args.samples)
-        if self.readout.mode == self.readout.MODE_PICO:
-          wmax = self.pico.waveformmax(args.channel)
-          if wmax < 100 and self.pico.range > self.pico.rangemin():
-            self.pico.setrange(self.pico.range - 1)
-          elif wmax > 200 and self.pico.range < self.pico.rangemax():
-            self.pico.setrange(self.pico.range + 1)
-          else:
-            break
-        else:
-          break
-
+      if self.readout.mode == self.readout.MODE_PICO:
+        self.rangectrl.select(args.channel, args.chipid, z, x=args.x, y=args.y)
+      lumival, uncval = self.readout.read(channel=args.channel,
+                                          samples=args.samples)
       lumi.append(lumival)
-      unc.append(uncval)
 
       # Writing to screen
       self.update('z:{0:5.1f}, L:{1:8.5f}, uL:{2:8.6f}'.format(
           z, lumival, uncval))
+      self.publish_progress(args,
+                            x=args.x,
+                            y=args.y,
+                            z=z,
+                            lumi=lumival,
+                            unc=uncval)
       # Writing to file
-      args.savefile.write(
-          "{0:5.1f} {1:5.1f} {2:5.1f} {3:8.5f} {4:8.6f}\n".format(
-              args.x, args.y, z, lumival, uncval))
-
-    self.close_savefile(args)
+      args.savefile.write_row(args.x, args.y, z, lumival, uncval)
+    return lumi
 
 
 class timescan(cmdbase.controlcmd):
   """
   Generate a log of the readout in terms relative to time.
   """
+  DEVICES = ['pico']
   DEFAULT_SAVEFILE = 'tscan_<CHIPID>_<TIMESTAMP>.txt'
   LOG = log.GREEN('[TIMESCAN]')
+  SAVEFILE_COLUMNS = [
+      ('time', 'i4', '{0:d}'),
+      ('lumi', 'f8', '{0:.3f}'),
+      ('unc', 'f8', '{0:.4f}'),
+  ]
 
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
@@ -254,16 +611,19 @@ class timescan(cmdbase.controlcmd):
     self.parse_savefile(args)
     return args
 
+  def expected_rows(self, args):
+    return args.nslice
+
   def run(self, args):
     self.init_handle()
     for i in range(args.nslice):
       self.check_handle(args)
       lumival, uncval = self.readout.read(channel=args.channel,
                                           sample=args.samples)
-      args.savefile.write('{0:d} {1:.3f} {2:.4f}\n'.format(
-          i * args.interval, lumival, uncval))
+      args.savefile.write_row(i * args.interval, lumival, uncval)
       self.update('{0:5.1f} {1:5.1f} | PROGRESS [{2:3d}/{3:3d}]'.format(
           lumival, uncval, i + 1, args.nslice))
+      self.publish_progress(args, lumi=lumival, unc=uncval)
       time.sleep(args.interval)
 
     self.close_savefile(args)
@@ -274,6 +634,7 @@ class showreadout(cmdbase.controlcmd):
   Continuously display ADC readout
   """
 
+  DEVICES = ['pico']
   LOG = log.GREEN('[READOUT]')
 
   def __init__(self, cmd):
@@ -6,6 +6,8 @@ class picoset(cmdbase.controlcmd):
   """
   Setting session parameters
   """
+  DEVICES = ['pico']
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.parser.add_argument('--range',
@@ -105,6 +107,7 @@ class picorunblock(cmdbase.controlcmd):
   finish without user intervension (no program fired triggering)
   """
 
+  DEVICES = ['pico', 'trigger']
   DEFAULT_SAVEFILE = 'picoblock_<TIMESTAMP>.txt'
   LOG = log.GREEN('[PICOBLOCK]')
 
@@ -126,6 +129,12 @@ class picorunblock(cmdbase.controlcmd):
                              action='store_true',
                              help=('Store the sum of the waveform values '
                                    'instead of waveforms itself'))
+    self.parser.add_argument('--delta',
+                             action='store_true',
+                             help=('Delta encoding the waveform samples of '
+                                   'compressed output (see --compress). This '
+                                   'improves the compression of waveforms '
+                                   'with varying baselines and pulse heights'))
 
   def parse(self, line):
     args = cmdbase.controlcmd.parse(self, line)
@@ -157,6 +166,7 @@ class picorunblock(cmdbase.controlcmd):
       for cap in range(self.pico.ncaptures):
         line = self.pico.waveformstr(args.channel, cap)
         args.savefile.write(line + '\n')
+      self.publish_progress(args, total=args.numblocks)
 
     # Closing
     args.savefile.flush()
@@ -170,6 +180,9 @@ class picorange(cmdbase.controlcmd):
   """
   Automatically setting the voltage range of the pico-scope based on a few waveforms of data.
   """
+  DEVICES = ['pico']
+  LOG = log.GREEN('[PICORANGE]')
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.parser.add_argument('--captures',
@@ -182,21 +195,7 @@ class picorange(cmdbase.controlcmd):
                              help='Input channel to base the calculation')
 
   def run(self, args):
-    # Setting the new number of block to run
-    self.pico.setblocknums(args.captures, self.pico.postsamples,
-                           self.pico.presamples)
-
-    while 1:
-      self.pico.startrapidblocks()
-      while not self.pico.isready():
-        self.trigger.pulse(self.pico.ncaptures, 500)
-      self.pico.flushbuffer()
-
-      wmax = self.pico.waveformmax(args.channel)
-
-      if wmax < 100 and self.pico.range > self.pico.rangemin():
-        self.pico.setrange(self.pico.range - 1)
-      elif wmax > 200 and self.pico.range < self.pico.rangemax():
-        self.pico.setrange(self.pico.range + 1)
-      else:
-        break
+    peak = self.rangectrl.select(args.channel, captures=args.captures)
+    self.printmsg('Waveform maximum: {0:.1f}mV, voltage range: {1:d} '
+                  '({2:.0f}mV)'.format(peak, self.pico.range,
+                                       self.pico.rangevalue(self.pico.range)))
@@ -0,0 +1,397 @@
+import ctlcmd.cmdbase as cmdbase
+import cmod.logger as log
+import cmod.jsonenc as jsonenc
+import socketserver
+import threading
+import json
+import stat
+import time
+import os
+
+
+class RPCError(Exception):
+  """
+  Exception reported to the client as a JSON-RPC error object.
+  """
+
+  def __init__(self, code, message):
+    Exception.__init__(self, message)
+    self.code = code
+
+
+class controlserver(object):
+  """
+  Headless JSON-RPC 2.0 interface of the control session, allowing scripts to
+  run the session commands without emulating a terminal. Requests are read as
+  newline delimited JSON objects from a Unix or TCP socket, with lines that are
+  not JSON objects treated as command lines. While a command runs, its output
+  and telemetry events are streamed to the client as notifications, followed
+  by the result of the request.
+
+  Each client connection is handled in its own thread. Before running, a
+  command acquires its own lock and the locks of the session devices that it
+  uses (see controlcmd.DEVICES), so commands of different clients only run
+  concurrently if they use separate devices. Read-only commands
+  (controlcmd.READONLY) do not lock any device, allowing the gantry coordinates
+  to be queried during a scan. Runfiles lock every command and device.
+  """
+
+  LOG = log.GREEN('[SERVER]')
+  DEVICES = ['gcoder', 'visual', 'pico', 'trigger']
+
+  ## JSON-RPC error codes
+  PARSE_ERROR = -32700
+  INVALID_REQUEST = -32600
+  METHOD_NOT_FOUND = -32601
+  INVALID_PARAMS = -32602
+  INTERNAL_ERROR = -32603
+  DEVICE_BUSY = -32000
+
+  STATUS = {
+      cmdbase.controlcmd.EXIT_SUCCESS: 'done',
+      cmdbase.controlcmd.PARSE_ERROR: 'parse error',
+      cmdbase.controlcmd.EXECUTE_ERROR: 'failed',
+  }
+
+  def __init__(self, cmd):
+    self.cmd = cmd
+    self.devlocks = {x: threading.Lock() for x in controlserver.DEVICES}
+    self.cmdlocks = {}
+    ## Running commands indexed by (client, request id)
+    self.running = {}
+    self.lock = threading.Lock()
+    cmd.telemetry.subscribe(lambda event: cmd.forward('event', event))
+
+  def serve(self, address):
+    """
+    Serving requests until interrupted. Addresses of the form HOST:PORT are
+    served over TCP, anything else is used as the path of a Unix socket.
+    """
+    if ':' in address:
+      host, port = address.rsplit(':', 1)
+      server = tcpserver((host, int(port)), clienthandler)
+    else:
+      if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+        os.remove(address)  # Left over by a previous session
+      server = unixserver(address, clienthandler)
+    server.control = self
+
+    log.printmsg(controlserver.LOG, 'Listening on [{0}]'.format(address))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      if ':' not in address:
+        os.remove(address)
+
+  def handle_line(self, line, client):
+    """
+    Processing a single request line, returns the response object, or None for
+    JSON-RPC notifications.
+    """
+    if not line.startswith('{'):
+      request = {'id': None, 'method': 'run', 'params': {'line': line}}
+    else:
+      try:
+        request = json.loads(line)
+      except ValueError as err:
+        return controlserver.error(None, controlserver.PARSE_ERROR, str(err))
+
+    reqid = request.get('id') if isinstance(request, dict) else None
+    if not isinstance(request, dict) or \
+       not isinstance(request.get('method'), str):
+      return controlserver.error(reqid, controlserver.INVALID_REQUEST,
+                                 'Request must be an object with a method')
+    method = {
+        'run': self.rpc_run,
+        'commands': self.rpc_commands,
+        'status': self.rpc_status,
+        'cancel': self.rpc_cancel,
+    }.get(request['method'])
+    if method is None:
+      return controlserver.error(
+          reqid, controlserver.METHOD_NOT_FOUND,
+          'Unknown method [{0}]'.format(request['method']))
+
+    try:
+      result = method(request.get('params', {}), reqid, client)
+    except RPCError as err:
+      return controlserver.error(reqid, err.code, str(err))
+    except Exception as err:
+      return controlserver.error(reqid, controlserver.INTERNAL_ERROR, str(err))
+    if 'id' not in request:
+      return None
+    return {'jsonrpc': '2.0', 'id': reqid, 'result': result}
+
+  @staticmethod
+  def error(reqid, code, message):
+    return {
+        'jsonrpc': '2.0',
+        'id': reqid,
+        'error': {
+            'code': code,
+            'message': message
+        }
+    }
+
+  def rpc_run(self, params, reqid, client):
+    """
+    Running a command given either as a command line ({"line": ...}) or as a
+    command name with the arguments as a list of tokens or as an object of
+    argument destinations and values ({"command": ..., "args": ...}). The
+    optional timeout is the maximum wait for the devices in seconds.
+    """
+    line = self.command_line(params)
+    name = line.split()[0]
+    if name in ['exit', 'EOF'] or not hasattr(self.cmd, 'do_' + name):
+      raise RPCError(controlserver.INVALID_PARAMS,
+                     'Unknown command [{0}]'.format(name))
+    command = getattr(self.cmd, name, None)
+    names = [name]
+    if not isinstance(command, cmdbase.controlcmd):
+      ## Runfiles run any of the commands, and compiling them puts the whole
+      ## session in dry run mode, so they run exclusively.
+      names = sorted(set([name] + self.command_names()))
+      devices = controlserver.DEVICES
+    elif command.READONLY:
+      devices = []
+    elif command.DEVICES is None:
+      devices = controlserver.DEVICES
+    else:
+      devices = command.DEVICES
+
+    def sink(kind, data):
+      if kind == 'event':
+        client.notify('event', {'id': reqid, 'event': data})
+      else:
+        client.notify('output', {'id': reqid, 'kind': kind, 'text': data})
+
+    ## Registered before waiting for the locks, so that the request can be
+    ## cancelled at any point.
+    key = (id(client), reqid)
+    start = time.time()
+    cancel = threading.Event()
+    with self.lock:
+      if key in self.running:
+        raise RPCError(controlserver.INVALID_REQUEST,
+                       'Request id [{0}] is already running'.format(reqid))
+      self.running[key] = {
+          'command': command,
+          'line': line,
+          'start': start,
+          'cancel': cancel
+      }
+    try:
+      locks = self.acquire(name, names, devices, params.get('timeout'))
+      try:
+        if cancel.is_set():
+          raise RPCError(controlserver.INVALID_REQUEST,
+                         'Request [{0}] was cancelled'.format(reqid))
+        self.cmd.sinks.sink = sink
+        self.cmd.sinks.cancel = cancel
+        try:
+          code = self.cmd.onecmd(line)
+        finally:
+          self.cmd.sinks.sink = None
+          self.cmd.sinks.cancel = None
+      finally:
+        for lock in reversed(locks):
+          lock.release()
+    finally:
+      with self.lock:
+        del self.running[key]
+    code = code or cmdbase.controlcmd.EXIT_SUCCESS
+    return {
+        'command': name,
+        'status': controlserver.STATUS.get(code, 'failed'),
+        'code': code,
+        'duration': time.time() - start
+    }
+
+  def acquire(self, name, names, devices, timeout=None):
+    """
+    Acquiring the locks of the listed commands, then the locks of the devices,
+    each in a fixed order so that clients never wait on each other in a cycle.
+    Raises a device busy error if the locks are not acquired within the
+    timeout.
+    """
+    with self.lock:
+      cmdlocks = [
+          self.cmdlocks.setdefault(x, threading.Lock()) for x in sorted(names)
+      ]
+    deadline = None if timeout is None else time.time() + timeout
+    acquired = []
+    for lock in cmdlocks + [self.devlocks[x] for x in sorted(devices)]:
+      wait = -1 if deadline is None else max(deadline - time.time(), 0)
+      if not lock.acquire(timeout=wait):
+        for x in reversed(acquired):
+          x.release()
+        busy = [x for x in names if self.cmdlocks[x].locked()] + \
+               [x for x in devices if self.devlocks[x].locked()]
+        raise RPCError(
+            controlserver.DEVICE_BUSY,
+            'Commands or devices used by [{0}] are busy: {1}'.format(
+                name, ', '.join(busy)))
+      acquired.append(lock)
+    return acquired
+
+  def command_line(self, params):
+    if 'line' in params:
+      line = str(params['line']).strip()
+      if not line:
+        raise RPCError(controlserver.INVALID_PARAMS, 'Empty command line')
+      return line
+    if 'command' not in params:
+      raise RPCError(controlserver.INVALID_PARAMS,
+                     'Either line or command must be given')
+
+    name = str(params['command'])
+    args = params.get('args', [])
+    command = getattr(self.cmd, name, None)
+    if isinstance(args, list):
+      tokens = [str(x) for x in args]
+    elif isinstance(args, dict) and isinstance(command, cmdbase.controlcmd):
+      tokens = controlserver.arg_tokens(command.parser, args)
+    else:
+      raise RPCError(controlserver.INVALID_PARAMS,
+                     'Invalid arguments for [{0}]'.format(name))
+    ## Command lines are split at white spaces
+    if any(len(x.split()) != 1 for x in tokens):
+      raise RPCError(controlserver.INVALID_PARAMS,
+                     'Argument values must be non-empty without white spaces')
+    return ' '.join([name] + tokens)
+
+  @staticmethod
+  def arg_tokens(parser, args):
+    """
+    Converting an object of argument destinations (as listed in the help
+    message) and values to command line tokens. Flags are given as booleans,
+    and multiple values as lists.
+    """
+    actions = {action.dest: action for action in parser._actions}
+    tokens = []
+    for key, value in args.items():
+      action = actions.get(key)
+      if action is None:
+        raise RPCError(controlserver.INVALID_PARAMS,
+                       'Unknown argument [{0}]'.format(key))
+      if action.nargs == 0:
+        if value:
+          tokens.append(action.option_strings[0])
+        continue
+      if action.option_strings:
+        tokens.append(action.option_strings[0])
+      tokens.extend(str(x) for x in (value if isinstance(value, list) else
+                                     [value]))
+    return tokens
+
+  def command_names(self):
+    return [
+        x for x in sorted(dir(self.cmd))
+        if isinstance(getattr(self.cmd, x), cmdbase.controlcmd)
+    ]
+
+  def rpc_commands(self, params, reqid, client):
+    commands = []
+    for name in self.command_names():
+      command = getattr(self.cmd, name)
+      commands.append({
+          'name': name,
+          'description': ' '.join((command.parser.description or '').split()),
+          'devices': command.DEVICES,
+          'readonly': command.READONLY,
+      })
+    return commands
+
+  def rpc_status(self, params, reqid, client):
+    with self.lock:
+      running = [{
+          'command': entry['line'].split()[0],
+          'line': entry['line'],
+          'id': key[1],
+          'elapsed': time.time() - entry['start']
+      } for key, entry in self.running.items()]
+    return {
+        'x': self.cmd.gcoder.opx,
+        'y': self.cmd.gcoder.opy,
+        'z': self.cmd.gcoder.opz,
+        'running': running,
+        'busy': [x for x, lock in self.devlocks.items() if lock.locked()],
+        'initializing': self.cmd.pending_devices(),
+    }
+
+  def rpc_cancel(self, params, reqid, client):
+    """
+    Terminating a running command, identified by the id of the request that
+    started it on the same connection, as with a termination signal in the
+    interactive session. The cancel flag of the request is checked by the
+    command (see controlcmd.check_handle) and between the steps of a runfile.
+    A request cancelled while waiting for the devices is not run.
+    """
+    with self.lock:
+      entry = self.running.get((id(client), params.get('id')))
+    if entry is not None:
+      entry['cancel'].set()
+    return {'cancelled': int(entry is not None)}
+
+
+class clienthandler(socketserver.StreamRequestHandler):
+  """
+  Connection of a single client. JSON requests are processed in separate
+  threads, so that a running command can be cancelled over the same connection,
+  while plain command lines are processed in order.
+  """
+
+  def setup(self):
+    socketserver.StreamRequestHandler.setup(self)
+    self.wlock = threading.Lock()
+    self.closed = False
+
+  def handle(self):
+    threads = []
+    for raw in self.rfile:
+      line = raw.decode(errors='replace').strip()
+      if not line:
+        continue
+      if line.startswith('{'):
+        threads.append(threading.Thread(target=self.respond, args=(line,)))
+        threads[-1].start()
+      else:
+        self.respond(line)
+    for thread in threads:
+      thread.join()
+
+  def respond(self, line):
+    response = self.server.control.handle_line(line, self)
+    if response is not None:
+      self.notify(None, response)
+
+  def notify(self, method, params):
+    """
+    Sending a notification, or a complete message if method is None. A client
+    disconnecting does not interrupt the running command.
+    """
+    message = params if method is None else {
+        'jsonrpc': '2.0',
+        'method': method,
+        'params': params
+    }
+    if self.closed:
+      return
+    try:
+      with self.wlock:
+        self.wfile.write((jsonenc.dumps(message) + '\n').encode())
+        self.wfile.flush()
+    except OSError:
+      self.closed = True
+
+
+class tcpserver(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+class unixserver(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
@@ -1,9 +1,10 @@
 import ctlcmd.cmdbase as cmdbase
 import cmod.logger as log
+import cmod.fitting as fitting
+import cmod.gcoder as gcoder
 import numpy as np
-from scipy.optimize import curve_fit
+import concurrent.futures
 import time
-import cv2
 
 
 class visualhscan(cmdbase.controlcmd):
@@ -11,8 +12,17 @@ class visualhscan(cmdbase.controlcmd):
   Performing horizontal scan with camera system
   """
 
+  DEVICES = ['gcoder', 'visual']
   DEFAULT_SAVEFILE = 'vhscan_<SCANZ>_<TIMESTAMP>.txt'
   LOG = log.GREEN('[VIS HSCAN]')
+  SAVEFILE_COLUMNS = [
+      ('x', 'f4', '{0:.1f}'),
+      ('y', 'f4', '{0:.1f}'),
+      ('z', 'f4', '{0:.1f}'),
+      ('recox', 'f4', '{0:.2f}'),
+      ('recoy', 'f4', '{0:.3f}'),
+  ]
+  MONITOR_FPS = 10  # Maximum refresh rate of the monitor window
 
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
@@ -23,11 +33,19 @@ class visualhscan(cmdbase.controlcmd):
                              '--monitor',
                              action='store_true',
                              help=('Whether or not to open the monitoring window'
-                                   ' (could be slow!!)'))
+                                   ' (rendered in a separate thread)'))
     self.parser.add_argument('--overwrite',
                              action='store_true',
                              help=('Forcing the storage of scan results as '
                                    'session information'))
+    self.parser.add_argument('--method',
+                             type=str,
+                             choices=['lsq', 'huber', 'ransac'],
+                             default='ransac',
+                             help=('Method for estimating the transformation '
+                                   'matrix: plain least squares, Huber '
+                                   'weighted least squares, or RANSAC outlier '
+                                   'rejection followed by the Huber fit'))
 
   def parse(self, line):
     args = cmdbase.controlcmd.parse(self, line)
@@ -35,51 +53,67 @@ class visualhscan(cmdbase.controlcmd):
     self.parse_savefile(args)
     return args
 
+  def plan(self, args):
+    if not args.chipid in self.board.visM and int(args.chipid) < 0:
+      self.board.add_calib_chip(args.chipid)
+    self.board.add_visM(args.chipid, args.scanz, [[1, 0], [0, 1]])
+
+  def expected_rows(self, args):
+    return len(self.make_hscan_mesh(args)[0])
+
   def run(self, args):
     self.init_handle()
     x, y = self.make_hscan_mesh(args)
 
-    ## New container to account for chip not found in FOV
-    gantry_x = []
-    gantry_y = []
+    ## Chips not found in FOV are rejected by the fit
     reco_x = []
     reco_y = []
 
-    ## Running over mesh.
-    for idx, (xval, yval) in enumerate(zip(x, y)):
-      self.check_handle(args)
-      self.move_gantry(xval, yval, args.scanz, False)
-
-      center = self.visual.find_chip(args.monitor)
+    def process(frame):
+      return self.visual.find_chip_frame(frame, args.monitor)
 
-      if center.x > 0 and center.y > 0:
-        gantry_x.append(xval)
-        gantry_y.append(yval)
-        reco_x.append(center.x)
-        reco_y.append(center.y)
+    def collect(idx, position, center):
+      xval, yval = x[idx], y[idx]
+      reco_x.append(center.x)
+      reco_y.append(center.y)
 
       self.update('{0} | {1} | {2}'.format(
           'x:{0:.1f}, y:{1:.1f}, z:{2:.1f}'.format(
               xval, yval, args.scanz), 'Reco x:{0:.1f}, y:{1:.1f}'.format(
-                  center.x, center.y), 'Progress [{0}/{1}]'.format(idx, len(x))))
-      args.savefile.write('{0:.1f} {1:.1f} {2:.1f} {3:.2f} {4:.3f}\n'.format(
-          xval, yval, args.scanz, center.x, center.y))
-    cv2.destroyAllWindows()
+                  center.x, center.y), 'Progress [{0}/{1}]'.format(
+                      idx + 1, len(x))))
+      self.publish_progress(args,
+                            x=xval,
+                            y=yval,
+                            z=args.scanz,
+                            recox=center.x,
+                            recoy=center.y)
+      args.savefile.write_row(xval, yval, args.scanz, center.x, center.y)
+
+    ## Running over mesh, image processing is overlapped with motion.
+    if args.monitor:
+      self.visual.start_monitor(visualhscan.MONITOR_FPS)
+    try:
+      self.visual_pipeline_scan(args, [(xval, yval, args.scanz)
+                                       for xval, yval in zip(x, y)], process,
+                                collect)
+    finally:
+      self.visual.stop_monitor()
     self.close_savefile(args)
 
-    fitx, covar_x = curve_fit(visualhscan.model, np.vstack((gantry_x, gantry_y)),
-                              reco_x)
-    fity, covar_y = curve_fit(visualhscan.model, np.vstack((gantry_x, gantry_y)),
-                              reco_y)
+    fit = fitting.fit_visM(x, y, reco_x, reco_y, method=args.method)
+    visM, unc = fit['visM'], fit['unc']
 
     self.printmsg( 'Transformation for CamX ' \
           '= ({0:.2f}+-{1:.3f})x + ({2:.2f}+-{3:.2f})y'.format(
-              fitx[0], np.sqrt(covar_x[0][0]),
-              fitx[1], np.sqrt(covar_x[1][1])  ) )
+              visM[0][0], unc[0][0], visM[0][1], unc[0][1] ) )
     self.printmsg( 'Transformation for CamY ' \
           '= ({0:.2f}+-{1:.3f})x + ({2:.2f}+-{3:.2f})y'.format(
-              fity[0], np.sqrt(covar_y[0][0]),
-              fity[1], np.sqrt(covar_y[1][1])  ) )
+              visM[1][0], unc[1][0], visM[1][1], unc[1][1] ) )
+    self.printmsg(('Inliers: {0:d}/{1:d} | Residual: {2:.2f}px | '
+                   'Condition number: {3:.2f}').format(
+                       int(np.sum(fit['inliers'])), len(x), fit['residual'],
+                       fit['cond']))
 
     ## Generating calibration chip id if using chip coordinates
     if not args.chipid in self.board.visM and int(args.chipid) < 0:
@@ -87,29 +121,23 @@ class visualhscan(cmdbase.controlcmd):
 
     ## Saving rounded coordinates
     if (not self.gcoder.opz in self.board.visM[args.chipid] or args.overwrite):
-      self.board.add_visM(args.chipid, self.gcoder.opz,
-                          [[fitx[0], fitx[1]], [fity[0], fity[1]]])
+      self.board.add_visM(args.chipid, self.gcoder.opz, visM)
     elif self.gcoder.opz in self.board.visM[args.chipid]:
       if self.cmd.prompt(
           'Tranformation equation for z={0:.1f} already exists, overwrite?'.
           format(args.scanz), 'no'):
-        self.board.add_visM(args.chipid, self.gcoder.opz,
-                            [[fitx[0], fitx[1]], [fity[0], fity[1]]])
+        self.board.add_visM(args.chipid, self.gcoder.opz, visM)
 
     ## Moving back to center
     self.gcoder.moveto(args.x, args.y, args.scanz, False)
 
-  @staticmethod
-  def model(xydata, a, b, c):
-    x, y = xydata
-    return a * x + b * y + c
-
 
 class visualcenterchip(cmdbase.controlcmd):
   """
   Moving the gantry so that the chip is in the center of the field of view
   """
 
+  DEVICES = ['gcoder', 'visual']
   LOG = log.GREEN('[VIS ALIGN]')
 
   def __init__(self, cmd):
@@ -125,6 +153,21 @@ class visualcenterchip(cmdbase.controlcmd):
                              action='store_true',
                              help=('Whether to overwrite the existing '
                                    'information or not'))
+    self.parser.add_argument('--oneshot',
+                             action='store_true',
+                             help=('Solve for the required motion once and only '
+                                   'correct if the residual is above tolerance '
+                                   'instead of iterating'))
+    self.parser.add_argument('--tolerance',
+                             type=float,
+                             default=0.1,
+                             help=('Maximum distance between the chip and the '
+                                   'center of the field of view [mm]'))
+
+    ## Locally refined transformation matrices, by (calibchip, z), and the
+    ## number of motions used by each one-shot centering in the session.
+    self.local_visM = {}
+    self.motion_history = []
 
   def parse(self, line):
     args = cmdbase.controlcmd.parse(self, line)
@@ -132,10 +175,7 @@ class visualcenterchip(cmdbase.controlcmd):
     if not args.scanz:
       raise Exception('Specify the height to perform the centering operation')
 
-    args.calibchip = args.chipid if (self.board.visM_hasz(
-        args.chipid, args.scanz)) else next(
-            (x for x in self.board.calibchips()
-             if self.board.visM_hasz(x, args.scanz)), None)
+    args.calibchip = self.visM_calibchip(args.chipid, args.scanz)
 
     if args.calibchip == None:
       self.printerr(('Motion transformation equation was not found for '
@@ -145,8 +185,52 @@ class visualcenterchip(cmdbase.controlcmd):
       raise Exception('Transformation equation not found')
     return args
 
+  def plan(self, args):
+    if args.chipid in self.board.vis_coord:
+      self.board.add_vis_coord(args.chipid, args.scanz, [args.x, args.y])
+
   def run(self, args):
     self.move_gantry(args.x, args.y, args.scanz, False)
+    if args.oneshot:
+      self.center_oneshot(args)
+    else:
+      self.center_iterative(args)
+
+    center = self.visual.find_chip(False)
+    self.printmsg(
+      'Gantry position: x={0:.1f} y={1:.1f} | '\
+      'Chip FOV position: x={2:.1f} y={3:.1f}'.
+        format(self.gcoder.opx, self.gcoder.opy, center.x, center.y))
+    self.store_result(args)
+
+  def center_oneshot(self, args):
+    """
+    Centering with a single solved motion, verifying with one frame and
+    correcting only if required. The locally refined matrix is kept for
+    subsequent calls in the same session.
+    """
+    key = (args.calibchip, self.board.roundz(args.scanz))
+    if not key in self.local_visM:
+      self.local_visM[key] = self.board.interp_visM(args.calibchip, args.scanz)
+
+    residuals, self.local_visM[key] = self.visual_center_oneshot(
+        self.local_visM[key], args.tolerance)
+    self.motion_history.append(len(residuals) - 1)
+
+    self.printmsg('Motions: {0:d} | Residuals [mm]: {1}'.format(
+        len(residuals) - 1, ' '.join('{0:.3f}'.format(r) for r in residuals)))
+    self.printmsg('Session average motions: {0:.2f} (max {1:d}, {2:d} calls)'.
+                  format(np.mean(self.motion_history),
+                         max(self.motion_history), len(self.motion_history)))
+    if residuals[-1] > args.tolerance:
+      self.printwarn('Residual {0:.3f}mm is above tolerance'.format(
+          residuals[-1]))
+
+  def center_iterative(self, args):
+    """
+    Iterative centering, moving repeatedly until the chip is close enough to
+    the center of the field of view.
+    """
     for movetime in range(10):  ## Maximum of 10 movements
       center = None
 
@@ -167,7 +251,7 @@ class visualcenterchip(cmdbase.controlcmd):
       ])
 
       motionxy = np.linalg.solve(
-          np.array(self.board.get_visM(args.calibchip, self.gcoder.opz)),
+          np.array(self.board.interp_visM(args.calibchip, self.gcoder.opz)),
           deltaxy)
 
       ## Early exit if difference from center is small
@@ -177,12 +261,10 @@ class visualcenterchip(cmdbase.controlcmd):
                          self.gcoder.opy + motionxy[1], self.gcoder.opz, False)
       time.sleep(0.1)  ## Waiting for the gantry to stop moving
 
-    center = self.visual.find_chip(False)
-    self.printmsg(
-      'Gantry position: x={0:.1f} y={1:.1f} | '\
-      'Chip FOV position: x={2:.1f} y={3:.1f}'.
-        format(self.gcoder.opx, self.gcoder.opy, center.x, center.y))
-
+  def store_result(self, args):
+    """
+    Storing the centered position as the visual coordinates of the chip.
+    """
     if (not self.board.vis_coord_hasz(args.chipid, self.gcoder.opz)
         or args.overwrite):
       self.board.add_vis_coord(args.chipid, self.gcoder.opz,
@@ -208,10 +290,320 @@ class visualcenterchip(cmdbase.controlcmd):
               self.gcoder.opx - deltax, self.gcoder.opy - deltay))
 
 
+class visualsurvey(cmdbase.controlcmd):
+  """
+  Surveying the visual coordinates of all chips on the board at a given height.
+  Chips are visited in an order that minimizes the gantry travel, the position
+  of each chip is predicted from the nearest chip already surveyed, and the
+  chip is centered with a single motion using the visual transformation
+  matrix. Chips already with visual coordinates at this height are skipped
+  unless --overwrite is set, so an interrupted survey can be resumed. With
+  --overwrite, existing coordinates (ex. from visualmosaic) are used as the
+  starting position.
+  """
+
+  DEVICES = ['gcoder', 'visual']
+  DEFAULT_SAVEFILE = 'vsurvey_<SCANZ>_<TIMESTAMP>.txt'
+  LOG = log.GREEN('[VIS SURVEY]')
+  SAVEFILE_COLUMNS = [
+      ('chip', 'i4', '{0:d}'),
+      ('x', 'f4', '{0:.1f}'),
+      ('y', 'f4', '{0:.1f}'),
+      ('z', 'f4', '{0:.1f}'),
+      ('motions', 'i4', '{0:d}'),
+      ('residual', 'f4', '{0:.3f}'),
+  ]
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.add_savefile_options(visualsurvey.DEFAULT_SAVEFILE)
+    self.parser.add_argument('-z',
+                             '--scanz',
+                             type=float,
+                             help=('Height to perform the survey [mm]. The '
+                                   'visual transformation equation must exist '
+                                   'for this height'))
+    self.parser.add_argument('--chips',
+                             type=str,
+                             nargs='+',
+                             help=('List of chip ids to survey, all chips in '
+                                   'the board type are used if not specified'))
+    self.parser.add_argument('--tolerance',
+                             type=float,
+                             default=0.1,
+                             help=('Maximum distance between the chip and the '
+                                   'center of the field of view [mm]'))
+    self.parser.add_argument('--calibfile',
+                             type=str,
+                             help=('Calibration file to save to after every '
+                                   'chip is surveyed (checkpointing)'))
+    self.parser.add_argument('--overwrite',
+                             action='store_true',
+                             help=('Survey chips that already have visual '
+                                   'coordinates at this height'))
+
+  def parse(self, line):
+    args = cmdbase.controlcmd.parse(self, line)
+    if not args.scanz:
+      raise Exception('Specify the height to perform the survey')
+    if not args.chips:
+      args.chips = [
+          c for c in self.board.chips() if self.board.orig_coord[c][0] >= 0
+          and self.board.orig_coord[c][1] >= 0
+      ]
+    for chip in args.chips:
+      if not chip in self.board.chips():
+        raise Exception('Chip id {0} was not specified in board type'.format(
+            chip))
+    if not args.overwrite:
+      args.chips = [
+          c for c in args.chips
+          if not self.board.vis_coord_hasz(c, args.scanz)
+      ]
+
+    args.calibchip = self.visM_calibchip(None, args.scanz)
+    if args.calibchip == None:
+      raise Exception(('Motion transformation equation was not found for '
+                       'position z={0:.1f}mm, please run command '
+                       '[visualhscan] first').format(args.scanz))
+    self.parse_savefile(args)
+    return args
+
+  def plan(self, args):
+    for chip in args.chips:
+      self.board.add_vis_coord(chip, args.scanz, self.board.orig_coord[chip])
+
+  def run(self, args):
+    self.init_handle()
+    order = self.order_by_travel(
+        [self.board.orig_coord[c] for c in args.chips],
+        (self.gcoder.opx, self.gcoder.opy))
+    default_offset = self.find_xyoffset(args.scanz)
+    visM = self.board.interp_visM(args.calibchip, args.scanz)
+    failed = []
+    nmotions = []
+    final_residuals = []
+
+    for idx, chipidx in enumerate(order):
+      self.check_handle(args)
+      chip = args.chips[chipidx]
+      x, y = self.predict_vis_coord(chip, args.scanz, default_offset)
+      self.move_gantry(x, y, args.scanz, False)
+
+      try:
+        residuals, visM = self.visual_center_oneshot(visM, args.tolerance)
+        nmotion, residual = len(residuals) - 1, residuals[-1]
+      except (cmdbase.ChipLostError, np.linalg.LinAlgError) as err:
+        self.printwarn('Chip {0} not found near x={1:.1f} y={2:.1f}: {3}'.format(
+            chip, x, y, str(err)))
+        failed.append(chip)
+        continue
+
+      nmotions.append(nmotion)
+      final_residuals.append(residual)
+      self.board.add_vis_coord(chip, self.gcoder.opz,
+                               [self.gcoder.opx, self.gcoder.opy])
+
+      ## Checkpointing progress
+      args.savefile.write_row(int(chip), self.gcoder.opx, self.gcoder.opy,
+                              self.gcoder.opz, nmotion, residual)
+      args.savefile.flush()
+      if args.calibfile:
+        self.board.save_calib_file(args.calibfile)
+
+      self.update('{0} | {1} | {2}'.format(
+          'Chip:{0:>4s} x:{1:.1f} y:{2:.1f}'.format(chip, self.gcoder.opx,
+                                                    self.gcoder.opy),
+          'Motions:{0:d} Residual:{1:.3f}'.format(nmotion + 1, residual),
+          'Progress [{0}/{1}]'.format(idx + 1, len(order))))
+      self.publish_progress(args,
+                            total=len(order),
+                            chip=chip,
+                            x=self.gcoder.opx,
+                            y=self.gcoder.opy,
+                            residual=residual)
+
+    self.close_savefile(args)
+    if len(nmotions):
+      self.printmsg('Surveyed {0} chips, average motions per chip: {1:.2f}'.
+                    format(len(nmotions), np.mean(nmotions) + 1))
+      self.printmsg('Final residual [mm] mean: {0:.3f} max: {1:.3f}'.format(
+          np.mean(final_residuals), np.max(final_residuals)))
+    if len(failed):
+      self.printwarn('Chips not found: {0}'.format(' '.join(failed)))
+
+
+class visualmosaic(cmdbase.controlcmd):
+  """
+  Capturing a coarse grid of overlapping frames across the board, stitching
+  them into a single mosaic using the gantry coordinates and the visual
+  transformation matrix, and detecting all chips in the mosaic in one pass.
+  Detected positions are matched to the board chips and used to seed the
+  visual coordinates, so that fine centering (visualsurvey --overwrite or
+  visualcenterchip) starts close to the chip.
+  """
+
+  DEVICES = ['gcoder', 'visual']
+  DEFAULT_SAVEFILE = 'vmosaic_<SCANZ>_<TIMESTAMP>.txt'
+  LOG = log.GREEN('[VIS MOSAIC]')
+  SAVEFILE_COLUMNS = [
+      ('chip', 'i4', '{0:d}'),
+      ('x', 'f4', '{0:.2f}'),
+      ('y', 'f4', '{0:.2f}'),
+      ('z', 'f4', '{0:.1f}'),
+      ('area', 'f4', '{0:.2f}'),
+      ('maxmeas', 'f4', '{0:.2f}'),
+  ]
+
+  def __init__(self, cmd):
+    cmdbase.controlcmd.__init__(self, cmd)
+    self.add_savefile_options(visualmosaic.DEFAULT_SAVEFILE)
+    self.parser.add_argument('-z',
+                             '--scanz',
+                             type=float,
+                             help=('Height to capture the mosaic [mm]. The '
+                                   'visual transformation equation must exist '
+                                   'for this height'))
+    self.parser.add_argument('--overlap',
+                             type=float,
+                             default=0.2,
+                             help=('Fractional overlap between neighbouring '
+                                   'frames'))
+    self.parser.add_argument('--scale',
+                             type=float,
+                             default=10,
+                             help='Resolution of the mosaic image [pixel/mm]')
+    self.parser.add_argument('--margin',
+                             type=float,
+                             default=10,
+                             help=('Margin around the expected chip positions '
+                                   'to include in the mosaic [mm]'))
+    self.parser.add_argument('--matchdist',
+                             type=float,
+                             default=5,
+                             help=('Maximum distance between a detected and '
+                                   'an expected chip position [mm]'))
+    self.parser.add_argument('--image',
+                             type=str,
+                             help='Saving the mosaic image to a file')
+    self.parser.add_argument('--overwrite',
+                             action='store_true',
+                             help=('Seed chips that already have visual '
+                                   'coordinates at this height'))
+
+  def parse(self, line):
+    args = cmdbase.controlcmd.parse(self, line)
+    if not args.scanz:
+      raise Exception('Specify the height to capture the mosaic')
+    if args.overlap < 0 or args.overlap >= 1:
+      raise Exception('Overlap must be within [0,1)')
+    args.calibchip = self.visM_calibchip(None, args.scanz)
+    if args.calibchip == None:
+      raise Exception(('Motion transformation equation was not found for '
+                       'position z={0:.1f}mm, please run command '
+                       '[visualhscan] first').format(args.scanz))
+    self.parse_savefile(args)
+    return args
+
+  def run(self, args):
+    self.init_handle()
+    visM = np.array(self.board.interp_visM(args.calibchip, args.scanz))
+    rawpixpermm = np.mean(np.linalg.svd(visM, compute_uv=False))
+
+    ## Field of view size in gantry coordinates
+    fov = np.abs(np.linalg.inv(visM)).dot(
+        [self.visual.frame_width(),
+         self.visual.frame_height()])
+    step = (1 - args.overlap) * fov
+
+    ## Expected chip positions and the gantry grid covering them
+    default_offset = self.find_xyoffset(args.scanz)
+    chips = [
+        c for c in self.board.chips() if self.board.orig_coord[c][0] >= 0
+        and self.board.orig_coord[c][1] >= 0
+    ]
+    expected = np.array(
+        [self.predict_vis_coord(c, args.scanz, default_offset) for c in chips])
+    lower = np.maximum(expected.min(axis=0) - args.margin, 0)
+    upper = np.minimum(
+        expected.max(axis=0) + args.margin,
+        [gcoder.GCoder.max_x(), gcoder.GCoder.max_y()])
+    xgrid = np.arange(lower[0], upper[0] + step[0], step[0])
+    ygrid = np.arange(lower[1], upper[1] + step[1], step[1])
+    points = [(x, y) for idx, y in enumerate(ygrid)
+              for x in (xgrid if idx % 2 == 0 else xgrid[::-1])]
+
+    self.visual.mosaic_init(xgrid[0] - fov[0] / 2, ygrid[0] - fov[1] / 2,
+                            xgrid[-1] + fov[0] / 2, ygrid[-1] + fov[1] / 2,
+                            args.scale)
+
+    ## Stitching of frame N is overlapped with the motion to frame N+1
+    stitches = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      for idx, (x, y) in enumerate(points):
+        self.check_handle(args)
+        self.move_gantry(x, y, args.scanz, False)
+        frame = self.visual.get_frame()
+        stitches.append(
+            executor.submit(self.visual.mosaic_add, frame, self.gcoder.opx,
+                            self.gcoder.opy, visM[0][0], visM[0][1],
+                            visM[1][0], visM[1][1]))
+        self.update('x:{0:.1f} y:{1:.1f} | Frame [{2}/{3}]'.format(
+            x, y, idx + 1, len(points)))
+        self.publish_progress(args, total=len(points), x=x, y=y)
+    ## Raising stitching errors rather than leaving a partial mosaic
+    for stitch in stitches:
+      stitch.result()
+
+    if args.image:
+      self.visual.mosaic_save(args.image)
+
+    found = self.visual.mosaic_find_chips(rawpixpermm)
+    matches = self.match_chips(chips, expected, found, args.matchdist)
+
+    for chip, reco in matches.items():
+      args.savefile.write_row(int(chip), reco.x, reco.y, args.scanz, reco.area,
+                              reco.maxmeas)
+      if args.overwrite or not self.board.vis_coord_hasz(chip, args.scanz):
+        self.board.add_vis_coord(chip, args.scanz, [reco.x, reco.y])
+    self.close_savefile(args)
+
+    self.printmsg(('Captured {0} frames, detected {1} chip candidates, '
+                   'matched {2}/{3} chips').format(len(points), len(found),
+                                                   len(matches), len(chips)))
+    missing = [c for c in chips if not c in matches]
+    if missing:
+      self.printwarn('Chips not found in mosaic: {0}'.format(' '.join(missing)))
+
+  @staticmethod
+  def match_chips(chips, expected, found, maxdist):
+    """
+    Greedy matching of detected chips to expected chip positions, closest pairs
+    first, with each detection used at most once.
+    """
+    if not len(found):
+      return {}
+    reco = np.array([[f.x, f.y] for f in found])
+    dist = np.linalg.norm(expected[:, np.newaxis, :] - reco[np.newaxis, :, :],
+                          axis=-1)
+    matches = {}
+    used = set()
+    for flatidx in np.argsort(dist, axis=None):
+      chipidx, recoidx = np.unravel_index(flatidx, dist.shape)
+      if dist[chipidx, recoidx] > maxdist:
+        break
+      if chips[chipidx] in matches or recoidx in used:
+        continue
+      matches[chips[chipidx]] = found[recoidx]
+      used.add(recoidx)
+    return matches
+
+
 class visualmaxsharp(cmdbase.controlcmd):
   """
   Moving the gantry so that the image sharpness is maximized
   """
+  DEVICES = ['gcoder', 'visual']
   LOG = log.GREEN('[VISMAXSHARP]')
 
   def __init__(self, cmd):
@@ -259,18 +651,30 @@ class visualzscan(cmdbase.controlcmd):
   Scanning focus to calibrate z distance
   """
 
+  DEVICES = ['gcoder', 'visual']
   DEFAULT_SAVEFILE = 'vscan_<CHIPID>_<TIMESTAMP>.txt'
   LOG = log.GREEN('[VISZSCAN]')
+  SAVEFILE_COLUMNS = [
+      ('x', 'f4', '{0:.1f}'),
+      ('y', 'f4', '{0:.1f}'),
+      ('z', 'f4', '{0:.1f}'),
+      ('sharpness', 'f8', '{0:.2f}'),
+      ('recox', 'f4', '{0:.1f}'),
+      ('recoy', 'f4', '{0:.1f}'),
+      ('area', 'f4', '{0:.1f}'),
+      ('maxmeas', 'f4', '{0:.1f}'),
+  ]
 
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
     self.add_savefile_options(visualzscan.DEFAULT_SAVEFILE)
     self.add_zscan_options()
+    self.add_adaptivez_options()
     self.parser.add_argument('-m',
                              '--monitor',
                              action='store_true',
                              help=('Whether or not to open a monitoring window '
-                                   '(could be slow!!)'))
+                                   '(rendered in a separate thread)'))
 
   def parse(self, line):
     args = cmdbase.controlcmd.parse(self, line)
@@ -279,6 +683,9 @@ class visualzscan(cmdbase.controlcmd):
     self.parse_savefile(args)
     return args
 
+  def expected_rows(self, args):
+    return args.maxpoints if args.adaptive else len(args.zlist)
+
   def run(self, args):
     self.init_handle()
     laplace = []
@@ -287,13 +694,14 @@ class visualzscan(cmdbase.controlcmd):
     reco_a = []
     reco_d = []
 
-    for z in args.zlist:
-      # Checking termination signal
-      self.check_handle(args)
-      self.move_gantry(args.x, args.y, z, False)
+    def process(frame):
+      # Sharpness is calculated first as the monitor draws onto a copy anyway.
+      return (self.visual.sharpness_frame(frame, False),
+              self.visual.find_chip_frame(frame, args.monitor))
 
-      reco = self.visual.find_chip(args.monitor)
-      laplace.append(self.visual.sharpness(args.monitor))
+    def collect(idx, position, result):
+      sharp, reco = result
+      laplace.append(sharp)
       reco_x.append(reco.x)
       reco_y.append(reco.y)
       reco_a.append(reco.area)
@@ -301,21 +709,39 @@ class visualzscan(cmdbase.controlcmd):
 
       # Writing to screen
       self.update('{0} | {1} | {2}'.format(
-          'x:{0:.1f} y:{1:.1f} z:{2:.1f}'.format(
-              self.gcoder.opx, self.gcoder.opy, self.gcoder.opz),
+          'x:{0:.1f} y:{1:.1f} z:{2:.1f}'.format(*position),
           'Sharpness:{0:.2f}'.format(laplace[-1]),
           'Reco x:{0:.1f} Reco y:{1:.1f} Area:{2:.1f} MaxD:{3:.1f}'.format(
               reco.x, reco.y, reco.area, reco.maxmeas)))
+      self.publish_progress(args,
+                            x=position[0],
+                            y=position[1],
+                            z=position[2],
+                            sharpness=laplace[-1],
+                            recox=reco.x,
+                            recoy=reco.y)
       # Writing to file
-      args.savefile.write('{0:.1f} {1:.1f} {2:.1f} '\
-                  '{3:.2f} '\
-                  '{4:.1f} {5:.1f} {6:.1f} {7:.1f}\n'.format(
-          self.gcoder.opx, self.gcoder.opy, self.gcoder.opz,
-          laplace[-1],
-          reco.x, reco.y, reco.area, reco.maxmeas
-          ))
-
-    cv2.destroyAllWindows()
+      args.savefile.write_row(position[0], position[1], position[2],
+                              laplace[-1], reco.x, reco.y, reco.area,
+                              reco.maxmeas)
+
+    # Image processing of each z point is overlapped with motion. In adaptive
+    # mode each refinement round is a separate pipelined scan, with the
+    # sharpness used to decide where to refine.
+    def measure(zlist):
+      self.visual_pipeline_scan(args, [(args.x, args.y, z) for z in zlist],
+                                process, collect)
+      return laplace[-len(zlist):]
+
+    if args.monitor:
+      self.visual.start_monitor(visualhscan.MONITOR_FPS)
+    try:
+      zvals, _ = self.adaptive_zscan(args, measure)
+    finally:
+      self.visual.stop_monitor()
+    self.close_savefile(args)
+    if args.adaptive:
+      self.printmsg('Measured {0:d} z points'.format(len(zvals)))
 
 
 #########################
@@ -326,6 +752,9 @@ class visualshowchip(cmdbase.controlcmd):
   """
   Long display of chip position, until termination signal is obtained.
   """
+
+  DEVICES = ['visual']
+
   def __init__(self, cmd):
     cmdbase.controlcmd.__init__(self, cmd)
 
@@ -333,8 +762,11 @@ class visualshowchip(cmdbase.controlcmd):
     return cmdbase.controlcmd.parse(self, line)
 
   def run(self, args):
-    while True:
-      self.visual.find_chip(True)
-      if cv2.waitKey(100) > 0:  ## If any key is pressed
-        break
-    cv2.destroyAllWindows()
+    self.init_handle()
+    self.visual.start_monitor(visualhscan.MONITOR_FPS)
+    try:
+      while not self.sighandle.terminate:
+        self.visual.find_chip(True)
+        time.sleep(1.0 / visualhscan.MONITOR_FPS)
+    finally:
+      self.visual.stop_monitor()
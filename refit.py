@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Offline refitting of stored scan files. The output files of the halign,
+halign3d and visualhscan commands in the given directories are parsed and
+refitted in parallel, and the results are written into a single calibration
+json file that can be loaded into a session with the loadcalib command.
+
+Usage: python3 refit.py -o calib.json [--boardtype cfg/board.json] DIR [DIR...]
+"""
+import cmod.fitting as fitting
+import cmod.datafile as datafile
+import numpy as np
+import concurrent.futures
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+
+## Filename prefixes of the default save files, matched to the fit routine
+## used. The longer prefixes should be listed first.
+FILE_TYPES = [
+    ('halign3d_', 'lumi3d'),
+    ('halign_', 'lumi'),
+    ('vhscan_', 'visM'),
+]
+
+## Chip ID used by the control commands if no chip ID was specified
+DEFAULT_CHIPID = '-100'
+
+
+def load_scan(filename):
+  """
+  Loading the whitespace separated columns of a scan file into a 2D array with
+  a single vectorized parse of the file contents.
+  """
+  with datafile.open_text(filename) as f:
+    content = f.read()
+  lines = content.strip().split('\n', 1)
+  if not lines[0]:
+    return np.empty((0, 0))
+  ncols = len(lines[0].split())
+  data = np.fromstring(content, sep=' ')
+  if len(data) % ncols:
+    raise Exception('Inconsistent number of columns in file')
+  return data.reshape(-1, ncols)
+
+
+def file_type(filename):
+  base = os.path.basename(filename)
+  for prefix, kind in FILE_TYPES:
+    if base.startswith(prefix):
+      return kind
+  return None
+
+
+def file_chipid(filename):
+  """
+  Chip ID from the <CHIPID> placeholder of the filename, which is expanded to
+  "chipid<ID>" when the save file is created.
+  """
+  match = re.search(r'chipid(-?\d+)', os.path.basename(filename))
+  return match.group(1) if match else DEFAULT_CHIPID
+
+
+def refit_file(filename):
+  """
+  Refitting a single file. Returns a tuple of the calibration type, chip ID
+  and a list of (z, result) pairs. Exceptions are returned as strings so that
+  a single bad file does not stop the processing of the others.
+  """
+  try:
+    kind = file_type(filename)
+    chipid = file_chipid(filename)
+    data = load_scan(filename)
+    if len(data) == 0:
+      raise Exception('File is empty')
+
+    if kind == 'lumi':
+      x, y, z, lumi, unc = data[:, :5].T
+      lumi = np.abs(lumi)
+      fitval, fitcovar = fitting.fit_halign(
+          x, y, lumi, unc, fitting.halign_guess(x, y, lumi, z[0]))
+      return kind, chipid, [(round(z[0], 1), [
+          fitval[1], np.sqrt(fitcovar[1][1]), fitval[2],
+          np.sqrt(fitcovar[2][2])
+      ])]
+    elif kind == 'lumi3d':
+      x, y, z, lumi, unc = data[:, :5].T
+      lumi = np.abs(lumi)
+      zref = np.mean(np.unique(z))
+      zvals = np.unique(z)
+      pedestal = [np.min(lumi[z == zval]) for zval in zvals]
+      mask = z == zvals[0]
+      N, x0, y0, _, _ = fitting.halign_guess(x[mask], y[mask], lumi[mask],
+                                             zvals[0])
+      fitval, fitcovar, zvals = fitting.fit_halign3d(
+          x, y, z, lumi, unc, [N, x0, y0, 0, 0, 0] + pedestal, zref)
+      return kind, chipid, [
+          (round(zval, 1),
+           fitting.halign3d_center(fitval, fitcovar, zval, zref))
+          for zval in zvals
+      ]
+    elif kind == 'visM':
+      x, y, z, recox, recoy = data[:, :5].T
+      return kind, chipid, [(round(z[0], 1),
+                             fitting.fit_visM(x, y, recox, recoy)['visM'])]
+    else:
+      raise Exception('Unknown file type')
+  except Exception as err:
+    return None, filename, str(err)
+
+
+def board_chips(filename):
+  with open(filename, 'r') as f:
+    return [str(key) for key in json.load(f)['default coordinate']]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description=('Refitting the stored scan files of the calibration '
+                   'commands, generating a calibration file that can be '
+                   'loaded by the loadcalib command'))
+  parser.add_argument('dirs',
+                      nargs='+',
+                      help='Directories (or files) containing the scan files')
+  parser.add_argument('-o',
+                      '--output',
+                      type=str,
+                      required=True,
+                      help='Output calibration json file')
+  parser.add_argument('--boardtype',
+                      type=str,
+                      help=('Board type json file, used to list every chip in '
+                            'the output, which is required by loadcalib'))
+  parser.add_argument('-j',
+                      '--jobs',
+                      type=int,
+                      default=os.cpu_count(),
+                      help='Number of parallel processes')
+  args = parser.parse_args()
+
+  files = []
+  for path in args.dirs:
+    if os.path.isdir(path):
+      files.extend(glob.glob(os.path.join(path, '*.txt')))
+      files.extend(glob.glob(os.path.join(path, '*.txt.*')))
+    else:
+      files.extend(glob.glob(path))
+  files = [f for f in files if file_type(f)]
+  # Results of newer files take precedence for the same chip and z value
+  files.sort(key=os.path.getmtime)
+
+  calib = {'lumi': {}, 'visM': {}}
+  if args.boardtype:
+    for chip in board_chips(args.boardtype):
+      calib['lumi'][chip] = {}
+      calib['visM'][chip] = {}
+
+  nfail = 0
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    for kind, chipid, results in pool.map(refit_file, files, chunksize=4):
+      if kind is None:
+        print('Failed to refit file [{0}]: {1}'.format(chipid, results),
+              file=sys.stderr)
+        nfail += 1
+        continue
+      target = calib['visM' if kind == 'visM' else 'lumi']
+      target.setdefault(chipid, {})
+      for z, result in results:
+        target[chipid][z] = [
+            list(map(float, r)) if hasattr(r, '__len__') else float(r)
+            for r in result
+        ]
+
+  ## Chip lists must be consistent across all calibration types
+  for chip in set(calib['lumi']) | set(calib['visM']):
+    calib['lumi'].setdefault(chip, {})
+    calib['visM'].setdefault(chip, {})
+
+  with open(args.output, 'w') as f:
+    f.write(
+        json.dumps(
+            {
+                'Lumi scan calibration': calib['lumi'],
+                'FOV scan calibration': {chip: {}
+                                         for chip in calib['lumi']},
+                'FOV transformation matrix': calib['visM']
+            },
+            indent=2))
+
+  print('Refitted {0:d} files ({1:d} failed), results written to [{2}]'.format(
+      len(files) - nfail, nfail, args.output))
@@ -297,18 +297,37 @@ const float GCoder::_max_x = 345;
 const float GCoder::_max_y = 450;
 const float GCoder::_max_z = 460;
 
+#include "gil.hpp"
 #include <boost/python.hpp>
 
+// Gantry motion blocks until the target position is reached, releasing the GIL
+// so that python threads (image processing... etc) can run in the mean time.
+static void
+moveto_nogil( GCoder& self, float x, float y, float z, const bool verbose )
+{
+  ReleaseGIL nogil;
+  self.MoveTo( x, y, z, verbose );
+}
+
+// Printer initialization waits for the printer to reset and home, releasing
+// the GIL so that the other devices can be initialized in parallel.
+static void
+initprinter_nogil( GCoder& self, const std::string& dev )
+{
+  ReleaseGIL nogil;
+  self.InitPrinter( dev );
+}
+
 BOOST_PYTHON_MODULE( gcoder )
 {
   boost::python::class_<GCoder>( "GCoder" )
   // .def( boost::python::init<const std::string&>() )
-  .def( "initprinter",     &GCoder::InitPrinter )
+  .def( "initprinter",     &initprinter_nogil )
   // Hiding functions from python
   // .def( "pass_gcode",       &GCoder::pass_gcode )
   .def( "getsettings",     &GCoder::GetSettings )
   .def( "set_speed_limit", &GCoder::SetSpeedLimit )
-  .def( "moveto",          &GCoder::MoveTo )
+  .def( "moveto",          &moveto_nogil )
   .def_readonly( "dev_path", &GCoder::dev_path )
   .def_readonly( "opx",      &GCoder::opx )
   .def_readonly( "opy",      &GCoder::opy )
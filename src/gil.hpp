@@ -0,0 +1,25 @@
+/**
+ * @file gil.hpp
+ * @brief Helper object for releasing the python global interpreter lock
+ *
+ * Long blocking calls (gantry motion, image processing... etc) should release
+ * the GIL so that other python threads can continue running in the mean time.
+ * The object should only be constructed in the python binding functions, and
+ * the wrapped function must not touch any python objects.
+ */
+#ifndef GIL_HPP
+#define GIL_HPP
+
+#include <Python.h>
+
+class ReleaseGIL
+{
+public:
+  ReleaseGIL() : _state( PyEval_SaveThread() ){}
+  ~ReleaseGIL(){ PyEval_RestoreThread( _state ); }
+
+private:
+  PyThreadState* _state;
+};
+
+#endif
@@ -64,6 +64,15 @@ PicoUnit::VoltageRangeMax() const
   return PS5000_20V;
 }
 
+float
+PicoUnit::VoltageRangeValue( const int index ) const
+{
+  if( index < 0 || index >= PS5000_MAX_RANGES ){
+    throw std::out_of_range( "Voltage range index out of range" );
+  }
+  return inputRanges[index];
+}
+
 void
 PicoUnit::SetVoltageRange( const int newrange )
 {
@@ -467,15 +476,26 @@ PicoUnit::findTimeInterval()
 
 /** BOOST PYTHON STUFF */
 
+#include "gil.hpp"
 #include <boost/python.hpp>
 
+// Opening the device takes a few seconds, releasing the GIL so that the other
+// devices can be initialized in parallel.
+static void
+init_nogil( PicoUnit& self )
+{
+  ReleaseGIL nogil;
+  self.Init();
+}
+
 BOOST_PYTHON_MODULE( pico )
 {
   boost::python::class_<PicoUnit, boost::noncopyable>( "PicoUnit" )
-  .def( "init",             &PicoUnit::Init            )
+  .def( "init",             &init_nogil                )
   .def( "settrigger",       &PicoUnit::SetTrigger      )
   .def( "rangemin",         &PicoUnit::VoltageRangeMin )
   .def( "rangemax",         &PicoUnit::VoltageRangeMax )
+  .def( "rangevalue",       &PicoUnit::VoltageRangeValue )
   .def( "setrange",         &PicoUnit::SetVoltageRange )
   .def( "setblocknums",     &PicoUnit::SetBlockNums    )
   .def( "startrapidblocks", &PicoUnit::StartRapidBlock )
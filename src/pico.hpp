@@ -17,6 +17,7 @@ public:
 
   int VoltageRangeMax() const ;
   int VoltageRangeMin() const ;
+  float VoltageRangeValue( const int index ) const ;
   void SetVoltageRange( int newrange );
 
   void SetTrigger(
@@ -5,6 +5,8 @@
 #include <opencv2/imgproc.hpp>
 
 #include <chrono>
+#include <climits>
+#include <mutex>
 #include <thread>
 
 // Helper objects for consistant display BGR
@@ -19,10 +21,21 @@ static const auto __dummy_settings
   = cv::utils::logging::setLogLevel( cv::utils::logging::LOG_LEVEL_SILENT );
 
 
-Visual::Visual() : cam(){}
-Visual::~Visual(){}
+Visual::Visual() :
+  cam(),
+  _monitor_fresh( false ),
+  _monitor_run( false )
+{}
 
-Visual::Visual( const std::string& dev ) : cam()
+Visual::~Visual()
+{
+  stop_monitor();
+}
+
+Visual::Visual( const std::string& dev ) :
+  cam(),
+  _monitor_fresh( false ),
+  _monitor_run( false )
 {
   init_dev( dev );
 }
@@ -54,81 +67,146 @@ Visual::frame_height() const
   return cam.get( cv::CAP_PROP_FRAME_HEIGHT );
 }
 
+cv::Mat
+Visual::get_frame()
+{
+  cv::Mat img;
+  getImg( img );
+  return img;
+}
+
 Visual::ChipResult
 Visual::find_chip( const bool monitor )
 {
-  // Magic numbers that will need some method of adjustment
+  cv::Mat img;
+  getImg( img );
+  return find_chip_frame( img, monitor );
+}
+
+// Status of a contour as a photosensor candidate
+enum CandidateStatus
+{
+  CAND_SMALL,
+  CAND_RATIO,
+  CAND_LUMI,
+  CAND_RECT,
+  CAND_PASS
+};
+
+// Magic numbers that will need some method of adjustment
+static const int minchipsize = 50;// In pixels of the raw camera frame
+
+static void
+find_contours( const cv::Mat& img,
+               std::vector<std::vector<cv::Point> >& contours )
+{
   static const cv::Size blursize( 5, 5 );
-  static const int minthreshold   = 80;
-  static const int maxthreshold   = 255;// this doesn't need to change.
+  static const int minthreshold = 80;
+  static const int maxthreshold = 255;// this doesn't need to change.
+
+  cv::Mat gray_img;
+  std::vector<cv::Vec4i> hierarchy;
+
+  // Standard image processing.
+  cv::cvtColor( img, gray_img, cv::COLOR_BGR2GRAY );
+  cv::blur( gray_img, gray_img, blursize );
+  cv::threshold( gray_img, gray_img,
+    minthreshold, maxthreshold,
+    cv::THRESH_BINARY );
+  cv::findContours( gray_img, contours, hierarchy,
+    cv::RETR_TREE, cv::CHAIN_APPROX_SIMPLE, cv::Point( 0, 0 ) );
+}
+
+static CandidateStatus
+check_candidate( const cv::Mat&                img,
+                 const std::vector<cv::Point>& contour,
+                 const double                  minsize,
+                 std::vector<cv::Point>&       hull )
+{
   static const double maxchiplumi = 40;
-  static const int minchipsize    = 50;
   static const double chipratio   = 1.4;
 
-  // Drawing variables
-  static const std::string winname = "FINDCHIP_MONITOR";
-  char msg[1024];
+  std::vector<cv::Point> polyapprox;
+
+  // Size and dimesion estimation from bounding rectangle
+  const cv::Rect bound = cv::boundingRect( contour );
+  const double ratio   = (double)bound.height / (double)bound.width;
+  const double size    = std::max( bound.height, bound.width );
+  if( size < minsize ){ return CAND_SMALL; }// skipping small speckles
+
+  // Expecting the ratio of the bounding box to be square.
+  if( ratio > chipratio || ratio < 1./chipratio ){
+    return CAND_RATIO;
+  }
 
+  // Expecting the internals of of the photosensor to be dark. The mask is
+  // only made over the bounding box to keep this cheap for large images.
+  cv::Mat mask = cv::Mat::zeros( bound.size(), CV_8UC1 );
+  cv::drawContours( mask,
+    std::vector<std::vector<cv::Point> >( 1, contour ), 0,
+    255, cv::FILLED, cv::LINE_8, cv::noArray(), INT_MAX, -bound.tl() );
+  const cv::Scalar meancol = cv::mean( img( bound ), mask );
+  const double lumi        = 0.2126*meancol[0]
+                             + 0.7152*meancol[1]
+                             + 0.0722*meancol[2];
+  if( lumi > maxchiplumi ){
+    return CAND_LUMI;
+  }// Photosensors are dark.
+
+  // Generating convex hull
+  cv::convexHull( cv::Mat( contour ), hull );
+
+  // Convex hull should be sufficiently rectangular
+  cv::approxPolyDP( hull, polyapprox, size*0.08, true );
+  if( polyapprox.size() != 4 ){
+    return CAND_RECT;
+  }
+
+  return CAND_PASS;
+}
+
+static Visual::ChipResult
+hull_result( const std::vector<cv::Point>& hull )
+{
+  // position calculation of final contour
+  cv::Moments m = cv::moments( hull, false );
+
+  // Maximum distance in contour
+  double distmax = 0;
+
+  for( const auto& p1 : hull ){
+    for( const auto& p2 : hull ){
+      distmax = std::max( distmax, cv::norm( p2-p1 ) );
+    }
+  }
+
+  return Visual::ChipResult{ m.m10/m.m00, m.m01/m.m00,  m.m00, distmax};
+}
+
+Visual::ChipResult
+Visual::find_chip_frame( const cv::Mat& img, const bool monitor )
+{
   // Operational variables
-  cv::Mat img, gray_img;
   std::vector<std::vector<cv::Point> > contours;
   std::vector<std::vector<cv::Point> > hulls;
-  std::vector<cv::Vec4i> hierarchy;
-  std::vector<cv::Point> polyapprox;
 
   std::vector<std::vector<cv::Point> > failed_ratio;
   std::vector<std::vector<cv::Point> > failed_lumi;
   std::vector<std::vector<cv::Point> > failed_rect;
   std::vector<std::vector<cv::Point> > failed_largest;
 
-
-  // Getting image
-  getImg( img );
-
-  // Standard image processing.
-  cv::cvtColor( img, gray_img, cv::COLOR_BGR2GRAY );
-  cv::blur( gray_img, gray_img, blursize );
-  cv::threshold( gray_img, gray_img,
-    minthreshold, maxthreshold,
-    cv::THRESH_BINARY );
-  cv::findContours( gray_img, contours, hierarchy,
-    cv::RETR_TREE, cv::CHAIN_APPROX_SIMPLE, cv::Point( 0, 0 ) );
+  find_contours( img, contours );
 
   // Calculating all contour properties
   for( unsigned i = 0; i < contours.size(); i++ ){
-    // Size and dimesion estimation from bounding rectangle
-    const cv::Rect bound = cv::boundingRect( contours.at( i ) );
-    const double ratio   = (double)bound.height / (double)bound.width;
-    const double size    = std::max( bound.height, bound.width );
-    if( size < minchipsize ){ continue; }// skipping small speckles
-
-    // Expecting the ratio of the bounding box to be square.
-    if( ratio > chipratio || ratio < 1./chipratio ){
-      failed_ratio.push_back( contours.at( i ) );
-      continue;
-    }
-
-    // Expecting the internals of of the photosensor to be dark.
-    cv::Mat mask = cv::Mat::zeros( img.size(), CV_8UC1 );
-    cv::drawContours( mask, contours, i, 255, cv::FILLED );
-    const cv::Scalar meancol = cv::mean( img, mask );
-    const double lumi        = 0.2126*meancol[0]
-                               + 0.7152*meancol[1]
-                               + 0.0722*meancol[2];
-    if( lumi > maxchiplumi ){
-      failed_lumi.push_back( contours.at( i ) );
-      continue;
-    }// Photosensors are dark.
-
-    // Generating convex hull
     std::vector<cv::Point> hull;
-    cv::convexHull( cv::Mat( contours.at( i ) ), hull );
 
-    // Convex hull should be sufficiently rectangular
-    cv::approxPolyDP( hull, polyapprox, size*0.08, true );
-    if( polyapprox.size() != 4 ){
-      failed_rect.push_back( contours.at( i ) );
-      continue;
+    switch( check_candidate( img, contours.at( i ), minchipsize, hull ) ){
+    case CAND_SMALL: continue;
+    case CAND_RATIO: failed_ratio.push_back( contours.at( i ) ); continue;
+    case CAND_LUMI:  failed_lumi.push_back( contours.at( i ) ); continue;
+    case CAND_RECT:  failed_rect.push_back( contours.at( i ) ); continue;
+    case CAND_PASS:  break;
     }
 
     // Only keeping largest convex hull
@@ -151,101 +229,240 @@ Visual::find_chip( const bool monitor )
   if( hulls.empty() ){
     ans = ChipResult{ -1, -1, 0, 0 };
   } else {
-    // position calculation of final contour
-    cv::Moments m = cv::moments( hulls.at( 0 ), false );
+    ans = hull_result( hulls.at( 0 ) );
+  }
 
-    // Maximum distance in contour
-    double distmax = 0;
+  // Passing the results to the display thread, the drawing is done there so
+  // that the detection is not slowed down by the monitor.
+  if( monitor ){
+    std::lock_guard<std::mutex> lock( _monitor_mutex );
+    _monitor_data.img            = img.clone();
+    _monitor_data.failed_ratio   = std::move( failed_ratio );
+    _monitor_data.failed_lumi    = std::move( failed_lumi );
+    _monitor_data.failed_rect    = std::move( failed_rect );
+    _monitor_data.failed_largest = std::move( failed_largest );
+    _monitor_data.hulls          = std::move( hulls );
+    _monitor_data.ans            = ans;
+    _monitor_fresh               = true;
+  }
 
-    for( const auto& p1 : hulls.at( 0 ) ){
-      for( const auto& p2 : hulls.at( 0 ) ){
-        distmax = std::max( distmax, cv::norm( p2-p1 ) );
-      }
-    }
+  return ans;
+}
 
-    ans = ChipResult{ m.m10/m.m00, m.m01/m.m00,  m.m00, distmax};
-  }
+double
+Visual::sharpness( const bool monitor )
+{
+  cv::Mat img;
+  getImg( img );
+  return sharpness_frame( img, monitor );
+}
 
-  // Plotting final calculation results
-  if( monitor ){
-    // Window will be created, if already exists, this function does nothing
-    cv::namedWindow( winname, cv::WINDOW_AUTOSIZE );
+double
+Visual::sharpness_frame( const cv::Mat& frame, const bool monitor )
+{
+  // Image containers
+  cv::Mat img, lap;
 
-    // Generating the image
-    cv::Mat display( img );
+  // Variable containers
+  cv::Scalar mu, sigma;
 
-    // for( unsigned i = 0; i < contours.size(); ++i ){
-    //   cv::drawContours( display, contours, i, white, 2 );
-    // }
+  // Converting to gray scale
+  cv::cvtColor( frame, img, cv::COLOR_BGR2GRAY );
 
-    for( unsigned i = 0; i < failed_ratio.size(); ++i ){
-      cv::drawContours( display, failed_ratio, i, white );
-    }
+  // Calculating lagrangian.
+  cv::Laplacian( img, lap, CV_64F, 5 );
+  cv::meanStdDev( lap, mu, sigma );
+  return sigma.val[0] * sigma.val[0];
+}
 
-    cv::putText( display, "FAILED RATIO",
-      cv::Point( 50, 700 ), cv::FONT_HERSHEY_SIMPLEX, 2, white  );
+void
+Visual::mosaic_init(
+  const double xmin,
+  const double ymin,
+  const double xmax,
+  const double ymax,
+  const double pixpermm )
+{
+  _mosaic_xmin     = xmin;
+  _mosaic_ymin     = ymin;
+  _mosaic_pixpermm = pixpermm;
+  _mosaic = cv::Mat::zeros(
+    std::ceil( ( ymax - ymin ) * pixpermm ),
+    std::ceil( ( xmax - xmin ) * pixpermm ),
+    CV_8UC3 );
+}
 
-    for( unsigned i = 0; i < failed_lumi.size(); ++i ){
-      cv::drawContours( display, failed_lumi, i, green );
-    }
+void
+Visual::mosaic_add(
+  const cv::Mat& frame,
+  const double   gantryx,
+  const double   gantryy,
+  const double   m00,
+  const double   m01,
+  const double   m10,
+  const double   m11 )
+{
+  // A point at pixel p in a frame taken at gantry position g would be in the
+  // center of the field of view c at gantry position W = g - M^-1 (p - c). The
+  // mosaic pixel is then q = s (W - Wmin), which is affine in p.
+  const double s   = _mosaic_pixpermm;
+  const double det = m00 * m11 - m01 * m10;
+  const double i00 = m11 / det;
+  const double i01 = -m01 / det;
+  const double i10 = -m10 / det;
+  const double i11 = m00 / det;
+  const double cx  = frame.cols / 2.0;
+  const double cy  = frame.rows / 2.0;
+
+  const double bx = s * ( gantryx - _mosaic_xmin + i00 * cx + i01 * cy );
+  const double by = s * ( gantryy - _mosaic_ymin + i10 * cx + i11 * cy );
+  const cv::Mat affine = ( cv::Mat_<double>( 2, 3 )
+                           << -s * i00, -s * i01, bx,
+                           -s * i10, -s * i11, by );
+
+  // Transparent border so frames are only pasted where they have content.
+  cv::warpAffine( frame, _mosaic, affine, _mosaic.size(),
+    cv::INTER_LINEAR, cv::BORDER_TRANSPARENT );
+}
 
-    cv::putText( display, "FAILED LUMI",
-      cv::Point( 50, 750 ), cv::FONT_HERSHEY_SIMPLEX, 2, green  );
+std::vector<Visual::ChipResult>
+Visual::mosaic_find_chips( const double rawpixpermm ) const
+{
+  // Minimum chip size is defined in raw frame pixels
+  const double scale = _mosaic_pixpermm / rawpixpermm;
+  std::vector<std::vector<cv::Point> > contours;
+  std::vector<ChipResult> ans;
 
-    for( unsigned i = 0; i < failed_rect.size(); ++i ){
-      cv::drawContours( display, failed_rect, i, yellow );
-    }
+  find_contours( _mosaic, contours );
 
-    cv::putText( display, "FAILED RECT",
-      cv::Point( 50, 800 ), cv::FONT_HERSHEY_SIMPLEX, 2, yellow  );
+  for( const auto& contour : contours ){
+    std::vector<cv::Point> hull;
+    if( check_candidate( _mosaic, contour, minchipsize * scale, hull )
+        != CAND_PASS ){ continue; }
+
+    // Converting to gantry coordinates [mm]
+    ChipResult res = hull_result( hull );
+    res.x        = res.x / _mosaic_pixpermm + _mosaic_xmin;
+    res.y        = res.y / _mosaic_pixpermm + _mosaic_ymin;
+    res.area    /= _mosaic_pixpermm * _mosaic_pixpermm;
+    res.maxmeas /= _mosaic_pixpermm;
+    ans.push_back( res );
+  }
 
-    for( unsigned i = 0; i < failed_largest.size(); ++i ){
-      cv::drawContours( display, failed_largest, i, cyan );
-    }
+  return ans;
+}
 
-    cv::putText( display, "FAILED LARGEST",
-      cv::Point( 50, 850 ), cv::FONT_HERSHEY_SIMPLEX, 2, cyan  );
-
-
-    if( hulls.empty() ){
-      cv::putText( display, "NOT FOUND",
-        cv::Point( 50, 100 ),
-        cv::FONT_HERSHEY_SIMPLEX,
-        1, red );
-    } else {
-      sprintf( msg, "x:%.1lf y:%.1lf", ans.x, ans.y ),
-      cv::drawContours( display, hulls, 0, red, 3 );
-      cv::circle( display, cv::Point( ans.x, ans.y ), 3, red, cv::FILLED );
-      cv::putText( display, msg,
-        cv::Point( 50, 100 ),
-        cv::FONT_HERSHEY_SIMPLEX,
-        2, red );
+void
+Visual::mosaic_save( const std::string& filename ) const
+{
+  imwrite( filename, _mosaic );
+}
+
+void
+Visual::start_monitor( const double maxfps )
+{
+  if( _monitor_run ){ return; }
+  _monitor_fresh = false;
+  _monitor_run   = true;
+  _monitor_thread = std::thread( &Visual::monitor_loop, this, maxfps );
+}
+
+void
+Visual::stop_monitor()
+{
+  if( !_monitor_run ){ return; }
+  _monitor_run = false;
+  _monitor_thread.join();
+}
+
+void
+Visual::monitor_loop( const double maxfps )
+{
+  static const std::string winname = "FINDCHIP_MONITOR";
+  const int waittime = std::max( 1, int( 1000 / maxfps ) );
+
+  // All GUI calls are made in this thread.
+  cv::namedWindow( winname, cv::WINDOW_AUTOSIZE );
+
+  while( _monitor_run ){
+    MonitorData data;
+    bool fresh = false;
+    {
+      std::lock_guard<std::mutex> lock( _monitor_mutex );
+      if( _monitor_fresh ){
+        std::swap( data, _monitor_data );
+        _monitor_fresh = false;
+        fresh          = true;
+      }
     }
 
-    imshow( winname, display );
-    cv::waitKey( 30 );
+    // Only the latest result is ever rendered, older results are dropped.
+    if( fresh ){
+      cv::imshow( winname, draw_monitor( data ) );
+    }
+    cv::waitKey( waittime );// Handling GUI events also caps the frame rate
   }
 
-  return ans;
+  cv::destroyWindow( winname );
+  cv::waitKey( 1 );
 }
 
-double
-Visual::sharpness( const bool monitor )
+cv::Mat&
+Visual::draw_monitor( MonitorData& data )
 {
-  // Image containers
-  cv::Mat img, lap;
+  char msg[1024];
+  cv::Mat& display = data.img;
 
-  // Variable containers
-  cv::Scalar mu, sigma;
+  // for( unsigned i = 0; i < contours.size(); ++i ){
+  //   cv::drawContours( display, contours, i, white, 2 );
+  // }
 
-  // Getting image converting to gray scale
-  getImg( img );
-  cv::cvtColor( img, img, cv::COLOR_BGR2GRAY );
+  for( unsigned i = 0; i < data.failed_ratio.size(); ++i ){
+    cv::drawContours( display, data.failed_ratio, i, white );
+  }
 
-  // Calculating lagrangian.
-  cv::Laplacian( img, lap, CV_64F, 5 );
-  cv::meanStdDev( lap, mu, sigma );
-  return sigma.val[0] * sigma.val[0];
+  cv::putText( display, "FAILED RATIO",
+    cv::Point( 50, 700 ), cv::FONT_HERSHEY_SIMPLEX, 2, white  );
+
+  for( unsigned i = 0; i < data.failed_lumi.size(); ++i ){
+    cv::drawContours( display, data.failed_lumi, i, green );
+  }
+
+  cv::putText( display, "FAILED LUMI",
+    cv::Point( 50, 750 ), cv::FONT_HERSHEY_SIMPLEX, 2, green  );
+
+  for( unsigned i = 0; i < data.failed_rect.size(); ++i ){
+    cv::drawContours( display, data.failed_rect, i, yellow );
+  }
+
+  cv::putText( display, "FAILED RECT",
+    cv::Point( 50, 800 ), cv::FONT_HERSHEY_SIMPLEX, 2, yellow  );
+
+  for( unsigned i = 0; i < data.failed_largest.size(); ++i ){
+    cv::drawContours( display, data.failed_largest, i, cyan );
+  }
+
+  cv::putText( display, "FAILED LARGEST",
+    cv::Point( 50, 850 ), cv::FONT_HERSHEY_SIMPLEX, 2, cyan  );
+
+
+  if( data.hulls.empty() ){
+    cv::putText( display, "NOT FOUND",
+      cv::Point( 50, 100 ),
+      cv::FONT_HERSHEY_SIMPLEX,
+      1, red );
+  } else {
+    sprintf( msg, "x:%.1lf y:%.1lf", data.ans.x, data.ans.y ),
+    cv::drawContours( display, data.hulls, 0, red, 3 );
+    cv::circle( display, cv::Point( data.ans.x, data.ans.y ), 3, red,
+      cv::FILLED );
+    cv::putText( display, msg,
+      cv::Point( 50, 100 ),
+      cv::FONT_HERSHEY_SIMPLEX,
+      2, red );
+  }
+
+  return display;
 }
 
 void
@@ -268,14 +485,89 @@ Visual::save_frame( const std::string& filename )
 }
 
 
+#include "gil.hpp"
 #include <boost/python.hpp>
 
+// Frame capture and processing can take a while, releasing the GIL so that the
+// python side can move the gantry in parallel.
+static cv::Mat
+get_frame_nogil( Visual& self )
+{
+  ReleaseGIL nogil;
+  return self.get_frame();
+}
+
+static Visual::ChipResult
+find_chip_frame_nogil( Visual& self, const cv::Mat& img, const bool monitor )
+{
+  ReleaseGIL nogil;
+  return self.find_chip_frame( img, monitor );
+}
+
+static double
+sharpness_frame_nogil( Visual& self, const cv::Mat& img, const bool monitor )
+{
+  ReleaseGIL nogil;
+  return self.sharpness_frame( img, monitor );
+}
+
+static void
+mosaic_add_nogil( Visual& self, const cv::Mat& frame,
+                  const double gantryx, const double gantryy,
+                  const double m00, const double m01,
+                  const double m10, const double m11 )
+{
+  ReleaseGIL nogil;
+  self.mosaic_add( frame, gantryx, gantryy, m00, m01, m10, m11 );
+}
+
+static boost::python::list
+mosaic_find_chips_list( const Visual& self, const double rawpixpermm )
+{
+  std::vector<Visual::ChipResult> chips;
+  {
+    ReleaseGIL nogil;
+    chips = self.mosaic_find_chips( rawpixpermm );
+  }
+
+  boost::python::list ans;
+
+  for( const auto& chip : chips ){
+    ans.append( chip );
+  }
+
+  return ans;
+}
+
+static void
+init_dev_nogil( Visual& self, const std::string& dev )
+{
+  ReleaseGIL nogil;
+  self.init_dev( dev );
+}
+
+static void
+stop_monitor_nogil( Visual& self )
+{
+  ReleaseGIL nogil;
+  self.stop_monitor();
+}
+
 BOOST_PYTHON_MODULE( visual )
 {
-  boost::python::class_<Visual>( "Visual" )
-  .def( "init_dev",     &Visual::init_dev )
-  .def( "find_chip",    &Visual::find_chip )
-  .def( "sharpness",    &Visual::sharpness )
+  boost::python::class_<Visual, boost::noncopyable>( "Visual" )
+  .def( "init_dev",        &init_dev_nogil )
+  .def( "find_chip",       &Visual::find_chip )
+  .def( "sharpness",       &Visual::sharpness )
+  .def( "get_frame",       &get_frame_nogil )
+  .def( "find_chip_frame", &find_chip_frame_nogil )
+  .def( "sharpness_frame", &sharpness_frame_nogil )
+  .def( "start_monitor",   &Visual::start_monitor )
+  .def( "stop_monitor",    &stop_monitor_nogil )
+  .def( "mosaic_init",       &Visual::mosaic_init )
+  .def( "mosaic_add",        &mosaic_add_nogil )
+  .def( "mosaic_find_chips", &mosaic_find_chips_list )
+  .def( "mosaic_save",       &Visual::mosaic_save )
   .def( "save_frame",   &Visual::save_frame )
   .def( "frame_width",  &Visual::frame_width )
   .def( "frame_height", &Visual::frame_height )
@@ -288,4 +580,8 @@ BOOST_PYTHON_MODULE( visual )
   .def_readwrite( "area",    &Visual::ChipResult::area )
   .def_readwrite( "maxmeas", &Visual::ChipResult::maxmeas )
   ;
+  // Opaque handle to a captured frame, only to be passed back to the
+  // processing functions.
+  boost::python::class_<cv::Mat>( "Frame" )
+  ;
 }
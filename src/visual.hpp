@@ -8,6 +8,11 @@
 #include <opencv2/highgui/highgui.hpp>
 #include <opencv2/videoio.hpp>
 
+#include <atomic>
+#include <mutex>
+#include <thread>
+#include <vector>
+
 class Visual
 {
 public:
@@ -28,14 +33,62 @@ public:
   ChipResult find_chip( const bool );
   double sharpness( const bool );
 
+  // Methods for processing frames that have already been captured, allowing
+  // the image processing to be performed while the gantry is moving.
+  cv::Mat get_frame();
+  ChipResult find_chip_frame( const cv::Mat&, const bool );
+  double sharpness_frame( const cv::Mat&, const bool );
+
   void save_frame( const std::string& filename );
 
+  // Board mosaic: frames are placed in gantry coordinates using the visual
+  // transformation matrix, so that all chips can be detected in one pass.
+  void mosaic_init( const double xmin, const double ymin,
+                    const double xmax, const double ymax,
+                    const double pixpermm );
+  void mosaic_add( const cv::Mat& frame,
+                   const double gantryx, const double gantryy,
+                   const double m00, const double m01,
+                   const double m10, const double m11 );
+  std::vector<ChipResult> mosaic_find_chips( const double rawpixpermm ) const;
+  void mosaic_save( const std::string& filename ) const;
+
+  // Monitor window is rendered in a separate display thread, using the latest
+  // results of find_chip calls with the monitor flag.
+  void start_monitor( const double maxfps );
+  void stop_monitor();
+
   unsigned frame_width() const ;
   unsigned frame_height() const;
 
 private:
   cv::VideoCapture cam;
   void getImg( cv::Mat& );
+
+  // Everything needed to draw the detection results.
+  struct MonitorData {
+    cv::Mat img;
+    std::vector<std::vector<cv::Point> > failed_ratio;
+    std::vector<std::vector<cv::Point> > failed_lumi;
+    std::vector<std::vector<cv::Point> > failed_rect;
+    std::vector<std::vector<cv::Point> > failed_largest;
+    std::vector<std::vector<cv::Point> > hulls;
+    ChipResult ans;
+  };
+
+  cv::Mat _mosaic;
+  double _mosaic_xmin;
+  double _mosaic_ymin;
+  double _mosaic_pixpermm;
+
+  MonitorData _monitor_data;
+  bool _monitor_fresh;
+  std::mutex _monitor_mutex;
+  std::atomic<bool> _monitor_run;
+  std::thread _monitor_thread;
+
+  void monitor_loop( const double maxfps );
+  static cv::Mat& draw_monitor( MonitorData& );
 };
 
 #endif
@@ -0,0 +1,288 @@
+"""
+Tests of the background uploader of cmod/sshfiler.py against an in-process SFTP
+server on localhost, serving a temporary directory. Run from the repository
+root with:
+
+  python3 -m unittest discover -s tests -t .
+"""
+import unittest
+import tempfile
+import threading
+import socket
+import shutil
+import json
+import os
+
+try:
+  import paramiko
+except ImportError:
+  paramiko = None
+
+import cmod.sshfiler as sshfiler
+
+USERNAME = 'calib'
+PASSWORD = 'calib'
+
+if paramiko is not None:
+
+  class SFTPHandle(paramiko.SFTPHandle):
+    """
+    File handle of the test server. Writes fail as requested by the server
+    settings, after writing part of the block to emulate a dropped connection.
+    """
+
+    def __init__(self, server, flags):
+      paramiko.SFTPHandle.__init__(self, flags)
+      self.server = server
+
+    def write(self, offset, data):
+      settings = self.server.settings
+      if settings['failures'] > 0 and settings['partial'] is not None:
+        settings['failures'] -= 1
+        paramiko.SFTPHandle.write(self, offset, data[:settings['partial']])
+        return paramiko.SFTP_FAILURE
+      return paramiko.SFTPHandle.write(self, offset, data)
+
+    def stat(self):
+      return paramiko.SFTPAttributes.from_stat(os.fstat(
+          self.readfile.fileno()))
+
+  class SFTPServer(paramiko.SFTPServerInterface):
+    """
+    SFTP server rooted at the temporary directory of the test.
+    """
+
+    def __init__(self, server, root, settings, *args, **kwargs):
+      paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+      self.root = root
+      self.settings = settings
+
+    def path(self, path):
+      return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def open(self, path, flags, attr):
+      try:
+        fd = os.open(self.path(path), flags, 0o644)
+      except OSError as err:
+        return paramiko.SFTPServer.convert_errno(err.errno)
+      if flags & os.O_WRONLY:
+        mode = 'ab' if flags & os.O_APPEND else 'wb'
+      elif flags & os.O_RDWR:
+        mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+      else:
+        mode = 'rb'
+      handle = SFTPHandle(self, flags)
+      handle.readfile = handle.writefile = os.fdopen(fd, mode)
+      return handle
+
+    def stat(self, path):
+      try:
+        return paramiko.SFTPAttributes.from_stat(os.stat(self.path(path)))
+      except OSError as err:
+        return paramiko.SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def chattr(self, path, attr):
+      try:
+        if attr._flags & attr.FLAG_SIZE:
+          os.truncate(self.path(path), attr.st_size)
+      except OSError as err:
+        return paramiko.SFTPServer.convert_errno(err.errno)
+      return paramiko.SFTP_OK
+
+  class SSHServer(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+      if username == USERNAME and password == PASSWORD:
+        return paramiko.AUTH_SUCCESSFUL
+      return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+      return 'password'
+
+    def check_channel_request(self, kind, chanid):
+      if kind == 'session':
+        return paramiko.OPEN_SUCCEEDED
+      return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class TestSSHFiler(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.hostkey = paramiko.RSAKey.generate(2048)
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.root = os.path.join(self.tmpdir, 'remote')
+    self.spool = os.path.join(self.tmpdir, 'spool')
+    os.makedirs(self.root)
+    self.settings = {'failures': 0, 'partial': None}
+    self.transports = []
+
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(5)
+    threading.Thread(target=self.accept_loop, daemon=True).start()
+    self.filers = []
+
+  def tearDown(self):
+    for filer in self.filers:
+      filer.close()
+    self.listener.close()
+    for transport in self.transports:
+      transport.close()
+    shutil.rmtree(self.tmpdir)
+
+  def accept_loop(self):
+    while True:
+      try:
+        sock, _ = self.listener.accept()
+      except OSError:
+        return
+      transport = paramiko.Transport(sock)
+      transport.add_server_key(self.hostkey)
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPServer,
+                                      self.root, self.settings)
+      transport.start_server(server=SSHServer())
+      self.transports.append(transport)
+
+  def connect(self):
+    filer = sshfiler.SSHFiler()
+    filer.spooldir = self.spool
+    filer.setremotepath('/')
+    filer.connect('127.0.0.1',
+                  USERNAME,
+                  PASSWORD,
+                  port=self.listener.getsockname()[1])
+    self.filers.append(filer)
+    return filer
+
+  def remote_content(self, name):
+    with open(os.path.join(self.root, name), 'rb') as f:
+      return f.read()
+
+  def spool_files(self):
+    return os.listdir(self.spool) if os.path.isdir(self.spool) else []
+
+  def spool_upload(self, name, data, offset, keep=False):
+    """
+    Local file and manifest of an upload to the given remote file, left over by
+    a terminated session after offset bytes were uploaded. The local file is a
+    spool file, or a file outside the spool directory if kept.
+    """
+    os.makedirs(self.spool, exist_ok=True)
+    spoolname = os.path.join(self.spool, '0.000000_' + name)
+    localname = os.path.join(self.tmpdir, name) if keep else spoolname
+    with open(localname, 'wb') as f:
+      f.write(data)
+    with open(spoolname + '.upload', 'w') as f:
+      json.dump(
+          {
+              'remote': '/' + name,
+              'local': localname,
+              'manifest': spoolname + '.upload',
+              'offset': offset,
+              'base': 0,
+              'wipe': False,
+              'closed': False,
+              'keep': keep,
+              'verify': False,
+          }, f)
+    return localname
+
+  def test_streaming(self):
+    filer = self.connect()
+    f = filer.remotefile('stream.txt', True)
+    lines = ['{0:d} {1}\n'.format(idx, 'x' * 100) for idx in range(2000)]
+    for idx, line in enumerate(lines):
+      f.write(line)
+      if idx % 500 == 0:
+        f.flush()
+    f.close()
+    self.assertTrue(filer.wait_uploads(30))
+    self.assertEqual(self.remote_content('stream.txt'),
+                     ''.join(lines).encode())
+    self.assertEqual(self.spool_files(), [])
+
+  def test_append(self):
+    with open(os.path.join(self.root, 'append.txt'), 'w') as f:
+      f.write('existing\n')
+    filer = self.connect()
+    filer.writeto('append.txt', 'appended\n')
+    self.assertTrue(filer.wait_uploads(30))
+    self.assertEqual(self.remote_content('append.txt'),
+                     b'existing\nappended\n')
+
+  def test_retry(self):
+    """
+    A failed write leaves part of the block in the remote file, the retry must
+    continue from the remote file size without duplicating content.
+    """
+    self.settings.update(failures=2, partial=1000)
+    filer = self.connect()
+    data = os.urandom(200000)
+    f = filer.remotefile('retry.bin', True, binary=True)
+    f.write(data)
+    f.close()
+    self.assertTrue(filer.wait_uploads(60))
+    self.assertEqual(self.settings['failures'], 0)
+    self.assertEqual(self.remote_content('retry.bin'), data)
+
+  def test_parallel(self):
+    """
+    Large spooled file of a terminated session uploaded over multiple channels,
+    with the remote file never created by the streaming upload.
+    """
+    data = os.urandom(400000)
+    localname = self.spool_upload('parallel.bin', data, offset=0)
+    threshold = sshfiler.SSHFiler.PARALLEL_THRESHOLD
+    chunk = sshfiler.SSHFiler.PARALLEL_CHUNK
+    sshfiler.SSHFiler.PARALLEL_THRESHOLD = 100000
+    sshfiler.SSHFiler.PARALLEL_CHUNK = 50000
+    try:
+      filer = self.connect()
+      self.assertTrue(filer.wait_uploads(60))
+      self.assertEqual(filer.history[-1].channels,
+                       sshfiler.SSHFiler.PARALLEL_CHANNELS)
+    finally:
+      sshfiler.SSHFiler.PARALLEL_THRESHOLD = threshold
+      sshfiler.SSHFiler.PARALLEL_CHUNK = chunk
+    self.assertEqual(self.remote_content('parallel.bin'), data)
+    self.assertFalse(os.path.isfile(localname))
+
+  def test_resume(self):
+    """
+    Upload left over by a terminated session, with the recorded offset behind
+    the remote content, is completed on the next connection.
+    """
+    data = os.urandom(100000)
+    with open(os.path.join(self.root, 'resume.bin'), 'wb') as f:
+      f.write(data[:60000])
+    self.spool_upload('resume.bin', data, offset=40000)
+
+    filer = self.connect()
+    self.assertTrue(filer.wait_uploads(30))
+    self.assertEqual(self.remote_content('resume.bin'), data)
+    self.assertEqual(self.spool_files(), [])
+
+  def test_resume_copy(self):
+    """
+    Copy of a local file outside the spool directory (as for the columnar save
+    files) left over by a terminated session, is resumed from the manifest in
+    the spool directory and the local file is kept.
+    """
+    data = os.urandom(100000)
+    localname = self.spool_upload('copy.bin', data, offset=0, keep=True)
+
+    filer = self.connect()
+    self.assertTrue(filer.wait_uploads(30))
+    self.assertEqual(self.remote_content('copy.bin'), data)
+    self.assertEqual(self.spool_files(), [])
+    self.assertTrue(os.path.isfile(localname))
+
+
+if __name__ == '__main__':
+  unittest.main()